@@ -1,34 +1,103 @@
-from flask import Flask, request, jsonify, render_template, redirect, url_for
+from flask import Flask, request, jsonify, render_template, redirect, url_for, Response, stream_with_context, g
 from scope_creator import ScopeCreator
+from job_queue import JobQueue, STATUSES
+from metrics import HTTP_REQUEST_SECONDS, REGISTRY
+from request_timing import PROFILE_SAMPLE_RATE, log_timing, phase, profiled, start_phases, stop_phases
+from scope_catalog import HIGHLIGHT_START, HIGHLIGHT_END
+from chat_context import build_chat_context, covers
+from retry_policy import RetryLaterError
+from markupsafe import Markup, escape
 import json
 import os
 import datetime
-import requests
 from dotenv import load_dotenv
 import re
+import time
 
 # Load environment variables
 load_dotenv()
 
 app = Flask(__name__)
 scope_creator = ScopeCreator()
+# /generate queues scopes here; job_worker.py generates them in the background
+job_queue = JobQueue()
+
+def _route():
+    # The route pattern rather than the path, so scope IDs don't each get a metric series
+    return request.url_rule.rule if request.url_rule else "unmatched"
+
+@app.before_request
+def start_timer():
+    g.request_started = time.perf_counter()
+    # Phases such as prompt, llm and save add their time to this timer; see request_timing
+    g.phase_timer, g.phase_token = start_phases()
+
+@app.after_request
+def record_request_time(response):
+    started = g.get('request_started')
+    if started is not None:
+        HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, route=_route(),
+                                     status=response.status_code)
+        g.status = response.status_code
+        response.headers['Server-Timing'] = g.phase_timer.server_timing()
+    return response
+
+@app.teardown_request
+def log_request_time(error=None):
+    """Log the request's phase timings once it is done, which for a stream is when the stream ends."""
+    if g.get('stream_pending'):
+        # Flask also tears a streamed request down when its view returns; wait for the stream
+        return
+    token = g.pop('phase_token', None)
+    if token is None:
+        return
+    timer = g.phase_timer
+    stop_phases(token)
+    log_timing({
+        "event": "request",
+        "method": request.method,
+        "route": _route(),
+        "status": g.get('status', 500),
+        "total_ms": round(timer.elapsed() * 1000, 1),
+        "phases": timer.milliseconds()
+    })
+
+@REGISTRY.collector
+def collect_app_state():
+    """Gauges read at scrape time from state the app already keeps."""
+    breaker = scope_creator.get_transport_stats()["circuit_breaker"]
+    jobs = job_queue.stats()
+    return [
+        ("scope_llm_circuit_open", "gauge", "1 while the circuit breaker in front of the model API is open.",
+         [({}, 1 if breaker["state"] == "open" else 0)]),
+        ("scope_jobs", "gauge", "Background jobs by status.",
+         [({"status": status}, jobs.get(status, 0)) for status in STATUSES])
+    ]
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+def _service_unavailable(message: str, retry_after: float):
+    """503 response telling the client when the AI service is worth trying again."""
+    response = jsonify({"error": message})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+    return response
+
 @app.route('/analyze', methods=['POST'])
-def analyze():
+async def analyze():
     try:
         data = request.get_json()
         project_name = data.get('project_name')
         transcription = data.get('transcription', '')
+        use_cache = data.get('cache', True) is not False
 
         if not project_name:
             return jsonify({"error": "Project name is required"}), 400
 
-        # Get initial project analysis and questions
-        analysis = scope_creator.analyze_project(project_name, transcription)
+        # Get initial project analysis and questions; "cache": false asks the model again
+        analysis = await scope_creator.analyze_project_async(project_name, transcription, use_cache=use_cache)
         
         # Check if we got a raw response or parsed JSON
         if "raw_response" in analysis:
@@ -38,56 +107,167 @@ def analyze():
         else:
             return jsonify(analysis)
 
+    except RetryLaterError as e:
+        return _service_unavailable(str(e), e.retry_after)
     except Exception as e:
         print(f"Error in analyze: {str(e)}")
         return jsonify({"error": f"Error analyzing project requirements: {str(e)}"}), 500
 
 @app.route('/get_follow_up', methods=['POST'])
-def get_follow_up():
+async def get_follow_up():
     try:
         data = request.get_json()
         project_name = data.get('project_name')
         current_info = data.get('current_info', {})
+        use_cache = data.get('cache', True) is not False
 
         if not project_name:
             return jsonify({"error": "Project name is required"}), 400
 
-        # Get follow-up questions based on current information
-        follow_up_questions = scope_creator.get_follow_up_questions(project_name, current_info)
+        # Get follow-up questions based on current information; "cache": false asks the model again
+        follow_up_questions = await scope_creator.get_follow_up_questions_async(project_name, current_info,
+                                                                               use_cache=use_cache)
         
         return jsonify({
             "questions": follow_up_questions
         })
 
+    except RetryLaterError as e:
+        return _service_unavailable(str(e), e.retry_after)
     except Exception as e:
         print(f"Error in get_follow_up: {str(e)}")
         return jsonify({"error": f"Error getting follow-up questions: {str(e)}"}), 500
 
+@app.route('/cache_stats')
+def cache_stats():
+    """Hit and miss counters of the LLM response cache and the scope file cache."""
+    return jsonify({
+        "llm_responses": scope_creator.get_response_cache_stats(),
+        "scopes": scope_creator.get_cache_stats()
+    })
+
+@app.route('/health')
+def health():
+    """Whether the model API is currently usable; 503 while the circuit breaker is open."""
+    transport = scope_creator.get_transport_stats()
+    status = 503 if transport["circuit_breaker"]["state"] == "open" else 200
+    return jsonify({"status": "ok" if status == 200 else "degraded", "jobs": job_queue.stats(), **transport}), status
+
+@app.route('/metrics')
+def metrics():
+    """Request, model call and storage metrics of this process in the Prometheus text format."""
+    return Response(REGISTRY.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 @app.route('/generate', methods=['POST'])
 def generate():
+    """Queue a scope for generation by the background workers and return its job ID at once.
+
+    Poll /jobs/<job_id> for its status and fetch the scope from /jobs/<job_id>/result.
+    """
     try:
         data = request.get_json()
         project_name = data.get('project_name')
-        project_info = data.get('project_info', {})
-        model = data.get('model')
 
         if not project_name:
             return jsonify({"error": "Project name is required"}), 400
 
-        # Generate the scope document
-        result = scope_creator.generate_scope(project_name, project_info, model)
-        
-        if "error" in result:
-            return jsonify({"error": result["error"]}), 500
-            
+        # A repeated request_key (double click, retry) returns the job queued the first time
+        # "mode": "sectioned" writes the sections concurrently from an outline
+        job_id = job_queue.enqueue("generate_scope", {
+            "project_name": project_name,
+            "project_info": data.get('project_info', {}),
+            "model": data.get('model'),
+            "mode": data.get('mode')
+        }, dedupe_key=data.get('request_key'))
+        job = job_queue.get(job_id)
+
         return jsonify({
-            "scope": result["scope"],
-            "scope_id": result["id"]
-        })
+            "job_id": job_id,
+            "status": job["status"],
+            "status_url": url_for('job_status', job_id=job_id),
+            "result_url": url_for('job_result', job_id=job_id)
+        }), 202
 
     except Exception as e:
         print(f"Error in generate: {str(e)}")
-        return jsonify({"error": f"Error generating scope: {str(e)}"}), 500
+        return jsonify({"error": f"Error queueing scope generation: {str(e)}"}), 500
+
+def _job_summary(job):
+    summary = {key: job[key] for key in ("id", "status", "attempts", "max_attempts", "error", "created", "updated")}
+    if job["status"] == "done":
+        summary["scope_id"] = job["result"]["scope_id"]
+    return summary
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Status of a background job."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    return jsonify(_job_summary(job))
+
+@app.route('/jobs/<job_id>/result')
+def job_result(job_id):
+    """The scope a finished generation job produced; 202 while it is still queued or running."""
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    if job["status"] == "failed":
+        return jsonify({"error": job["error"] or "Failed to generate scope document", **_job_summary(job)}), 500
+    if job["status"] != "done":
+        response = jsonify(_job_summary(job))
+        response.status_code = 202
+        response.headers['Retry-After'] = '2'
+        return response
+
+    scope_id = job["result"]["scope_id"]
+    scope_data = scope_creator.get_saved_scope(scope_id)
+    if not scope_data:
+        return jsonify({"error": "Generated scope no longer exists"}), 404
+    return jsonify({"scope": scope_data["scope"], "scope_id": scope_id})
+
+def _sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+@app.route('/generate/stream', methods=['POST'])
+def generate_stream():
+    """Generate a scope document, streaming it to the page as Server-Sent Events.
+
+    Sends "delta" events with raw text as the model writes it, then a "done" event with the
+    formatted scope and its saved ID, or an "error" event.
+    """
+    data = request.get_json()
+    project_name = data.get('project_name')
+    project_info = data.get('project_info', {})
+    model = data.get('model')
+
+    if not project_name:
+        return jsonify({"error": "Project name is required"}), 400
+
+    def events():
+        try:
+            # Flush the headers straight away so proxies see a response before the model starts
+            yield ": generating\n\n"
+            for event, payload in scope_creator.generate_scope_stream(project_name, project_info, model,
+                                                                      request_key=data.get('request_key')):
+                if event == "delta":
+                    yield _sse_event("delta", {"text": payload})
+                elif event == "done":
+                    # The Server-Timing header went out before generation began, so the phases are sent here
+                    yield _sse_event("done", {"scope": payload["scope"], "scope_id": payload["id"],
+                                              "timing": g.phase_timer.milliseconds()})
+                else:
+                    yield _sse_event("error", {"error": payload})
+        finally:
+            g.stream_pending = False
+
+    g.stream_pending = True
+
+    return Response(stream_with_context(events()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
 
 @app.route('/save_api_key', methods=['POST'])
 def save_api_key():
@@ -201,8 +381,10 @@ def clean_and_format_scope(scope):
 
 @app.route('/scopes')
 def list_scopes():
-    """List all saved scopes."""
-    scopes = scope_creator.list_saved_scopes()
+    """List saved scopes, newest first, one page at a time."""
+    limit = min(request.args.get('limit', 60, type=int), 500)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    scopes = scope_creator.list_saved_scopes(limit, offset)
     
     # Format timestamps for display
     for scope in scopes:
@@ -210,7 +392,28 @@ def list_scopes():
         if timestamp:
             scope["formatted_date"] = datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
     
-    return render_template('scopes.html', scopes=scopes)
+    return render_template('scopes.html', scopes=scopes, limit=limit, offset=offset)
+
+@app.route('/search')
+def search_scopes():
+    """Search saved scopes; returns JSON when called with format=json."""
+    query = request.args.get('q', '').strip()
+    limit = min(request.args.get('limit', 20, type=int), 100)
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    results = scope_creator.search_scopes(query, limit, offset) if query else []
+    
+    if request.args.get('format') == 'json':
+        for result in results:
+            result["snippet"] = result["snippet"].replace(HIGHLIGHT_START, "").replace(HIGHLIGHT_END, "")
+        return jsonify({"query": query, "results": results})
+    
+    # Escape the snippet text and turn the match markers into highlights
+    for result in results:
+        result["snippet"] = Markup(str(escape(result["snippet"]))
+                                   .replace(HIGHLIGHT_START, "<mark>")
+                                   .replace(HIGHLIGHT_END, "</mark>"))
+    
+    return render_template('search.html', query=query, results=results, limit=limit, offset=offset)
 
 @app.route('/scope/<scope_id>')
 def view_scope(scope_id):
@@ -218,18 +421,12 @@ def view_scope(scope_id):
     # Try to get the scope directly first
     scope_data = scope_creator.get_saved_scope(scope_id)
     
-    # If not found, try to find a match among available scopes
+    # If not found, redirect to the saved scope whose ID matches best
     if not scope_data:
-        # Get all scopes and check if any filename contains our scope_id
-        all_scopes = scope_creator.list_saved_scopes()
-        for scope in all_scopes:
-            if scope_id in scope.get("id", ""):
-                # Found a potential match, try with this ID instead
-                print(f"Original scope_id '{scope_id}' not found, using '{scope['id']}' instead")
-                scope_data = scope_creator.get_saved_scope(scope["id"])
-                if scope_data:
-                    # Redirect to the correct URL with the actual ID
-                    return redirect(url_for('view_scope', scope_id=scope["id"]))
+        resolved_id = scope_creator.resolve_scope_id(scope_id)
+        if resolved_id and resolved_id != scope_id:
+            print(f"Original scope_id '{scope_id}' not found, using '{resolved_id}' instead")
+            return redirect(url_for('view_scope', scope_id=resolved_id))
     
     if not scope_data:
         return render_template('error.html', message="Scope not found"), 404
@@ -242,18 +439,12 @@ def edit_scope(scope_id):
     # Try to get the scope directly first
     scope_data = scope_creator.get_saved_scope(scope_id)
     
-    # If not found, try to find a match among available scopes
+    # If not found, redirect to the saved scope whose ID matches best
     if not scope_data:
-        # Get all scopes and check if any filename contains our scope_id
-        all_scopes = scope_creator.list_saved_scopes()
-        for scope in all_scopes:
-            if scope_id in scope.get("id", ""):
-                # Found a potential match, try with this ID instead
-                print(f"Original scope_id '{scope_id}' not found, using '{scope['id']}' instead")
-                scope_data = scope_creator.get_saved_scope(scope["id"])
-                if scope_data:
-                    # Redirect to the correct URL with the actual ID
-                    return redirect(url_for('edit_scope', scope_id=scope["id"]))
+        resolved_id = scope_creator.resolve_scope_id(scope_id)
+        if resolved_id and resolved_id != scope_id:
+            print(f"Original scope_id '{scope_id}' not found, using '{resolved_id}' instead")
+            return redirect(url_for('edit_scope', scope_id=resolved_id))
     
     if not scope_data:
         return render_template('error.html', message="Scope not found"), 404
@@ -285,35 +476,41 @@ def scope_history(scope_id):
         
     return render_template('scope_history.html', scope=scope_data, scope_id=scope_id, history=history)
 
-@app.route('/scope/<scope_id>/version/<timestamp>')
-def view_scope_version(scope_id, timestamp):
+@app.route('/scope/<scope_id>/versions/<int:version_id>')
+def view_scope_version(scope_id, version_id):
     """View a specific version of a scope."""
     scope_data = scope_creator.get_saved_scope(scope_id)
-    history = scope_creator.get_scope_history(scope_id)
     
-    if not scope_data or not history:
+    if not scope_data:
         return render_template('error.html', message="Scope or history not found"), 404
     
-    # Find the requested version
-    timestamp = float(timestamp)
-    version = None
-    for v in history:
-        if v.get("timestamp") == timestamp:
-            version = v
-            break
+    # Rebuild the requested version from the stored history
+    version = scope_creator.get_scope_version(scope_id, version_id)
     
     if not version:
         return render_template('error.html', message="Version not found"), 404
         
     return render_template('view_scope_version.html', scope=scope_data, scope_id=scope_id, 
-                          version=version, current_timestamp=timestamp)
+                          version=version, version_id=version_id)
 
-@app.route('/scope/<scope_id>/restore/<timestamp>', methods=['POST'])
-def restore_scope_version(scope_id, timestamp):
+@app.route('/scope/<scope_id>/version/<timestamp>')
+def view_scope_version_by_timestamp(scope_id, timestamp):
+    """Redirect links that identify a version by timestamp to its version number."""
+    try:
+        version_id = scope_creator.find_version_id(scope_id, float(timestamp))
+    except ValueError:
+        version_id = None
+    
+    if not version_id:
+        return render_template('error.html', message="Version not found"), 404
+        
+    return redirect(url_for('view_scope_version', scope_id=scope_id, version_id=version_id))
+
+@app.route('/scope/<scope_id>/versions/<int:version_id>/restore', methods=['POST'])
+def restore_scope_version(scope_id, version_id):
     """Restore a scope to a previous version."""
     try:
-        timestamp = float(timestamp)
-        success = scope_creator.restore_scope_version(scope_id, timestamp)
+        success = scope_creator.restore_scope_version(scope_id, version_id)
         
         if not success:
             return jsonify({"error": "Failed to restore version"}), 500
@@ -322,31 +519,43 @@ def restore_scope_version(scope_id, timestamp):
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
-@app.route('/ai_chat', methods=['POST'])
-def ai_chat():
+@app.route('/scope/<scope_id>/restore/<timestamp>', methods=['POST'])
+def restore_scope_version_by_timestamp(scope_id, timestamp):
+    """Restore a scope to a previous version identified by timestamp."""
     try:
-        data = request.get_json()
-        user_message = data.get('message', '')
-        document_content = data.get('document_content', '')
-        project_name = data.get('project_name', '')
-        scope_id = data.get('scope_id', '')
-        
-        if not user_message or not document_content:
-            return jsonify({"error": "Message and document content are required"}), 400
+        version_id = scope_creator.find_version_id(scope_id, float(timestamp))
+        if not version_id:
+            return jsonify({"error": "Version not found"}), 404
             
-        # Add line numbers to document content for precise referencing
-        content_lines = document_content.split('\n')
-        numbered_content = ""
-        for i, line in enumerate(content_lines, 1):
-            numbered_content += f"{i:04d}: {line}\n"
-            
-        # Prepare the prompt for the AI model
-        prompt = f"""You are an AI assistant helping a user edit their document. Your task is to provide suggestions, improvements, or edits based on the user's request.
+        return restore_scope_version(scope_id, version_id)
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@phase("prompt")
+def _chat_messages(user_message, document_content, project_name, cursor_line=None):
+    """Prompt messages for the editor's AI chat, and the part of the document they show.
+
+    Long documents are cut down to the sections near the cursor or relevant to the message,
+    plus an outline of the rest; see chat_context.build_chat_context.
+    """
+    context = build_chat_context(document_content, user_message, cursor_line)
+    if context["windowed"]:
+        document_note = ("The document is too long to show in full. Below is an outline of all of its sections with "
+                         "their line ranges, then the sections relevant to the request, with line numbers at the start "
+                         "of each line in the format \"NNNN: \". The line numbers are positions in the whole document. "
+                         "Only edit lines that are shown; if the request is about another section, say which one and "
+                         "ask the user to put their cursor in it.")
+    else:
+        document_note = ("The document below includes line numbers at the start of each line in the format \"NNNN: \" "
+                         "where NNNN is the line number.")
+
+    # Prepare the prompt for the AI model
+    prompt = f"""You are an AI assistant helping a user edit their document. Your task is to provide suggestions, improvements, or edits based on the user's request.
 
 Document Context (Project: {project_name}):
-The document below includes line numbers at the start of each line in the format "NNNN: " where NNNN is the line number.
+{document_note}
 ```
-{numbered_content}
+{context["text"]}
 ```
 
 User Request: {user_message}
@@ -377,39 +586,32 @@ IMPORTANT:
 
 Only use the JSON format when you need to make specific text edits. For general advice or when answering questions, just provide the explanation without the JSON.
 """
+    
+    messages = [
+        {"role": "system", "content": "You are a helpful AI assistant specialized in document editing. You're careful about line numbers and precise editing."},
+        {"role": "user", "content": prompt}
+    ]
+    return messages, context
+
+@app.route('/ai_chat', methods=['POST'])
+def ai_chat():
+    try:
+        data = request.get_json()
+        user_message = data.get('message', '')
+        document_content = data.get('document_content', '')
+        project_name = data.get('project_name', '')
+        scope_id = data.get('scope_id', '')
+        # 1-based line the editor's cursor is on, if the page sent it
+        cursor_line = data.get('cursor_line')
+        cursor_line = cursor_line if isinstance(cursor_line, int) and cursor_line > 0 else None
         
-        # Call the Deepseek r-1 model through OpenRouter API
-        api_key = os.getenv("OPENROUTER_API_KEY")
-        if not api_key:
-            return jsonify({"error": "OpenRouter API key not found. Please set it in your .env file."}), 500
+        if not user_message or not document_content:
+            return jsonify({"error": "Message and document content are required"}), 400
             
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {api_key}",
-            "HTTP-Referer": request.headers.get('Host', 'localhost')  # Optional
-        }
-        
-        payload = {
-            "model": "google/gemini-2.0-pro-exp-02-05:free",
-            "messages": [
-                {"role": "system", "content": "You are a helpful AI assistant specialized in document editing. You're careful about line numbers and precise editing."},
-                {"role": "user", "content": prompt}
-            ],
-            "temperature": 0.5,  # Lower temperature for more precise output
-            "max_tokens": 1500
-        }
-        
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers=headers,
-            json=payload
-        )
-        
-        if response.status_code != 200:
-            return jsonify({"error": f"Error from AI service: {response.text}"}), 500
-
-        ai_response = response.json()
-        ai_message = ai_response['choices'][0]['message']['content']
+        content_lines = document_content.split('\n')
+        messages, context = _chat_messages(user_message, document_content, project_name, cursor_line)
+        # Call the model through the shared transport, with the same connection pool and retries as generation
+        ai_message = scope_creator.chat(messages, model=data.get('model'))
         
         # Extract JSON if present
         edit_data = None
@@ -429,6 +631,11 @@ Only use the JSON format when you need to make specific text edits. For general
                         print(f"Invalid line range: {start_line}-{end_line}, document has {len(content_lines)} lines")
                         edit_data = None
                         ai_message += "\n\nNote: I suggested an edit with invalid line numbers. Please provide more specific instructions about which section you'd like to edit."
+                    elif not covers(context, start_line, end_line):
+                        # The model was only shown part of a long document and can't edit what it didn't see
+                        print(f"Edit of lines {start_line}-{end_line} outside the lines shown: {context['ranges']}")
+                        edit_data = None
+                        ai_message += "\n\nNote: I suggested an edit to lines I couldn't see. Place your cursor in the section you'd like to change and ask again."
             except json.JSONDecodeError as e:
                 print(f"Error parsing JSON: {e}")
                 # We'll still return the message even if JSON parsing fails
@@ -441,9 +648,17 @@ Only use the JSON format when you need to make specific text edits. For general
             "edit": edit_data
         })
         
+    except RetryLaterError as e:
+        return _service_unavailable(str(e), e.retry_after)
     except Exception as e:
         print(f"Error in AI chat: {str(e)}")
         return jsonify({"error": f"Error processing request: {str(e)}"}), 500
 
+# Run a sample of requests under cProfile, saving the slow ones; see request_timing.sampled_profile
+if PROFILE_SAMPLE_RATE > 0:
+    for endpoint, view in list(app.view_functions.items()):
+        if endpoint != 'static':
+            app.view_functions[endpoint] = profiled(view, endpoint)
+
 if __name__ == '__main__':
     app.run(debug=True, port=5006) 
\ No newline at end of file
@@ -0,0 +1,193 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import time
+from typing import Dict, List, Optional, Tuple
+
+from llm_transport import track_usage
+from rate_limit import RateLimiter, SharedRateLimiter
+from retry_policy import RetryLaterError
+
+
+def job_id(job: Dict) -> str:
+    """The job's "id", or a hash of its contents, so reordering the input doesn't break resuming."""
+    if job.get("id"):
+        return str(job["id"])
+    payload = json.dumps(job, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def load_jobs(path: str) -> List[Tuple[str, Dict]]:
+    """Read (job ID, job) pairs from a JSONL file, skipping lines that aren't valid jobs."""
+    jobs = []
+    with open(path, 'r') as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                print(f"Skipping line {number}: {str(e)}")
+                continue
+            if not isinstance(job, dict) or not job.get("project_name"):
+                print(f"Skipping line {number}: project_name is required")
+                continue
+            jobs.append((job_id(job), job))
+    return jobs
+
+
+def load_checkpoint(path: str) -> Dict[str, Dict]:
+    """Results of earlier runs by job ID; the last record of a job wins."""
+    records = {}
+    try:
+        with open(path, 'r') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # A line cut short when a run was killed
+                records[record["job_id"]] = record
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def _answers(job: Dict) -> List[Tuple[str, str]]:
+    answers = job.get("answers") or {}
+    if isinstance(answers, dict):
+        return [(str(question), str(answer)) for question, answer in answers.items()]
+    return [(str(item.get("question", "")), str(item.get("answer", ""))) for item in answers if isinstance(item, dict)]
+
+
+def project_info(job: Dict, analysis: Dict) -> Dict:
+    """The project_info the web page would submit: the analysis questions plus the job's answers."""
+    questions = [{"question": question} for question, _ in _answers(job)]
+    questions += [q for q in analysis.get("initial_questions", []) if isinstance(q, dict)]
+    info = {"transcription": job.get("transcription", ""), "initial_questions": questions}
+    for i, (_, answer) in enumerate(_answers(job)):
+        info[str(i)] = answer
+    return info
+
+
+async def _wait_to_retry(project_name: str, message: str, retry_after: float):
+    retry_after = max(1.0, retry_after)
+    print(f"{project_name} waiting {retry_after:.0f}s: {message}")
+    await asyncio.sleep(retry_after)
+
+
+async def run_job(creator, job_key: str, job: Dict, model: Optional[str], mode: Optional[str]) -> Dict:
+    """Analyze and generate one project; returns its checkpoint record.
+
+    Calls turned away by the rate limiter or the circuit breaker are waited out and
+    repeated, rather than recorded as failures, however long that takes.
+    """
+    started = time.perf_counter()
+    record = {"job_id": job_key, "project_name": job["project_name"]}
+    with track_usage() as usage:
+        try:
+            while True:
+                try:
+                    analysis = await creator.analyze_project_async(job["project_name"], job.get("transcription"))
+                    break
+                except RetryLaterError as e:
+                    await _wait_to_retry(job["project_name"], str(e), e.retry_after)
+            while True:
+                result = await creator.generate_scope_async(job["project_name"], project_info(job, analysis),
+                                                            job.get("model") or model, request_key=job_key,
+                                                            mode=job.get("mode") or mode)
+                if "retry_after" not in result:
+                    break
+                await _wait_to_retry(job["project_name"], result["error"], result["retry_after"])
+            if "error" in result:
+                record.update(status="error", error=result["error"])
+            else:
+                record.update(status="ok", scope_id=result["id"])
+        except Exception as e:
+            record.update(status="error", error=str(e))
+    record.update(latency=round(time.perf_counter() - started, 3), usage=dict(usage), finished=time.time())
+    return record
+
+
+async def run_batch(creator, jobs: List[Tuple[str, Dict]], checkpoint: str, concurrency: int,
+                    model: Optional[str] = None, mode: Optional[str] = None, records: Optional[List] = None) -> List[Dict]:
+    """Run jobs with at most concurrency in progress, appending each result to the checkpoint file."""
+    records = records if records is not None else []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    with open(checkpoint, 'a') as out:
+        async def run(job_key: str, job: Dict):
+            async with semaphore:
+                record = await run_job(creator, job_key, job, model, mode)
+            out.write(json.dumps(record) + "\n")
+            out.flush()
+            records.append(record)
+            status = "ok" if record["status"] == "ok" else f"error: {record['error']}"
+            print(f"[{len(records)}/{len(jobs)}] {job['project_name']} ({record['latency']:.1f}s) {status}")
+
+        await asyncio.gather(*(run(job_key, job) for job_key, job in jobs))
+    return records
+
+
+def _percentile(values: List[float], percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+
+def summarize(records: List[Dict], skipped: int, elapsed: float) -> str:
+    ok = [r for r in records if r["status"] == "ok"]
+    latencies = [r["latency"] for r in records]
+    tokens = {key: sum(r.get("usage", {}).get(key, 0) for r in records)
+              for key in ("calls", "prompt_tokens", "completion_tokens", "total_tokens")}
+    lines = [
+        f"{len(ok)} generated, {len(records) - len(ok)} failed, {skipped} already done, "
+        f"in {elapsed:.1f}s ({len(records) / elapsed * 60 if elapsed else 0:.1f} jobs/min)",
+        f"latency p50 {_percentile(latencies, 50):.1f}s, p95 {_percentile(latencies, 95):.1f}s, "
+        f"max {max(latencies, default=0):.1f}s",
+        f"{tokens['calls']} model calls, {tokens['prompt_tokens']} prompt + {tokens['completion_tokens']} "
+        f"completion = {tokens['total_tokens']} tokens"
+    ]
+    if ok:
+        lines.append(f"{tokens['total_tokens'] / len(ok):.0f} tokens per generated scope")
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Generate scopes for every project in a JSONL file. Each line is an object with "
+                    "project_name and optionally id, transcription, answers ({question: answer}), model "
+                    "and mode. Finished jobs are recorded in the checkpoint file and skipped on the next run.")
+    parser.add_argument("jobs", help="JSONL file of projects")
+    parser.add_argument("--checkpoint", help="results file used to resume; defaults to <jobs>.done.jsonl")
+    parser.add_argument("--concurrency", type=int, default=4, help="projects in progress at once")
+    parser.add_argument("--rate", type=float, default=0, help="most model calls per minute; 0 for no limit")
+    parser.add_argument("--model", help="model for jobs that don't name one")
+    parser.add_argument("--mode", choices=["single", "sectioned"], help="scope generation mode")
+    parser.add_argument("--skip-failed", action="store_true", help="don't run jobs that failed last time again")
+    args = parser.parse_args()
+
+    checkpoint = args.checkpoint or f"{os.path.splitext(args.jobs)[0]}.done.jsonl"
+    done = load_checkpoint(checkpoint)
+    jobs = load_jobs(args.jobs)
+    finished = {"ok", "error"} if args.skip_failed else {"ok"}
+    pending = [(key, job) for key, job in jobs if done.get(key, {}).get("status") not in finished]
+    print(f"{len(jobs)} jobs, {len(jobs) - len(pending)} already done, {len(pending)} to run")
+
+    from scope_creator import ScopeCreator
+    creator = ScopeCreator()
+    if args.rate > 0:
+        # A budget of this run's own; the shared budgets of the key and models still apply
+        if isinstance(creator.transport.rate_limiter, SharedRateLimiter):
+            creator.transport.rate_limiter.process = RateLimiter(args.rate / 60)
+        else:
+            creator.transport.rate_limiter = RateLimiter(args.rate / 60)
+
+    records = []
+    started = time.perf_counter()
+    try:
+        asyncio.run(run_batch(creator, pending, checkpoint, args.concurrency, args.model, args.mode, records))
+    except KeyboardInterrupt:
+        print(f"\nInterrupted; run again to resume. Progress is saved in {checkpoint}")
+    print(summarize(records, len(jobs) - len(pending), time.perf_counter() - started))
@@ -0,0 +1,145 @@
+"""Stress test for concurrent scope saves.
+
+Runs many processes, each with several threads, that save edits to a handful of scopes at
+the same time, then checks that every saved edit ended up either in the version history
+or as the current document of its scope, that versions are numbered without gaps and can
+be found by their timestamps, and, for the file backend, that every file still parses.
+Exits with status 1 if any check fails.
+
+    python benchmarks/concurrent_updates.py --processes 4 --threads 8 --updates 25
+    python benchmarks/concurrent_updates.py --backend sqlite
+"""
+import argparse
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scope_store import FileScopeStore  # noqa: E402
+from scope_store_sqlite import SQLiteScopeStore  # noqa: E402
+
+
+def _open_store(backend: str, scopes_dir: str, **kwargs):
+    if backend == "sqlite":
+        return SQLiteScopeStore(str(Path(scopes_dir) / "scopes.sqlite3"), **kwargs)
+    return FileScopeStore(scopes_dir, **kwargs)
+
+
+def _run_worker(backend: str, scopes_dir: str, scope_ids, worker: int, threads: int, updates: int) -> int:
+    store = _open_store(backend, scopes_dir)
+
+    def save(thread: int) -> int:
+        failures = 0
+        for n in range(updates):
+            scope_id = scope_ids[(worker + thread + n) % len(scope_ids)]
+            text = f"# Scope\n\nEdit from worker {worker} thread {thread} number {n}\n"
+            if not store.update(scope_id, {"project_name": scope_id, "scope": text}):
+                failures += 1
+        return failures
+
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(save, range(threads)))
+
+
+def _check_scope(store, scope_id: str):
+    """Return the texts of every version and the current document, and the problems found."""
+    problems = []
+    texts = set()
+    history = store.history(scope_id)
+    numbers = [v["version"] for v in history]
+    if numbers != list(range(1, len(history) + 1)):
+        problems.append(f"{scope_id}: version numbers are not 1..{len(history)}")
+    for v in history:
+        version = store.version(scope_id, v["version"])
+        if version is None:
+            problems.append(f"{scope_id}: version {v['version']} can't be read")
+            continue
+        texts.add(version["scope"])
+        if store.find_version_id(scope_id, v["timestamp"]) is None:
+            problems.append(f"{scope_id}: version {v['version']} isn't found by its timestamp")
+    current = store.get(scope_id)
+    if current is None:
+        problems.append(f"{scope_id}: can't be read")
+    else:
+        texts.add(current["scope"])
+    return texts, len(history), problems
+
+
+def _check_files(store) -> list:
+    """Parse every scope file the file backend wrote; a torn write shows up as invalid JSON."""
+    problems = []
+    for path in store.scopes_dir.rglob(f"*{store.layout.suffix}"):
+        try:
+            store.layout.read(path)
+        except Exception as e:
+            problems.append(f"{path.relative_to(store.scopes_dir)}: {str(e)}")
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--updates", type=int, default=25, help="saves per thread")
+    parser.add_argument("--scopes", type=int, default=3, help="number of scopes being edited")
+    parser.add_argument("--backend", choices=["file", "sqlite"], default="file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as scopes_dir:
+        if args.backend == "sqlite":
+            store = _open_store(args.backend, scopes_dir, snapshot_interval=5)
+        else:
+            store = _open_store(args.backend, scopes_dir, segment_size=5)
+        scope_ids = [f"stress_{i}" for i in range(args.scopes)]
+        for scope_id in scope_ids:
+            store.create({
+                "id": scope_id,
+                "project_name": scope_id,
+                "project_info": {},
+                "scope": "initial",
+                "date_created": time.time(),
+                "formatted_date": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+        started = time.perf_counter()
+        with ProcessPoolExecutor(max_workers=args.processes) as pool:
+            futures = [pool.submit(_run_worker, args.backend, scopes_dir, scope_ids, worker,
+                                   args.threads, args.updates)
+                       for worker in range(args.processes)]
+            failures = sum(f.result() for f in futures)
+        elapsed = time.perf_counter() - started
+
+        total = args.processes * args.threads * args.updates
+        expected = {f"# Scope\n\nEdit from worker {w} thread {t} number {n}\n"
+                    for w in range(args.processes) for t in range(args.threads) for n in range(args.updates)}
+        expected.add("initial")
+
+        found = set()
+        history_entries = 0
+        problems = []
+        for scope_id in scope_ids:
+            texts, length, scope_problems = _check_scope(store, scope_id)
+            found.update(texts)
+            history_entries += length
+            problems.extend(scope_problems)
+        if args.backend == "file":
+            problems.extend(_check_files(store))
+
+        print(f"{total} saves in {elapsed:.2f}s ({total / elapsed:.0f} saves/s), {failures} failed")
+        print(f"{history_entries} history entries across {len(scope_ids)} scopes")
+
+        lost = expected - found
+        for problem in problems:
+            print(problem)
+        if failures or lost or problems or history_entries != total:
+            print(f"FAILED: {failures} saves failed, {len(lost)} edits lost, {len(problems)} other problems, "
+                  f"expected {total} history entries")
+            sys.exit(1)
+        print("OK: no edits lost")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Compare how many LLM calls the sync and async request paths keep in flight.
+
+Starts the local mock of the OpenRouter chat completions endpoint (mock_openrouter.py) with
+a fixed delay, points ScopeCreator at it and makes the same number of calls:
+
+- sync:  _make_api_call from a pool of worker threads, like a threaded WSGI server
+- async: _make_api_call_async, all gathered on one event loop; the transport runs them
+         on its own event loop thread
+
+and reports the wall time, throughput, the most requests the mock saw at once and how many
+TCP connections were opened. The transport uses its default pool settings (LLM_POOL_SIZE and
+LLM_ASYNC_CONNECTIONS), as the app would.
+
+    python benchmarks/llm_concurrency.py --requests 200 --latency 0.5 --threads 8
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from mock_openrouter import MockConfig, mock_url, start_mock
+
+
+def _messages(i: int):
+    return [{"role": "user", "content": f"Request {i}"}]
+
+
+def _run_sync(creator, requests: int, threads: int) -> float:
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda i: creator._make_api_call(_messages(i), max_retries=1), range(requests)))
+    return time.perf_counter() - started
+
+
+def _run_async(creator, requests: int) -> float:
+    async def run():
+        await asyncio.gather(*(creator._make_api_call_async(_messages(i), max_retries=1)
+                               for i in range(requests)))
+
+    started = time.perf_counter()
+    asyncio.run(run())
+    return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds the mock takes to answer")
+    parser.add_argument("--threads", type=int, default=8, help="worker threads for the sync path")
+    args = parser.parse_args()
+
+    server = start_mock(MockConfig(latency=args.latency))
+    mock = server.config
+    os.environ["OPENROUTER_BASE_URL"] = mock_url(server)
+    os.environ.setdefault("OPENROUTER_API_KEY", "mock")
+    os.environ["LLM_CACHE_ENABLED"] = "false"
+
+    # ScopeCreator keeps its scopes and caches in the working directory
+    with tempfile.TemporaryDirectory() as workdir:
+        os.chdir(workdir)
+        from scope_creator import ScopeCreator
+        creator = ScopeCreator(model="mock")
+
+        print(f"{args.requests} calls, {args.latency * 1000:.0f}ms mock latency\n")
+        print(f"{'path':<28}{'wall':>10}{'calls/s':>10}{'peak in flight':>16}{'connections':>13}")
+        for name, run in ((f"sync, {args.threads} threads", lambda: _run_sync(creator, args.requests, args.threads)),
+                          ("async, 1 event loop", lambda: _run_async(creator, args.requests))):
+            mock.peak = 0
+            mock.connections = 0
+            elapsed = run()
+            print(f"{name:<28}{elapsed:>9.2f}s{args.requests / elapsed:>10.1f}{mock.peak:>16}"
+                  f"{mock.connections:>13}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
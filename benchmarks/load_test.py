@@ -0,0 +1,216 @@
+"""End-to-end load test of the web app against the local mock OpenRouter server.
+
+Starts mock_openrouter.py and app.py (on a threaded server, like `python app.py`) in this
+process, working in a temporary directory with a copy of context.txt and --seed-scopes
+saved scopes. Then, for every scenario and concurrency level, it sends --requests requests
+from that many client threads and reports requests per second and p50/p95/p99 latency.
+
+Scenarios:
+
+- analyze          POST /analyze
+- follow_up        POST /get_follow_up
+- generate         POST /generate (queues a job and returns)
+- generate_stream  POST /generate/stream, read to the end (a full generation)
+- ai_chat          POST /ai_chat
+- scope            GET /scope/<id>
+- scopes           GET /scopes
+
+Every request uses a different project, so the response cache and request coalescing don't
+hide the model calls; pass --cache to measure with the cache on. Settings such as
+SCOPE_STORAGE_BACKEND are taken from the environment.
+
+    python benchmarks/load_test.py --concurrency 1,8,32 --requests 100 --latency 0.5
+    python benchmarks/load_test.py --scenarios scope,scopes --json before.json
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import math
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from mock_openrouter import MockConfig, mock_url, scope_text, start_mock
+
+SCENARIOS = ["analyze", "follow_up", "generate", "generate_stream", "ai_chat", "scope", "scopes"]
+
+
+def _percentile(values, percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(percent / 100 * len(ordered)) - 1)] if ordered else 0.0
+
+
+class LoadTest:
+    """Builds the requests of each scenario and times them against a running app."""
+
+    def __init__(self, base_url: str, scope_ids, document: str):
+        self.base_url = base_url
+        self.scope_ids = scope_ids
+        self.document = document
+        self.random = random.Random(1)
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def _next(self) -> int:
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def request(self, scenario: str):
+        """Return (method, path, JSON body) for one request of scenario."""
+        n = self._next()
+        project = f"Load Test Project {n}"
+        info = {"transcription": f"Meeting {n} about the booking system", "initial_questions": [
+            {"question": "Which platforms must the product support?"}], "0": "Web and iOS"}
+        if scenario == "analyze":
+            return "POST", "/analyze", {"project_name": project, "transcription": info["transcription"]}
+        if scenario == "follow_up":
+            return "POST", "/get_follow_up", {"project_name": project, "current_info": info}
+        if scenario == "generate":
+            return "POST", "/generate", {"project_name": project, "project_info": info, "request_key": f"load-{n}"}
+        if scenario == "generate_stream":
+            return "POST", "/generate/stream", {"project_name": project, "project_info": info}
+        if scenario == "ai_chat":
+            return "POST", "/ai_chat", {"message": f"Make request {n} clearer", "document_content": self.document,
+                                        "project_name": project}
+        if scenario == "scope":
+            with self._lock:
+                scope_id = self.random.choice(self.scope_ids)
+            return "GET", f"/scope/{scope_id}", None
+        return "GET", "/scopes", None
+
+    def call(self, scenario: str):
+        """Send one request and return (seconds, ok)."""
+        method, path, body = self.request(scenario)
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(self.base_url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request, timeout=600) as response:
+                payload = response.read()
+                ok = response.status < 400 and b"event: error" not in payload
+        except (urllib.error.URLError, OSError):
+            ok = False
+        return time.perf_counter() - started, ok
+
+    def run(self, scenario: str, concurrency: int, requests: int):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            results = list(pool.map(lambda _: self.call(scenario), range(requests)))
+        wall = time.perf_counter() - started
+        latencies = [seconds * 1000 for seconds, _ in results]
+        return {
+            "scenario": scenario,
+            "concurrency": concurrency,
+            "requests": requests,
+            "errors": sum(1 for _, ok in results if not ok),
+            "wall": round(wall, 3),
+            "rps": round(requests / wall, 2),
+            "p50_ms": round(_percentile(latencies, 50), 1),
+            "p95_ms": round(_percentile(latencies, 95), 1),
+            "p99_ms": round(_percentile(latencies, 99), 1),
+            "max_ms": round(max(latencies), 1)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated client thread counts")
+    parser.add_argument("--requests", type=int, default=64, help="requests per scenario and concurrency level")
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds the mock takes to answer")
+    parser.add_argument("--jitter", type=float, default=0.1)
+    parser.add_argument("--chunk-delay", type=float, default=0.005, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of model calls that fail")
+    parser.add_argument("--scope-words", type=int, default=2000)
+    parser.add_argument("--seed-scopes", type=int, default=200, help="saved scopes to create before testing")
+    parser.add_argument("--cache", action="store_true", help="keep the LLM response cache on")
+    parser.add_argument("--json", help="also write the results to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the app's own output")
+    args = parser.parse_args()
+
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    levels = [int(level) for level in args.concurrency.split(",")]
+
+    mock = start_mock(MockConfig(latency=args.latency, jitter=args.jitter, chunk_delay=args.chunk_delay,
+                                 error_rate=args.error_rate, scope_words=args.scope_words, seed=1))
+    os.environ.update({
+        "OPENROUTER_BASE_URL": mock_url(mock),
+        "OPENROUTER_API_KEY": os.environ.get("OPENROUTER_API_KEY", "mock"),
+        "LLM_CACHE_ENABLED": "true" if args.cache else "false",
+        "LLM_RATE_LIMIT_ENABLED": "false",
+        "LLM_POOL_SIZE": os.environ.get("LLM_POOL_SIZE", str(max(levels) * 2))
+    })
+
+    json_path = os.path.abspath(args.json) if args.json else None
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="scope-load-")
+    if (ROOT / "context.txt").exists():
+        shutil.copy(ROOT / "context.txt", workdir)
+    os.chdir(workdir)
+
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with output:
+            import app
+            from werkzeug.serving import make_server
+
+            document = scope_text(args.scope_words)
+            scope_ids = []
+            for i in range(args.seed_scopes):
+                scope_id = f"seeded_scope_{i:05d}"
+                app.scope_creator.store.create({
+                    "id": scope_id, "project_name": f"Seeded Scope {i}", "project_info": {}, "scope": document,
+                    "date_created": time.time() - i, "formatted_date": time.strftime("%Y-%m-%d %H:%M:%S")
+                })
+                scope_ids.append(scope_id)
+
+            if not args.verbose:
+                logging.getLogger("werkzeug").setLevel(logging.ERROR)
+            server = make_server("127.0.0.1", 0, app.app, threaded=True)
+            server.socket.listen(1024)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            test = LoadTest(f"http://127.0.0.1:{server.server_port}", scope_ids or ["missing"], document)
+
+            results = []
+            for scenario in scenarios:
+                for concurrency in levels:
+                    results.append(test.run(scenario, concurrency, args.requests))
+                    result = results[-1]
+                    print(f"{scenario} x{concurrency}: {result['rps']} rps", file=sys.__stdout__, flush=True)
+            server.shutdown()
+    finally:
+        mock.shutdown()
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    print(f"\nmock latency {args.latency * 1000:.0f}ms, {args.requests} requests per row, "
+          f"{mock.config.requests} model calls, {mock.config.errors} failed by the mock\n")
+    print(f"{'scenario':<17}{'conc':>5}{'errors':>8}{'rps':>9}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}")
+    for r in results:
+        print(f"{r['scenario']:<17}{r['concurrency']:>5}{r['errors']:>8}{r['rps']:>9.1f}{r['p50_ms']:>10.1f}"
+              f"{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+    if json_path:
+        with open(json_path, 'w') as f:
+            json.dump({"settings": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,267 @@
+"""A local stand-in for OpenRouter's OpenAI-compatible chat completions endpoint.
+
+Answers POST .../chat/completions, streaming or not, with canned responses that fit the
+prompts ScopeCreator sends: analysis JSON, follow-up questions, scope outlines, scope
+documents and editor chat replies. Latency, streaming speed, error rate and the responses
+themselves are configurable, so the app can be measured without network access or tokens.
+
+Run it and point the app at it:
+
+    python benchmarks/mock_openrouter.py --port 8099 --latency 0.5 --error-rate 0.05
+    OPENROUTER_BASE_URL=http://127.0.0.1:8099/api/v1 OPENROUTER_API_KEY=mock python app.py
+
+or start it in-process with start_mock().
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional, Tuple
+
+ANALYSIS = {
+    "project_type": "Web application",
+    "relevant_sections": ["Project Purpose", "Requirements", "Assumptions"],
+    "initial_questions": [
+        {"question": "Which platforms must the product support?", "why_needed": "Determines the technical scope",
+         "section": "Requirements"},
+        {"question": "Which user roles need separate permissions?", "why_needed": "Drives access control",
+         "section": "Requirements"}
+    ]
+}
+
+OUTLINE = {
+    "summary": "A web application for managing bookings, with an administration area.",
+    "requirement_categories": [
+        {"title": "User Interface", "covers": ["screens", "navigation"]},
+        {"title": "Administration", "covers": ["user management", "reporting"]},
+        {"title": "Integrations", "covers": ["payments", "email"]}
+    ],
+    "assumption_topics": ["hosting", "browser support", "third-party services"]
+}
+
+CHAT_REPLY = """I'll tighten the opening of the Project Purpose section.
+
+```json
+{"start_line": 1, "end_line": 1, "new_text": "# Project Purpose"}
+```"""
+
+
+def scope_text(words: int) -> str:
+    """A Markdown scope document of about the given length."""
+    sentence = ("The system will validate every input on the server, record the change in the audit log and "
+                "show the result to the user within two seconds. ")
+    per_paragraph = len(sentence.split()) * 3
+    paragraphs = max(1, words // per_paragraph)
+    sections = ["## Project Purpose", "## Requirements", "### 1. User Interface", "### 2. Administration",
+                "## Assumptions"]
+    parts = ["# Mock Project", "October 2026"]
+    for i in range(paragraphs):
+        if i % max(1, paragraphs // len(sections)) == 0 and sections:
+            parts.append(sections.pop(0))
+        parts.append(f"{i + 1}. " + sentence * 3)
+    parts += sections
+    return "\n\n".join(parts)
+
+
+class MockConfig:
+    """How the mock answers; shared by all of its request threads."""
+
+    def __init__(self, latency: float = 0.5, jitter: float = 0.0, first_token: float = 0.2,
+                 chunk_delay: float = 0.01, chunk_words: int = 8, error_rate: float = 0.0,
+                 error_status: int = 500, retry_after: Optional[float] = None, scope_words: int = 2000,
+                 responses: Optional[List[Tuple[str, str]]] = None, seed: Optional[int] = None):
+        self.latency = latency
+        self.jitter = jitter
+        self.first_token = first_token
+        self.chunk_delay = chunk_delay
+        self.chunk_words = chunk_words
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.retry_after = retry_after
+        self.scope = scope_text(scope_words)
+        # (substring of the prompt, response) pairs checked before the built-in responses
+        self.responses = responses or []
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.peak = 0
+        self.connections = 0
+
+    def response_for(self, messages: List[Dict]) -> str:
+        prompt = "\n".join(str(message.get("content", "")) for message in messages)
+        for marker, response in self.responses:
+            if marker in prompt:
+                return response
+        if "analyze what type of project" in prompt:
+            return json.dumps(ANALYSIS)
+        if "determine if any CRITICAL information is still missing" in prompt:
+            return "[]"
+        if "You are planning a comprehensive scope document" in prompt:
+            return json.dumps(OUTLINE)
+        if "document editing" in prompt:
+            return CHAT_REPLY
+        return self.scope
+
+    def delay(self) -> float:
+        with self.lock:
+            return max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        with self.server.config.lock:
+            self.server.config.connections += 1
+
+    def _send_json(self, status: int, payload: Dict, headers: Optional[Dict] = None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        config = self.server.config
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("chat/completions"):
+            self._send_json(404, {"error": {"message": f"No route for {self.path}"}})
+            return
+
+        with config.lock:
+            config.requests += 1
+            config.in_flight += 1
+            config.peak = max(config.peak, config.in_flight)
+        try:
+            if config.should_fail():
+                time.sleep(config.delay() / 4)
+                with config.lock:
+                    config.errors += 1
+                headers = {"Retry-After": str(config.retry_after)} if config.retry_after is not None else {}
+                self._send_json(config.error_status, {"error": {"message": "Mock failure", "code": config.error_status}},
+                                headers)
+                return
+
+            messages = request.get("messages", [])
+            content = config.response_for(messages)
+            usage = {"prompt_tokens": sum(len(str(m.get("content", ""))) for m in messages) // 4,
+                     "completion_tokens": len(content) // 4}
+            usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+            if request.get("stream"):
+                self._stream(request, content, usage, config)
+            else:
+                time.sleep(config.delay())
+                self._send_json(200, {
+                    "id": "mock-completion",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "mock"),
+                    "choices": [{"index": 0, "finish_reason": "stop",
+                                 "message": {"role": "assistant", "content": content}}],
+                    "usage": usage
+                })
+        finally:
+            with config.lock:
+                config.in_flight -= 1
+
+    def _stream(self, request: Dict, content: str, usage: Dict, config: MockConfig):
+        """Send the response as server-sent chunks, like the API does with stream: true."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+        def send(data: str):
+            payload = f"data: {data}\n\n".encode('utf-8')
+            self.wfile.write(f"{len(payload):x}\r\n".encode('ascii') + payload + b"\r\n")
+            self.wfile.flush()
+
+        time.sleep(config.first_token)
+        words = content.split(" ")
+        for i in range(0, len(words), config.chunk_words):
+            text = " ".join(words[i:i + config.chunk_words]) + (" " if i + config.chunk_words < len(words) else "")
+            send(json.dumps({
+                "id": "mock-completion",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [{"index": 0, "delta": {"content": text}, "finish_reason": None}]
+            }))
+            time.sleep(config.chunk_delay)
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send(json.dumps({
+                "id": "mock-completion",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [],
+                "usage": usage
+            }))
+        send("[DONE]")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_mock(config: Optional[MockConfig] = None, port: int = 0) -> ThreadingHTTPServer:
+    """Serve the mock from a background thread; the URL is mock_url(server)."""
+    ThreadingHTTPServer.request_queue_size = 1024
+    server = ThreadingHTTPServer(("127.0.0.1", port), MockHandler)
+    server.daemon_threads = True
+    server.config = config or MockConfig()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def mock_url(server: ThreadingHTTPServer) -> str:
+    """The base URL to set as OPENROUTER_BASE_URL."""
+    return f"http://127.0.0.1:{server.server_address[1]}/api/v1"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--latency", type=float, default=0.5, help="seconds before a non-streamed answer")
+    parser.add_argument("--jitter", type=float, default=0.0, help="latency varies by up to this many seconds")
+    parser.add_argument("--first-token", type=float, default=0.2, help="seconds before the first streamed chunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.01, help="seconds between streamed chunks")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests that fail")
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--retry-after", type=float, help="Retry-After header sent with failures")
+    parser.add_argument("--scope-words", type=int, default=2000, help="length of generated scopes")
+    parser.add_argument("--responses", help='JSON file of [["prompt substring", "response"], ...] to answer with')
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    responses = None
+    if args.responses:
+        with open(args.responses, 'r') as f:
+            responses = [tuple(pair) for pair in json.load(f)]
+    config = MockConfig(args.latency, args.jitter, args.first_token, args.chunk_delay, error_rate=args.error_rate,
+                        error_status=args.error_status, retry_after=args.retry_after, scope_words=args.scope_words,
+                        responses=responses, seed=args.seed)
+    server = start_mock(config, args.port)
+    print(f"Mock OpenRouter at {mock_url(server)}; Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(60)
+            print(f"{config.requests} requests, {config.errors} failed, peak {config.peak} in flight")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Compare scope storage layouts for write, read and list.
+
+Creates the same set of scopes in a temporary directory for each layout and compression
+(flat JSON, sharded JSON, sharded gzip and, if the zstandard package is installed, sharded
+zstd), then times:
+
+- write: creating every scope and saving one edit to each
+- read:  loading scope heads in random order with the parsed-file cache turned off
+- list:  enumerating scope files from the directory, and listing from the catalog
+
+    python benchmarks/storage_layout.py --scopes 2000 --reads 2000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from scope_cache import ScopeCache  # noqa: E402
+from scope_layout import zstandard  # noqa: E402
+from scope_store import FileScopeStore  # noqa: E402
+
+CONFIGURATIONS = [("flat", "none"), ("sharded", "none"), ("sharded", "gzip"), ("sharded", "zstd")]
+
+
+def _sample_text() -> str:
+    sample_path = Path(__file__).resolve().parent.parent / "context.txt"
+    try:
+        return sample_path.read_text()
+    except FileNotFoundError:
+        return "## Requirements\n\n1. The system shall do something measurable.\n" * 100
+
+
+def _disk_usage(directory: str) -> int:
+    total = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.startswith("catalog.sqlite3"):
+                total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def _run(layout: str, compression: str, scopes: int, reads: int, text: str) -> dict:
+    os.environ["SCOPE_STORAGE_LAYOUT"] = layout
+    os.environ["SCOPE_COMPRESSION"] = compression
+    with tempfile.TemporaryDirectory() as scopes_dir:
+        store = FileScopeStore(scopes_dir)
+        store.cache = ScopeCache(max_bytes=0)
+        scope_ids = [f"project_{i}_20250101{i % 1000000:06d}" for i in range(scopes)]
+
+        started = time.perf_counter()
+        for i, scope_id in enumerate(scope_ids):
+            store.create({
+                "id": scope_id,
+                "project_name": f"Project {i}",
+                "project_info": {"0": f"Answer for project {i}"},
+                "scope": f"# Project {i}\n\n{text}",
+                "date_created": time.time(),
+                "formatted_date": time.strftime("%Y-%m-%d %H:%M:%S")
+            })
+        for i, scope_id in enumerate(scope_ids):
+            store.update(scope_id, {"scope": f"# Project {i} (edited)\n\n{text}"})
+        write_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        for scope_id in random.choices(scope_ids, k=reads):
+            store.get(scope_id)
+        read_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        listed = sum(1 for _ in store.layout.iter_head_paths())
+        scan_time = time.perf_counter() - started
+
+        started = time.perf_counter()
+        store.list()
+        catalog_time = time.perf_counter() - started
+
+        assert listed == scopes
+        return {
+            "write_ms": write_time * 1000 / (2 * scopes),
+            "read_ms": read_time * 1000 / reads,
+            "scan_ms": scan_time * 1000,
+            "catalog_ms": catalog_time * 1000,
+            "disk_mb": _disk_usage(scopes_dir) / (1024 * 1024)
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scopes", type=int, default=2000)
+    parser.add_argument("--reads", type=int, default=2000)
+    args = parser.parse_args()
+
+    text = _sample_text()
+    print(f"{args.scopes} scopes of about {len(text.split())} words, {args.reads} reads\n")
+    print(f"{'layout':<20}{'write/op':>12}{'read/op':>12}{'dir scan':>12}{'catalog':>12}{'disk':>12}")
+    for layout, compression in CONFIGURATIONS:
+        if compression == "zstd" and zstandard is None:
+            print(f"{layout + '/' + compression:<20}  skipped, zstandard is not installed")
+            continue
+        result = _run(layout, compression, args.scopes, args.reads, text)
+        print(f"{layout + '/' + compression:<20}"
+              f"{result['write_ms']:>10.2f}ms{result['read_ms']:>10.3f}ms"
+              f"{result['scan_ms']:>10.1f}ms{result['catalog_ms']:>10.1f}ms"
+              f"{result['disk_mb']:>10.1f}MB")
+
+
+if __name__ == '__main__':
+    main()
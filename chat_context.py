@@ -0,0 +1,163 @@
+import os
+import re
+from typing import Dict, List, Optional, Tuple
+
+from context_index import BM25, estimate_tokens
+
+# Most document text, in estimated tokens, put in one AI chat prompt; shorter documents are sent whole
+CHAT_CONTEXT_TOKEN_BUDGET = int(os.getenv("CHAT_CONTEXT_TOKEN_BUDGET", "3000"))
+# Most sections picked by relevance to the message, besides the one holding the cursor
+CHAT_CONTEXT_TOP_K = int(os.getenv("CHAT_CONTEXT_TOP_K", "4"))
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+
+
+def parse_sections(lines: List[str]) -> List[Dict]:
+    """Split a Markdown document into sections at its headings.
+
+    Each section runs from its heading to the line before the next heading of any level,
+    and is {"start", "end", "level", "title", "trail"} with 1-based, inclusive line numbers
+    and trail the titles of the headings above it. Lines before the first heading form a
+    section of level 0 without a title. Headings inside fenced code blocks don't count.
+    """
+    sections = []
+    trail: List[Tuple[int, str]] = []
+    in_fence = False
+    for number, line in enumerate(lines, 1):
+        if _FENCE.match(line):
+            in_fence = not in_fence
+        match = None if in_fence else _HEADING.match(line.strip())
+        if match:
+            level, title = len(match.group(1)), match.group(2)
+            trail = [entry for entry in trail if entry[0] < level] + [(level, title)]
+            sections.append({"start": number, "end": number, "level": level, "title": title,
+                             "trail": " > ".join(entry[1] for entry in trail)})
+        elif not sections:
+            sections.append({"start": number, "end": number, "level": 0, "title": "", "trail": ""})
+        else:
+            sections[-1]["end"] = number
+    return sections
+
+
+def _tokens(lines: List[str], start: int, end: int) -> int:
+    return sum(estimate_tokens(line) + 1 for line in lines[start - 1:end])
+
+
+def _clip(lines: List[str], start: int, end: int, around: int, budget: int) -> Tuple[int, int]:
+    """The largest window of lines start..end around line around that fits in budget tokens."""
+    low = high = min(max(around, start), end)
+    used = _tokens(lines, low, high)
+    while True:
+        grew = False
+        for candidate in (high + 1, low - 1):
+            if start <= candidate <= end:
+                cost = _tokens(lines, candidate, candidate)
+                if used + cost <= budget:
+                    used += cost
+                    low, high = min(low, candidate), max(high, candidate)
+                    grew = True
+        if not grew:
+            return low, high
+
+
+def select_ranges(lines: List[str], sections: List[Dict], message: str, cursor_line: Optional[int] = None,
+                  token_budget: int = CHAT_CONTEXT_TOKEN_BUDGET,
+                  top_k: int = CHAT_CONTEXT_TOP_K) -> List[Tuple[int, int]]:
+    """The line ranges of the sections an AI chat message is most likely about, in document order.
+
+    The section holding the cursor comes first, then up to top_k sections ranked by BM25
+    against the message (headings count twice), while they fit in token_budget. A
+    section too long for what is left of the budget is skipped, except that the cursor's
+    section and the best match are cut down to a window around the cursor, or from their
+    start. If the message matches nothing and there is no cursor, the document is
+    sent from the top. Adjacent ranges are merged.
+    """
+    scores = BM25([f"{section['trail']} {section['trail']} " + " ".join(lines[section['start'] - 1:section['end']])
+                   for section in sections]).scores(message)
+    ranked = sorted((i for i in range(len(sections)) if scores[i] > 0), key=lambda i: (-scores[i], i))[:top_k]
+
+    cursor = None
+    if cursor_line is not None:
+        cursor = next((i for i, section in enumerate(sections)
+                       if section["start"] <= cursor_line <= section["end"]), None)
+    order = ([cursor] if cursor is not None else []) + [i for i in ranked if i != cursor]
+    if not order:
+        order = list(range(len(sections)))
+
+    best = ranked[0] if ranked else None
+    ranges, used = [], 0
+    for i in order:
+        section = sections[i]
+        cost = _tokens(lines, section["start"], section["end"])
+        if used + cost <= token_budget:
+            ranges.append((section["start"], section["end"]))
+            used += cost
+        elif (not ranges or i in (cursor, best)) and used < token_budget:
+            around = cursor_line if i == cursor else section["start"]
+            start, end = _clip(lines, section["start"], section["end"], around, token_budget - used)
+            ranges.append((start, end))
+            used += _tokens(lines, start, end)
+
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def _numbered(lines: List[str], start: int, end: int) -> str:
+    return "\n".join(f"{number:04d}: {lines[number - 1]}" for number in range(start, end + 1))
+
+
+def build_chat_context(document: str, message: str, cursor_line: Optional[int] = None,
+                       token_budget: int = CHAT_CONTEXT_TOKEN_BUDGET, top_k: int = CHAT_CONTEXT_TOP_K) -> Dict:
+    """The part of a document to show the AI chat model, with the document's own line numbers.
+
+    Returns {"text", "ranges", "windowed"}. A document within token_budget is shown whole.
+    A longer one is shown as an outline of all its headings with their line ranges,
+    followed by the selected sections; ranges lists the line ranges shown in full.
+    """
+    lines = document.split('\n')
+    if _tokens(lines, 1, len(lines)) <= token_budget:
+        return {"text": _numbered(lines, 1, len(lines)), "ranges": [(1, len(lines))], "windowed": False}
+
+    sections = parse_sections(lines)
+    ranges = select_ranges(lines, sections, message, cursor_line, token_budget, top_k)
+
+    outline = []
+    for section in sections:
+        if not section["level"]:
+            continue
+        shown = any(start <= section["end"] and section["start"] <= end for start, end in ranges)
+        outline.append(f"{'*' if shown else ' '} {section['start']:04d}-{section['end']:04d} "
+                       f"{'#' * section['level']} {section['title']}")
+
+    excerpts = [_numbered(lines, start, end) for start, end in ranges]
+    text = ("Outline (line ranges of every section; * marks sections shown below, in full or in part):\n"
+            + "\n".join(outline) + "\n\nSections shown:\n" + "\n....\n".join(excerpts))
+    return {"text": text, "ranges": ranges, "windowed": True}
+
+
+def covers(context: Dict, start_line: int, end_line: int) -> bool:
+    """Whether lines start_line to end_line were all shown in full, so the model can edit them."""
+    return any(start <= start_line and end_line <= end for start, end in context["ranges"])
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the part of a scope document the AI chat would send")
+    parser.add_argument("document", help="Markdown file")
+    parser.add_argument("message")
+    parser.add_argument("--cursor-line", type=int)
+    parser.add_argument("--budget", type=int, default=CHAT_CONTEXT_TOKEN_BUDGET)
+    args = parser.parse_args()
+
+    with open(args.document, 'r') as f:
+        document = f.read()
+    context = build_chat_context(document, args.message, args.cursor_line, args.budget)
+    print(context["text"])
+    print(f"\n{estimate_tokens(context['text'])} of {estimate_tokens(document)} tokens, lines {context['ranges']}")
@@ -0,0 +1,214 @@
+import math
+import os
+import re
+import threading
+from collections import Counter
+from typing import Dict, List, Tuple
+
+CONTEXT_PATH = os.getenv("CONTEXT_PATH", "context.txt")
+# Most context, in estimated tokens, pasted into one prompt
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1000"))
+# Most chunks of context pasted into one prompt
+CONTEXT_TOP_K = int(os.getenv("CONTEXT_TOP_K", "4"))
+# Size, in estimated tokens, that the context file is split into
+CONTEXT_CHUNK_TOKENS = int(os.getenv("CONTEXT_CHUNK_TOKENS", "250"))
+
+_WORD = re.compile(r"[a-z0-9]+")
+_HEADING = re.compile(r"^(#{1,6})\s+(.*)$")
+_STOPWORDS = frozenset("""a an and are as at be been but by can for from has have if in into is it its of on or
+that the their then there these this those to was were will with would should which who what when where how
+all any each more most other some such no not only own same so than too very""".split())
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of English text, about four characters per token."""
+    return (len(text) + 3) // 4
+
+
+def _terms(text: str) -> List[str]:
+    return [term for term in _WORD.findall(text.lower()) if term not in _STOPWORDS]
+
+
+def chunk_text(text: str, max_tokens: int = CONTEXT_CHUNK_TOKENS) -> List[Dict]:
+    """Split guidance text into chunks of whole paragraphs, each tagged with its heading trail.
+
+    Returns [{"heading", "text"}] in document order. A chunk never spans two sections, and a
+    paragraph longer than max_tokens is split between lines.
+    """
+    chunks = []
+    trail = []
+    parts = []
+    size = 0
+
+    def flush():
+        nonlocal parts, size
+        if parts:
+            chunks.append({"heading": " > ".join(title for _, title in trail), "text": "\n\n".join(parts)})
+        parts, size = [], 0
+
+    for block in re.split(r"\n\s*\n", text):
+        lines = [line.rstrip() for line in block.strip('\n').split('\n') if line.strip()]
+        while lines and _HEADING.match(lines[0].strip()):
+            flush()
+            level, title = _HEADING.match(lines.pop(0).strip()).groups()
+            trail = [entry for entry in trail if entry[0] < len(level)] + [(len(level), title.strip())]
+        if not lines:
+            continue
+
+        # Split oversized paragraphs between lines
+        pieces, piece = [], []
+        for line in lines:
+            if piece and estimate_tokens("\n".join(piece + [line])) > max_tokens:
+                pieces.append("\n".join(piece))
+                piece = []
+            piece.append(line)
+        pieces.append("\n".join(piece))
+
+        for piece in pieces:
+            tokens = estimate_tokens(piece)
+            if parts and size + tokens > max_tokens:
+                flush()
+            parts.append(piece)
+            size += tokens
+    flush()
+    return chunks
+
+
+class BM25:
+    """Okapi BM25 ranking of a fixed list of texts against a query."""
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, texts: List[str]):
+        self._frequencies = [Counter(_terms(text)) for text in texts]
+        self._lengths = [sum(frequencies.values()) for frequencies in self._frequencies]
+        self._average_length = sum(self._lengths) / len(texts) if texts else 0.0
+        documents = Counter(term for frequencies in self._frequencies for term in frequencies)
+        self._idf = {term: math.log(1 + (len(texts) - count + 0.5) / (count + 0.5))
+                     for term, count in documents.items()}
+
+    def scores(self, query: str) -> List[float]:
+        """BM25 score of every text for query."""
+        terms = set(_terms(query))
+        scores = []
+        for frequencies, length in zip(self._frequencies, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self._average_length or 1))
+            for term in terms:
+                tf = frequencies.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            scores.append(score)
+        return scores
+
+
+class ContextIndex:
+    """BM25 index over the chunks of the context file, for picking the guidance a prompt needs.
+
+    The file is chunked and indexed on first use and again whenever its mtime or size
+    changes, so edits are picked up without a restart. Everything is local; nothing is sent
+    anywhere to rank the chunks.
+    """
+
+    def __init__(self, path: str = CONTEXT_PATH, chunk_tokens: int = CONTEXT_CHUNK_TOKENS):
+        self.path = path
+        self.chunk_tokens = chunk_tokens
+        self._lock = threading.Lock()
+        self._signature = None
+        self.chunks: List[Dict] = []
+        self._bm25 = BM25([])
+        self.loads = 0
+
+    def _current(self) -> Tuple[List[Dict], BM25]:
+        """The chunks and their BM25 index, read together, reloaded if the context file changed."""
+        try:
+            stat = os.stat(self.path)
+            signature = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = None
+
+        with self._lock:
+            if signature == self._signature and self.loads:
+                return self.chunks, self._bm25
+            text = ""
+            if signature is None:
+                print(f"Warning: {self.path} not found")
+            else:
+                try:
+                    with open(self.path, 'r') as f:
+                        text = f.read()
+                except OSError as e:
+                    print(f"Error reading {self.path}: {str(e)}")
+            chunks = chunk_text(text, self.chunk_tokens)
+            # Swapped together, so a reader never pairs chunks with another version's index
+            self.chunks, self._bm25 = chunks, BM25([chunk["heading"] + " " + chunk["text"] for chunk in chunks])
+            self._signature = signature
+            self.loads += 1
+            return self.chunks, self._bm25
+
+    def scores(self, query: str) -> List[float]:
+        """BM25 score of every chunk for query."""
+        return self._current()[1].scores(query)
+
+    def select(self, query: str, token_budget: int = CONTEXT_TOKEN_BUDGET, top_k: int = CONTEXT_TOP_K) -> List[Dict]:
+        """The chunks to give a prompt about query, in document order.
+
+        Text before the first heading is general guidance and is always included. After it
+        come the top_k chunks most relevant to query that still fit in token_budget, or the
+        first ones if nothing in the context matches the query.
+        """
+        chunks, bm25 = self._current()
+        scores = bm25.scores(query)
+        general = [i for i, chunk in enumerate(chunks) if not chunk["heading"]]
+        ranked = sorted((i for i in range(len(scores)) if chunks[i]["heading"]), key=lambda i: (-scores[i], i))
+        if not any(scores[i] for i in ranked):
+            ranked.sort()
+
+        chosen, used, picked = [], 0, 0
+        for i in general + ranked:
+            if i not in general and picked >= top_k:
+                break
+            tokens = estimate_tokens(chunks[i]["text"])
+            if used + tokens > token_budget:
+                continue
+            chosen.append(i)
+            used += tokens
+            picked += i not in general
+        return [chunks[i] for i in sorted(chosen)]
+
+    def render(self, query: str, token_budget: int = CONTEXT_TOKEN_BUDGET, top_k: int = CONTEXT_TOP_K) -> str:
+        """The selected chunks as prompt text, each headed by where it comes from."""
+        parts = []
+        for chunk in self.select(query, token_budget, top_k):
+            parts.append(f"[{chunk['heading']}]\n{chunk['text']}" if chunk["heading"] else chunk["text"])
+        return "\n\n---\n\n".join(parts)
+
+    def stats(self) -> Dict:
+        chunks, _ = self._current()
+        return {
+            "chunks": len(chunks),
+            "tokens": sum(estimate_tokens(chunk["text"]) for chunk in chunks),
+            "loads": self.loads
+        }
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Show the context chunks selected for a query")
+    parser.add_argument("query")
+    parser.add_argument("--context", default=CONTEXT_PATH)
+    parser.add_argument("--budget", type=int, default=CONTEXT_TOKEN_BUDGET)
+    parser.add_argument("--top-k", type=int, default=CONTEXT_TOP_K)
+    args = parser.parse_args()
+
+    index = ContextIndex(args.context)
+    chunks, bm25 = index._current()
+    scores = bm25.scores(args.query)
+    selected = index.select(args.query, args.budget, args.top_k)
+    print(f"{index.stats()['chunks']} chunks, {index.stats()['tokens']} tokens in {args.context}")
+    for chunk, score in zip(chunks, scores):
+        mark = "*" if chunk in selected else " "
+        print(f"{mark} {score:6.2f} {estimate_tokens(chunk['text']):>5}  {chunk['heading'] or '(top)'}")
+    print(f"\nselected {len(selected)} chunks, {sum(estimate_tokens(c['text']) for c in selected)} tokens")
@@ -0,0 +1,206 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, Optional
+
+JOB_QUEUE_PATH = os.getenv("JOB_QUEUE_PATH", "jobs.sqlite3")
+# Attempts a job gets before it is marked failed
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+# Seconds a worker may run a job before another worker assumes it died and takes the job over
+JOB_LEASE = float(os.getenv("JOB_LEASE", "900"))
+# Seconds before the first retry of a failed job; doubles with every attempt
+JOB_RETRY_DELAY = float(os.getenv("JOB_RETRY_DELAY", "30"))
+# Seconds finished jobs are kept before they are purged
+JOB_RETENTION = float(os.getenv("JOB_RETENTION", str(7 * 24 * 60 * 60)))
+
+STATUSES = ("queued", "running", "done", "failed")
+
+
+class JobQueue:
+    """Persistent queue of background jobs in a SQLite database.
+
+    Jobs move from queued to running when a worker claims them, then to done, or back to
+    queued with a delay if they fail and have attempts left, and finally to failed. A
+    claimed job is leased to its worker for lease seconds; if the worker dies, the job is
+    claimed again once the lease runs out, so jobs survive restarts of the app and the
+    workers. A worker records the outcome of a job only while its claim still holds the
+    lease, so a slow worker can't overwrite the result of the one that took over.
+    Enqueueing with a dedupe key that is already queued, running or done returns the
+    existing job instead of adding another.
+
+    Like SQLiteScopeStore, the database runs in WAL mode and state changes take the write
+    lock with BEGIN IMMEDIATE, so any number of web and worker processes can share it.
+    """
+
+    def __init__(self, db_path: str = JOB_QUEUE_PATH, lease: float = JOB_LEASE):
+        self.db_path = Path(db_path)
+        self.lease = lease
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    id TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    dedupe_key TEXT,
+                    status TEXT NOT NULL,
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    max_attempts INTEGER NOT NULL,
+                    run_after REAL NOT NULL,
+                    lease_expires REAL,
+                    worker TEXT,
+                    result TEXT,
+                    error TEXT,
+                    created REAL NOT NULL,
+                    updated REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_ready ON jobs (status, run_after)")
+            conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_jobs_dedupe ON jobs (dedupe_key) "
+                         "WHERE dedupe_key IS NOT NULL AND status != 'failed'")
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly by _transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a block in a write transaction, holding the database write lock from the start."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    @staticmethod
+    def _job_from_row(row: sqlite3.Row) -> Dict:
+        return {
+            "id": row["id"],
+            "kind": row["kind"],
+            "payload": json.loads(row["payload"]),
+            "status": row["status"],
+            "attempts": row["attempts"],
+            "max_attempts": row["max_attempts"],
+            "run_after": row["run_after"],
+            "worker": row["worker"],
+            "result": json.loads(row["result"]) if row["result"] is not None else None,
+            "error": row["error"],
+            "created": row["created"],
+            "updated": row["updated"]
+        }
+
+    def enqueue(self, kind: str, payload: Dict, dedupe_key: Optional[str] = None,
+                max_attempts: int = JOB_MAX_ATTEMPTS) -> str:
+        """Add a job and return its ID, or the ID of the live job already added with dedupe_key."""
+        now = time.time()
+        with self._transaction() as conn:
+            if dedupe_key:
+                row = conn.execute("SELECT id FROM jobs WHERE dedupe_key = ? AND status != 'failed'",
+                                   (dedupe_key,)).fetchone()
+                if row:
+                    return row["id"]
+            job_id = uuid.uuid4().hex
+            conn.execute(
+                "INSERT INTO jobs (id, kind, payload, dedupe_key, status, max_attempts, run_after, created, updated) "
+                "VALUES (?, ?, ?, ?, 'queued', ?, ?, ?, ?)",
+                (job_id, kind, json.dumps(payload), dedupe_key, max_attempts, now, now, now)
+            )
+        return job_id
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """Take the oldest job that is ready to run, or whose worker's lease ran out."""
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute(
+                "SELECT * FROM jobs WHERE (status = 'queued' AND run_after <= ?) "
+                "OR (status = 'running' AND lease_expires < ?) ORDER BY run_after LIMIT 1",
+                (now, now)
+            ).fetchone()
+            if row is None:
+                return None
+            if row["status"] == "running":
+                print(f"Job {row['id']} was abandoned by worker {row['worker']}; taking it over")
+                if row["attempts"] >= row["max_attempts"]:
+                    conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                                 ("Worker stopped while running the job", now, row["id"]))
+                    return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', attempts = attempts + 1, worker = ?, lease_expires = ?, "
+                "updated = ? WHERE id = ?",
+                (worker, now + self.lease, now, row["id"])
+            )
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone()
+        return self._job_from_row(row)
+
+    def complete(self, job_id: str, result: Dict, worker: str, attempt: int) -> bool:
+        """Mark a running job done with its result.
+
+        worker and attempt are those of the claim. Returns False, without changing the job,
+        if the lease ran out and another worker has taken the job over since.
+        """
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = 'done', result = ?, error = NULL, lease_expires = NULL, updated = ? "
+                "WHERE id = ? AND status = 'running' AND worker = ? AND attempts = ?",
+                (json.dumps(result), time.time(), job_id, worker, attempt))
+        return cursor.rowcount > 0
+
+    def fail(self, job_id: str, error: str, worker: str, attempt: int, retry_delay: float = JOB_RETRY_DELAY,
+             retryable: bool = True) -> Optional[bool]:
+        """Record a failed attempt; requeue the job after a backoff if it has attempts left.
+
+        A job whose error is not retryable fails at once. Returns whether the job will be
+        retried, or None, without changing the job, if the claim of worker and attempt no
+        longer holds the lease.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            row = conn.execute("SELECT attempts, max_attempts FROM jobs "
+                               "WHERE id = ? AND status = 'running' AND worker = ? AND attempts = ?",
+                               (job_id, worker, attempt)).fetchone()
+            if row is None:
+                return None
+            retry = retryable and row["attempts"] < row["max_attempts"]
+            if retry:
+                delay = retry_delay * 2 ** (row["attempts"] - 1)
+                conn.execute("UPDATE jobs SET status = 'queued', run_after = ?, error = ?, lease_expires = NULL, "
+                             "updated = ? WHERE id = ?", (now + delay, error, now, job_id))
+            else:
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, lease_expires = NULL, updated = ? "
+                             "WHERE id = ?", (error, now, job_id))
+        return retry
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        row = self._connect().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._job_from_row(row) if row else None
+
+    def purge(self, older_than: float = JOB_RETENTION) -> int:
+        """Delete done and failed jobs last updated more than older_than seconds ago."""
+        with self._transaction() as conn:
+            cursor = conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                                  (time.time() - older_than,))
+        return cursor.rowcount
+
+    def stats(self) -> Dict:
+        counts = dict.fromkeys(STATUSES, 0)
+        for row in self._connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status"):
+            counts[row[0]] = row[1]
+        return counts
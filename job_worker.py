@@ -0,0 +1,124 @@
+import argparse
+import os
+import signal
+import socket
+import threading
+import time
+from typing import Dict
+
+from job_queue import JOB_QUEUE_PATH, JOB_RETRY_DELAY, JobQueue
+from request_timing import log_timing, sampled_profile, track_phases
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Seconds an idle worker waits before looking for new jobs again
+JOB_POLL_INTERVAL = float(os.getenv("JOB_POLL_INTERVAL", "1"))
+
+
+class JobError(Exception):
+    """A job attempt failed; retry_after, if set, is the least time to wait before the next.
+
+    A job whose error is not retryable, such as a request the API rejected, fails without
+    using its remaining attempts.
+    """
+
+    def __init__(self, message: str, retry_after: float = 0.0, retryable: bool = True):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.retryable = retryable
+
+
+def run_generate_scope(creator, payload: Dict) -> Dict:
+    result = creator.generate_scope(payload["project_name"], payload.get("project_info", {}), payload.get("model"),
+                                    mode=payload.get("mode"))
+    if "error" in result:
+        raise JobError(result["error"], result.get("retry_after") or 0.0, result.get("retryable", True))
+    return {"scope_id": result["id"]}
+
+
+# Job kind -> function(creator, payload) returning the job's result
+HANDLERS = {
+    "generate_scope": run_generate_scope
+}
+
+
+def work(queue: JobQueue, creator, name: str, stop: threading.Event):
+    """Claim and run jobs until stop is set, finishing the current job first."""
+    while not stop.is_set():
+        try:
+            job = queue.claim(name)
+        except Exception as e:
+            print(f"Error claiming a job in {name}: {str(e)}")
+            job = None
+        if job is None:
+            stop.wait(JOB_POLL_INTERVAL)
+            continue
+
+        started = time.perf_counter()
+        status = "done"
+        with track_phases() as timer:
+            try:
+                handler = HANDLERS.get(job["kind"])
+                if handler is None:
+                    raise JobError(f"Unknown job kind: {job['kind']}", retryable=False)
+                with sampled_profile(f"job_{job['kind']}"):
+                    result = handler(creator, job["payload"])
+            except Exception as e:
+                status = "failed"
+                retry_delay = max(JOB_RETRY_DELAY, getattr(e, "retry_after", 0.0))
+                retrying = queue.fail(job["id"], str(e), name, job["attempts"], retry_delay,
+                                      getattr(e, "retryable", True))
+                if retrying is None:
+                    status = "lease_lost"
+                    print(f"Job {job['id']} attempt {job['attempts']} failed after its lease ran out; "
+                          f"another worker has taken it over: {str(e)}")
+                else:
+                    print(f"Job {job['id']} attempt {job['attempts']} failed"
+                          f"{', will retry' if retrying else ''}: {str(e)}")
+            else:
+                if queue.complete(job["id"], result, name, job["attempts"]):
+                    print(f"Job {job['id']} done in {time.perf_counter() - started:.1f}s")
+                else:
+                    status = "lease_lost"
+                    print(f"Job {job['id']} attempt {job['attempts']} finished after its lease ran out; "
+                          f"dropping its result, as another worker has taken the job over")
+        log_timing({
+            "event": "job",
+            "job_id": job["id"],
+            "kind": job["kind"],
+            "attempt": job["attempts"],
+            "status": status,
+            "total_ms": round(timer.elapsed() * 1000, 1),
+            "phases": timer.milliseconds()
+        })
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run background jobs, such as scope generation queued by /generate.")
+    parser.add_argument("--workers", type=int, default=JOB_WORKERS, help="jobs run at the same time")
+    parser.add_argument("--db", default=JOB_QUEUE_PATH)
+    args = parser.parse_args()
+
+    from scope_creator import ScopeCreator
+    creator = ScopeCreator()
+    queue = JobQueue(args.db)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    prefix = f"{socket.gethostname()}:{os.getpid()}"
+    threads = [threading.Thread(target=work, args=(queue, creator, f"{prefix}:{i}", stop), daemon=True)
+               for i in range(args.workers)]
+    for thread in threads:
+        thread.start()
+    print(f"{args.workers} workers running jobs from {args.db}")
+
+    # Purge old finished jobs now and then while the workers run
+    while not stop.wait(3600):
+        purged = queue.purge()
+        if purged:
+            print(f"Purged {purged} finished jobs")
+
+    print("Stopping; waiting for running jobs to finish")
+    for thread in threads:
+        thread.join()
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from fileio import atomic_write
+
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() not in ("0", "false", "no")
+LLM_CACHE_DIR = os.getenv("LLM_CACHE_DIR", "llm_cache")
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", str(24 * 60 * 60)))
+LLM_CACHE_MEMORY_BYTES = int(os.getenv("LLM_CACHE_MEMORY_BYTES", str(16 * 1024 * 1024)))
+LLM_CACHE_DISK_BYTES = int(os.getenv("LLM_CACHE_DISK_BYTES", str(256 * 1024 * 1024)))
+
+
+def request_key(model: str, messages: List[Dict], **params) -> str:
+    """Hash everything that determines a completion: model, messages and sampling parameters."""
+    payload = json.dumps({"model": model, "messages": messages, "params": params},
+                         sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed cache of LLM completions, in memory with a disk tier.
+
+    Entries are keyed by request_key and expire ttl seconds after the response was
+    received. The memory tier is an LRU capped at memory_bytes of response text. The disk
+    tier keeps one file per entry under cache_dir/<first two hex digits>/, shared by every
+    process; a hit touches the file's mtime, and when the tier grows past disk_bytes the
+    least recently used files are deleted.
+    """
+
+    def __init__(self, cache_dir: str = LLM_CACHE_DIR, ttl: float = LLM_CACHE_TTL,
+                 memory_bytes: int = LLM_CACHE_MEMORY_BYTES, disk_bytes: int = LLM_CACHE_DISK_BYTES):
+        self.cache_dir = Path(cache_dir)
+        self.ttl = ttl
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_usage = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.json"
+
+    def _remember(self, key: str, created: float, content: str):
+        size = len(content.encode('utf-8'))
+        if size > self.memory_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= self._entries.pop(key)[2]
+        self._entries[key] = (created, content, size)
+        self._bytes += size
+        while self._bytes > self.memory_bytes:
+            _, (_, _, dropped) = self._entries.popitem(last=False)
+            self._bytes -= dropped
+            self.evictions += 1
+
+    def _read_disk(self, key: str):
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if time.time() - entry.get("created", 0) > self.ttl:
+            path.unlink(missing_ok=True)
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None if it is missing or expired."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if time.time() - entry[0] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                self._bytes -= self._entries.pop(key)[2]
+
+        entry = self._read_disk(key)
+        with self._lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.disk_hits += 1
+            self._remember(key, entry["created"], entry["content"])
+        return entry["content"]
+
+    def put(self, key: str, content: str, model: Optional[str] = None):
+        """Cache a response in memory and on disk."""
+        created = time.time()
+        with self._lock:
+            self._remember(key, created, content)
+
+        data = json.dumps({"created": created, "model": model, "content": content})
+        try:
+            atomic_write(self._path(key), data)
+        except OSError as e:
+            print(f"Error writing LLM cache entry {key}: {str(e)}")
+            return
+        self._account_disk(len(data))
+
+    def invalidate(self, key: str):
+        """Drop one entry from memory and disk."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+        self._path(key).unlink(missing_ok=True)
+
+    def _account_disk(self, added: int):
+        with self._lock:
+            if self._disk_usage is None:
+                self._disk_usage = sum(size for _, size, _ in self._disk_files())
+            else:
+                self._disk_usage += added
+            if self._disk_usage <= self.disk_bytes:
+                return
+            # Delete least recently used files down to 90% of the budget, so pruning is infrequent
+            files = sorted(self._disk_files(), key=lambda f: f[2])
+            usage = sum(size for _, size, _ in files)
+            for path, size, _ in files:
+                if usage <= self.disk_bytes * 0.9:
+                    break
+                path.unlink(missing_ok=True)
+                usage -= size
+                self.evictions += 1
+            self._disk_usage = usage
+
+    def _disk_files(self):
+        """Yield (path, size, mtime) for every entry in the disk tier."""
+        if not self.cache_dir.exists():
+            return
+        for shard in self.cache_dir.iterdir():
+            if not shard.is_dir():
+                continue
+            for path in shard.glob("*.json"):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                yield path, stat.st_size, stat.st_mtime
+
+    def clear(self):
+        """Drop every entry from memory and disk."""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            for path, _, _ in list(self._disk_files()):
+                path.unlink(missing_ok=True)
+            self._disk_usage = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.memory_bytes,
+                "disk_bytes": self._disk_usage,
+                "max_disk_bytes": self.disk_bytes,
+                "ttl": self.ttl
+            }
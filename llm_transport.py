@@ -0,0 +1,354 @@
+import asyncio
+import concurrent.futures
+import contextvars
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
+
+import httpx
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, DefaultHttpxClient, OpenAI
+
+from metrics import LLM_ATTEMPT_ERRORS, LLM_REQUEST_SECONDS, LLM_RETRIES, LLM_TOKENS, error_reason
+from rate_limit import default_rate_limiter
+from request_timing import phase
+from retry_policy import CircuitBreaker, RetryLaterError, RetryPolicy, is_retryable
+
+# Point at another OpenAI-compatible endpoint, such as a local mock server, for testing
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "20"))
+# Most connections the async client opens at once, and so most async calls in flight together
+LLM_ASYNC_CONNECTIONS = int(os.getenv("LLM_ASYNC_CONNECTIONS", "500"))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "90"))
+LLM_CONNECT_TIMEOUT = float(os.getenv("LLM_CONNECT_TIMEOUT", "10"))
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "180"))
+
+# Token usage of the calls made in the current context; see track_usage
+_usage = contextvars.ContextVar("llm_usage", default=None)
+
+
+@contextmanager
+def track_usage():
+    """Count the tokens of every completion made inside the block, including by tasks it starts.
+
+    Yields a Counter of prompt_tokens, completion_tokens, total_tokens and calls. Calls
+    answered from a cache or shared with another caller's request are not counted.
+    """
+    usage = Counter()
+    token = _usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _usage.reset(token)
+
+
+class LLMTransport:
+    """The one way this app talks to the model API.
+
+    Holds a single OpenAI client over a keep-alive connection pool, so calls reuse open
+    TLS connections instead of handshaking each time. Async calls run on one AsyncOpenAI
+    client owned by an event loop on a background thread of the transport's own. Flask
+    runs every async view on a new event loop, and async connections can't outlive their
+    loop, so a client per caller's loop would connect afresh on every request. The
+    clients' built-in retries are turned off; every call goes through the retry loop here
+    instead, which follows one RetryPolicy and shares one CircuitBreaker.
+
+    Every call is recorded in the metrics module by model and operation, a label naming
+    what the call is for, such as "analyze" or "chat".
+    """
+
+    def __init__(self, api_key: str, base_url: str = OPENROUTER_BASE_URL, default_headers: Optional[Dict] = None,
+                 pool_size: int = LLM_POOL_SIZE, connect_timeout: float = LLM_CONNECT_TIMEOUT,
+                 read_timeout: float = LLM_READ_TIMEOUT, retry_policy: Optional[RetryPolicy] = None,
+                 breaker: Optional[CircuitBreaker] = None, rate_limiter=None,
+                 async_connections: int = LLM_ASYNC_CONNECTIONS):
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.breaker = breaker or CircuitBreaker()
+        # Called before every attempt; see rate_limit.SharedRateLimiter for the interface
+        self.rate_limiter = rate_limiter if rate_limiter is not None else default_rate_limiter(api_key)
+        self.usage = Counter()
+        self._usage_lock = threading.Lock()
+        self._limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size,
+                                    keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._options = {
+            "base_url": base_url,
+            "api_key": api_key,
+            "default_headers": default_headers or {},
+            "timeout": self._timeout,
+            "max_retries": 0
+        }
+        self.client = OpenAI(http_client=DefaultHttpxClient(limits=self._limits, timeout=self._timeout),
+                             **self._options)
+        self._async_limits = httpx.Limits(max_connections=max(pool_size, async_connections),
+                                          max_keepalive_connections=pool_size,
+                                          keepalive_expiry=LLM_KEEPALIVE_EXPIRY)
+        # Started on the first async call; see _async_loop
+        self._loop = None
+        self._async_client = None
+        self._loop_lock = threading.Lock()
+
+    def _async_loop(self) -> asyncio.AbstractEventLoop:
+        """The transport's event loop, running on a background thread, started on first use."""
+        with self._loop_lock:
+            if self._loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="llm-async", daemon=True).start()
+                self._async_client = AsyncOpenAI(
+                    http_client=DefaultAsyncHttpxClient(limits=self._async_limits, timeout=self._timeout),
+                    **self._options
+                )
+                self._loop = loop
+            return self._loop
+
+    def _submit(self, coroutine) -> concurrent.futures.Future:
+        """Run a coroutine on the transport's loop, in a copy of the caller's context.
+
+        The copy carries the caller's usage and phase tracking over to the task. Cancelling
+        the returned future cancels the task.
+        """
+        loop = self._async_loop()
+        context = contextvars.copy_context()
+        future = concurrent.futures.Future()
+
+        def finished(task: asyncio.Task):
+            try:
+                if task.cancelled():
+                    future.cancel()
+                elif task.exception() is not None:
+                    future.set_exception(task.exception())
+                else:
+                    future.set_result(task.result())
+            except concurrent.futures.InvalidStateError:
+                pass  # The caller cancelled in the meantime
+
+        def start():
+            if future.cancelled():
+                coroutine.close()
+                return
+            # A task runs in a copy of the context it is created in
+            task = context.run(loop.create_task, coroutine)
+            task.add_done_callback(finished)
+            future.add_done_callback(lambda f: f.cancelled() and loop.call_soon_threadsafe(task.cancel))
+
+        loop.call_soon_threadsafe(start)
+        return future
+
+    @staticmethod
+    def _content(completion) -> str:
+        if not completion or not completion.choices:
+            raise ValueError("Empty response from API")
+        return completion.choices[0].message.content
+
+    @staticmethod
+    def _estimate_tokens(messages: List[Dict]) -> int:
+        """Rough prompt size, about four characters per token, for the rate limiter."""
+        return sum(len(str(message.get("content", ""))) for message in messages) // 4
+
+    def _record_usage(self, completion, model: str, operation: str, estimated: int):
+        usage = getattr(completion, "usage", None)
+        counts = {
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "total_tokens": getattr(usage, "total_tokens", 0) or 0,
+            "calls": 1
+        }
+        with self._usage_lock:
+            self.usage.update(counts)
+            tracked = _usage.get()
+            if tracked is not None:
+                tracked.update(counts)
+        LLM_TOKENS.inc(counts["prompt_tokens"], model=model, operation=operation, type="prompt")
+        LLM_TOKENS.inc(counts["completion_tokens"], model=model, operation=operation, type="completion")
+        if self.rate_limiter is not None and counts["total_tokens"]:
+            self.rate_limiter.record_usage(model, counts["total_tokens"] - estimated)
+
+    def _attempt_timeout(self, deadline: float):
+        """Timeout of one attempt: the configured timeouts, but never past the request deadline."""
+        remaining = self.retry_policy.remaining(deadline)
+        return httpx.Timeout(min(self._timeout.read, remaining),
+                             connect=min(self._timeout.connect, remaining))
+
+    @contextmanager
+    def _observe(self, model: str, operation: str):
+        """Record the duration and outcome of a call, from its first attempt to its last."""
+        started = time.perf_counter()
+        outcome = "error"
+        try:
+            with phase("llm"):
+                yield
+            outcome = "ok"
+        except RetryLaterError:
+            outcome = "unavailable"
+            raise
+        except (GeneratorExit, asyncio.CancelledError):
+            outcome = "cancelled"
+            raise
+        finally:
+            LLM_REQUEST_SECONDS.observe(time.perf_counter() - started, model=model, operation=operation,
+                                        outcome=outcome)
+
+    def _after_failure(self, error: Exception, attempt: int, max_attempts: int, deadline: float,
+                       model: str, operation: str) -> Optional[float]:
+        """Record a failed attempt and return how long to wait before the next, or None to give up."""
+        LLM_ATTEMPT_ERRORS.inc(model=model, operation=operation, reason=error_reason(error))
+        if is_retryable(error):
+            self.breaker.record_failure()
+        else:
+            # The API answered, it just rejected this request
+            self.breaker.record_success()
+        delay = self.retry_policy.next_delay(error, attempt, max_attempts, deadline)
+        if delay is None:
+            print(f"Error on attempt {attempt + 1}, giving up: {str(error)}")
+        else:
+            print(f"Error on attempt {attempt + 1}, retrying in {delay:.1f}s: {str(error)}")
+            LLM_RETRIES.inc(model=model, operation=operation)
+        return delay
+
+    def complete(self, messages: List[Dict], model: str, max_retries: Optional[int] = None,
+                 operation: str = "other", **params) -> str:
+        """Get a chat completion, retrying failures as the retry policy allows."""
+        with self._observe(model, operation):
+            return self._complete(messages, model, max_retries, operation, **params)
+
+    def _complete(self, messages: List[Dict], model: str, max_retries: Optional[int], operation: str,
+                  **params) -> str:
+        max_attempts = max_retries or self.retry_policy.max_attempts
+        deadline = self.retry_policy.start()
+        estimated = self._estimate_tokens(messages)
+        for attempt in range(max_attempts):
+            with self.breaker.attempt():
+                if self.rate_limiter is not None:
+                    with phase("rate_limit"):
+                        self.rate_limiter.acquire(model, estimated)
+                try:
+                    completion = self.client.chat.completions.create(
+                        model=model, messages=messages, timeout=self._attempt_timeout(deadline), **params)
+                    self._record_usage(completion, model, operation, estimated)
+                    content = self._content(completion)
+                except Exception as e:
+                    delay = self._after_failure(e, attempt, max_attempts, deadline, model, operation)
+                    if delay is None:
+                        raise
+                else:
+                    self.breaker.record_success()
+                    return content
+            with phase("retry_wait"):
+                time.sleep(delay)
+
+        raise Exception("Max retries exceeded")
+
+    async def complete_async(self, messages: List[Dict], model: str, max_retries: Optional[int] = None,
+                             operation: str = "other", **params) -> str:
+        """Async version of complete; waits between retries without blocking any thread.
+
+        Runs on the transport's own event loop, whichever loop the caller is on, so calls
+        from every request share one pool of connections.
+        """
+        return await asyncio.wrap_future(self._submit(self._complete_async(messages, model, max_retries, operation,
+                                                                           **params)))
+
+    async def _complete_async(self, messages: List[Dict], model: str, max_retries: Optional[int], operation: str,
+                              **params) -> str:
+        with self._observe(model, operation):
+            max_attempts = max_retries or self.retry_policy.max_attempts
+            deadline = self.retry_policy.start()
+            estimated = self._estimate_tokens(messages)
+            for attempt in range(max_attempts):
+                with self.breaker.attempt():
+                    if self.rate_limiter is not None:
+                        with phase("rate_limit"):
+                            await self.rate_limiter.acquire_async(model, estimated)
+                    try:
+                        completion = await self._async_client.chat.completions.create(
+                            model=model, messages=messages, timeout=self._attempt_timeout(deadline), **params)
+                        self._record_usage(completion, model, operation, estimated)
+                        content = self._content(completion)
+                    except Exception as e:
+                        delay = self._after_failure(e, attempt, max_attempts, deadline, model, operation)
+                        if delay is None:
+                            raise
+                    else:
+                        self.breaker.record_success()
+                        return content
+                with phase("retry_wait"):
+                    await asyncio.sleep(delay)
+
+            raise Exception("Max retries exceeded")
+
+    def stream(self, messages: List[Dict], model: str, max_retries: Optional[int] = None,
+               operation: str = "other", **params) -> Iterator[str]:
+        """Stream a chat completion, yielding its text as it arrives.
+
+        Failures are retried only until the first text has been yielded; after that an
+        error is raised to the caller. The deadline covers waiting for the first text.
+        """
+        with self._observe(model, operation):
+            yield from self._stream(messages, model, max_retries, operation, **params)
+
+    def _stream(self, messages: List[Dict], model: str, max_retries: Optional[int], operation: str,
+                **params) -> Iterator[str]:
+        max_attempts = max_retries or self.retry_policy.max_attempts
+        deadline = self.retry_policy.start()
+        estimated = self._estimate_tokens(messages)
+        for attempt in range(max_attempts):
+            with self.breaker.attempt():
+                if self.rate_limiter is not None:
+                    with phase("rate_limit"):
+                        self.rate_limiter.acquire(model, estimated)
+                started = False
+                try:
+                    # The last chunk then carries the usage, for the metrics and the token budgets
+                    stream = self.client.chat.completions.create(
+                        model=model, messages=messages, stream=True, timeout=self._attempt_timeout(deadline),
+                        **{"stream_options": {"include_usage": True}, **params})
+                    usage_chunk = None
+                    try:
+                        for chunk in stream:
+                            if getattr(chunk, "usage", None):
+                                usage_chunk = chunk
+                            if not chunk.choices:
+                                continue
+                            text = chunk.choices[0].delta.content
+                            if text:
+                                if not started:
+                                    started = True
+                                    self.breaker.record_success()
+                                yield text
+                    finally:
+                        stream.close()
+                        if started:
+                            self._record_usage(usage_chunk, model, operation, estimated)
+                    if not started:
+                        raise ValueError("Empty response from API")
+                    return
+
+                except Exception as e:
+                    if started:
+                        print(f"Error while streaming: {str(e)}")
+                        LLM_ATTEMPT_ERRORS.inc(model=model, operation=operation, reason=error_reason(e))
+                        raise
+                    delay = self._after_failure(e, attempt, max_attempts, deadline, model, operation)
+                    if delay is None:
+                        raise
+            with phase("retry_wait"):
+                time.sleep(delay)
+
+    def stats(self) -> Dict:
+        with self._usage_lock:
+            usage = dict(self.usage)
+        return {
+            "circuit_breaker": self.breaker.stats(),
+            "rate_limiter": self.rate_limiter.stats() if self.rate_limiter is not None else {},
+            "usage": usage
+        }
+
+    def close(self):
+        self.client.close()
+        with self._loop_lock:
+            loop, self._loop = self._loop, None
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(self._async_client.close(), loop).result(timeout=10)
+            loop.call_soon_threadsafe(loop.stop)
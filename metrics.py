@@ -0,0 +1,239 @@
+import bisect
+import functools
+import os
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() not in ("0", "false", "no")
+# Label combinations a metric keeps apart; further ones are counted under label values of "other"
+METRICS_MAX_SERIES = int(os.getenv("METRICS_MAX_SERIES", "500"))
+
+# Upper bounds, in seconds, of the latency histogram buckets
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+STORAGE_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Values of one metric by label values, updated under a lock of its own."""
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 max_series: int = METRICS_MAX_SERIES):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.max_series = max_series
+        self._series: Dict[Tuple[str, ...], object] = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {', '.join(self.labels)}")
+        key = tuple(str(labels[name]) for name in self.labels)
+        if key not in self._series and len(self._series) >= self.max_series:
+            # Unbounded label values, such as a model named by the client, can't exhaust memory
+            key = ("other",) * len(self.labels)
+        return key
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            series = sorted(self._series.items())
+            lines += self._render_series(series)
+        return lines
+
+    def _render_series(self, series) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """A total that only goes up, such as retries or tokens."""
+
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        if not METRICS_ENABLED:
+            return
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels) -> float:
+        with self._lock:
+            return self._series.get(tuple(str(labels[name]) for name in self.labels), 0)
+
+    def _render_series(self, series) -> List[str]:
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_value(value)}" for key, value in series]
+
+
+class Histogram(_Metric):
+    """Counts of observations, such as latencies, in fixed buckets, with their count and sum.
+
+    An observation costs a lock, a dictionary lookup and a binary search over the bucket
+    bounds, so histograms can stay on in production.
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = REQUEST_BUCKETS, max_series: int = METRICS_MAX_SERIES):
+        if "le" in labels:
+            raise ValueError("le is reserved for histogram buckets")
+        super().__init__(name, documentation, labels, max_series)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, **labels):
+        if not METRICS_ENABLED:
+            return
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                # Counts per bucket (the last for values above every bound), then the sum
+                series = self._series[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def time(self, **labels):
+        """Decorator observing how long each call of the function takes."""
+        def decorator(func: Callable) -> Callable:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.observe(time.perf_counter() - started, **labels)
+            return wrapper
+        return decorator
+
+    def count(self, **labels) -> int:
+        with self._lock:
+            series = self._series.get(tuple(str(labels[name]) for name in self.labels))
+            return sum(series[:-1]) if series else 0
+
+    def _render_series(self, series) -> List[str]:
+        lines = []
+        names = self.labels + ("le",)
+        for key, counts in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(names, key + (_format_value(bound),))} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """The metrics of a process, exported in the Prometheus text format by render().
+
+    Collectors are functions called at render time for values that already live elsewhere,
+    such as job counts or the circuit breaker state. Each returns (name, type, help,
+    [(labels, value)]) tuples.
+    """
+
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+        self._collectors: List[Callable[[], Iterable[Tuple[str, str, str, List[Tuple[Dict, float]]]]]] = []
+        self._lock = threading.Lock()
+
+    def _add(self, metric: _Metric) -> _Metric:
+        with self._lock:
+            self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = REQUEST_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, documentation, labels, buckets))
+
+    def collector(self, func: Callable):
+        with self._lock:
+            self._collectors.append(func)
+        return func
+
+    def render(self) -> str:
+        with self._lock:
+            metrics, collectors = list(self._metrics), list(self._collectors)
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        for collect in collectors:
+            try:
+                families = list(collect())
+            except Exception as e:
+                print(f"Error collecting metrics from {getattr(collect, '__name__', collect)}: {str(e)}")
+                continue
+            for name, kind, documentation, samples in families:
+                lines += [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+                for labels, value in samples:
+                    lines.append(f"{name}{_format_labels(list(labels), list(labels.values()))} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram(
+    "scope_http_request_duration_seconds",
+    "Time to handle a request, up to the response headers for streamed responses.",
+    ("method", "route", "status"))
+
+LLM_REQUEST_SECONDS = REGISTRY.histogram(
+    "scope_llm_request_duration_seconds",
+    "Time of a model call including its retries; outcome is ok, error, unavailable or cancelled.",
+    ("model", "operation", "outcome"))
+LLM_ATTEMPT_ERRORS = REGISTRY.counter(
+    "scope_llm_attempt_errors_total",
+    "Failed attempts of model calls, by HTTP status or exception type.",
+    ("model", "operation", "reason"))
+LLM_RETRIES = REGISTRY.counter(
+    "scope_llm_retries_total",
+    "Attempts of model calls made after a failed attempt.",
+    ("model", "operation"))
+LLM_TOKENS = REGISTRY.counter(
+    "scope_llm_tokens_total",
+    "Tokens the API reported in the usage of completions.",
+    ("model", "operation", "type"))
+
+STORAGE_SECONDS = REGISTRY.histogram(
+    "scope_storage_operation_duration_seconds",
+    "Time of scope storage operations.",
+    ("backend", "operation"), STORAGE_BUCKETS)
+SCOPE_FILE_SECONDS = REGISTRY.histogram(
+    "scope_file_io_duration_seconds",
+    "Time to read (on a cache miss) or write one scope head or history file.",
+    ("operation",), STORAGE_BUCKETS)
+
+
+def error_reason(error: Exception) -> str:
+    """A short, bounded label for an error: its HTTP status if it has one, else its type."""
+    status = getattr(error, "status_code", None)
+    return str(status) if status is not None else type(error).__name__
+
+
+def storage_timed(backend: str, operation: str):
+    """Decorator timing a ScopeStore method in STORAGE_SECONDS."""
+    return STORAGE_SECONDS.time(backend=backend, operation=operation)
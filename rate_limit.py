@@ -0,0 +1,236 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from retry_policy import RetryLaterError
+
+LLM_RATE_LIMIT_ENABLED = os.getenv("LLM_RATE_LIMIT_ENABLED", "true").lower() not in ("0", "false", "no")
+RATE_LIMIT_PATH = os.getenv("RATE_LIMIT_PATH", "rate_limits.sqlite3")
+# Requests and tokens per minute allowed for the API key across all models; 0 for no limit
+LLM_KEY_RPM = float(os.getenv("LLM_KEY_RPM", "0"))
+LLM_KEY_TPM = float(os.getenv("LLM_KEY_TPM", "0"))
+# Requests and tokens per minute allowed for each model; 0 for no limit
+LLM_MODEL_RPM = float(os.getenv("LLM_MODEL_RPM", "0"))
+LLM_MODEL_TPM = float(os.getenv("LLM_MODEL_TPM", "0"))
+# OpenRouter allows 20 requests per minute to its free (":free") model variants
+LLM_FREE_MODEL_RPM = float(os.getenv("LLM_FREE_MODEL_RPM", "20"))
+# Per-model overrides, as JSON: {"model": {"rpm": 60, "tpm": 100000}}
+LLM_MODEL_LIMITS = json.loads(os.getenv("LLM_MODEL_LIMITS", "{}"))
+# Longest a caller is queued for a slot before it gets RateLimitedError instead
+LLM_RATE_LIMIT_MAX_WAIT = float(os.getenv("LLM_RATE_LIMIT_MAX_WAIT", "30"))
+
+
+class RateLimitedError(RetryLaterError):
+    """Raised instead of waiting when a call would have to queue longer than the limiter allows."""
+
+    def __init__(self, bucket: str, retry_after: float):
+        super().__init__(f"Rate limit of {bucket} reached; try again in {retry_after:.0f}s", retry_after)
+        self.bucket = bucket
+
+
+class RateLimiter:
+    """Token bucket limiting calls to rate per second on average, with bursts of up to burst.
+
+    Each acquire takes one token, waiting until the bucket has refilled enough. Waiters
+    reserve their slot before sleeping, so they are served in arrival order. Shared by
+    the threads and event loops of one process.
+    """
+
+    def __init__(self, rate: float, burst: float = 1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def _reserve(self) -> float:
+        """Take a token, returning how many seconds to wait before using it."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            wait = max(0.0, -self._tokens / self.rate)
+            self.waited += wait
+            return wait
+
+    def acquire(self, model: Optional[str] = None, tokens: int = 0):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, model: Optional[str] = None, tokens: int = 0):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, model: str, tokens: int):
+        pass
+
+    def stats(self) -> Dict:
+        return {"rate": self.rate, "waited": self.waited}
+
+
+class SharedRateLimiter:
+    """Requests- and tokens-per-minute budgets for one API key, shared across processes.
+
+    Every budget is a token bucket in a SQLite database, so all threads, web workers and
+    job workers on the machine draw from the same buckets. There are buckets for the API
+    key as a whole and for each model. A bucket holds up to one minute of its budget and
+    refills continuously.
+
+    Before a call, acquire takes one request and the estimated prompt tokens from each
+    bucket that applies. If a bucket is short, the caller's share is reserved and the
+    caller sleeps until it refills. Callers that would wait longer than max_wait get
+    RateLimitedError at once instead. After the call, record_usage charges the difference
+    between the estimate and the tokens the response reports.
+
+    process_rpm adds a budget of this process alone, such as a batch run's --rate, kept in
+    memory by a RateLimiter rather than in the database.
+    """
+
+    def __init__(self, api_key: str, db_path: str = RATE_LIMIT_PATH, key_rpm: float = LLM_KEY_RPM,
+                 key_tpm: float = LLM_KEY_TPM, model_rpm: float = LLM_MODEL_RPM, model_tpm: float = LLM_MODEL_TPM,
+                 free_model_rpm: float = LLM_FREE_MODEL_RPM, model_limits: Optional[Dict] = None,
+                 max_wait: float = LLM_RATE_LIMIT_MAX_WAIT, process_rpm: float = 0):
+        # Buckets are named by a hash of the key, so the key itself is never written to disk
+        self.key_id = hashlib.sha256(api_key.encode('utf-8')).hexdigest()[:12]
+        self.db_path = Path(db_path)
+        self.key_rpm = key_rpm
+        self.key_tpm = key_tpm
+        self.model_rpm = model_rpm
+        self.model_tpm = model_tpm
+        self.free_model_rpm = free_model_rpm
+        # A requests-per-minute budget of this process alone, on top of the shared ones; kept
+        # in memory, as no other process draws from it
+        self.process = RateLimiter(process_rpm / 60) if process_rpm > 0 else None
+        self.model_limits = LLM_MODEL_LIMITS if model_limits is None else model_limits
+        self.max_wait = max_wait
+        self._local = threading.local()
+        self._stats_lock = threading.Lock()
+        self.waits = 0
+        self.waited = 0.0
+        self.rejected = 0
+
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS buckets (
+                    name TEXT PRIMARY KEY,
+                    level REAL NOT NULL,
+                    updated REAL NOT NULL
+                ) WITHOUT ROWID
+            """)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly by _transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a block in a write transaction, holding the database write lock from the start."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def limits(self, model: str) -> List[Tuple[str, float, bool]]:
+        """The buckets a call to model draws from, as (name, per-minute budget, counts tokens)."""
+        override = self.model_limits.get(model, {})
+        model_rpm = override.get("rpm", self.free_model_rpm if model.endswith(":free") else self.model_rpm)
+        model_tpm = override.get("tpm", self.model_tpm)
+        buckets = [
+            (f"key:{self.key_id}:rpm", self.key_rpm, False),
+            (f"key:{self.key_id}:tpm", self.key_tpm, True),
+            (f"model:{self.key_id}:{model}:rpm", model_rpm, False),
+            (f"model:{self.key_id}:{model}:tpm", model_tpm, True)
+        ]
+        return [bucket for bucket in buckets if bucket[1] > 0]
+
+    def _draw(self, conn: sqlite3.Connection, name: str, per_minute: float, amount: float, now: float) -> float:
+        """Take amount from a bucket, returning the seconds until its level is back to zero."""
+        row = conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        rate = per_minute / 60
+        level = per_minute if row is None else min(per_minute, row[0] + (now - row[1]) * rate)
+        level -= amount
+        conn.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)", (name, level, now))
+        return max(0.0, -level / rate)
+
+    def _reserve(self, model: str, tokens: int) -> float:
+        buckets = self.limits(model)
+        if not buckets:
+            return 0.0
+        now = time.time()
+        with self._transaction() as conn:
+            waits = [(self._draw(conn, name, per_minute, tokens if counts_tokens else 1, now), name, counts_tokens)
+                     for name, per_minute, counts_tokens in buckets]
+            wait, name, counts_tokens = max(waits)
+            if wait > self.max_wait:
+                # Raising rolls the transaction back, which gives the reservation back
+                with self._stats_lock:
+                    self.rejected += 1
+                owner = model if name.startswith("model:") else "the API key"
+                raise RateLimitedError(f"{owner} ({'tokens' if counts_tokens else 'requests'} per minute)", wait)
+        if wait:
+            with self._stats_lock:
+                self.waits += 1
+                self.waited += wait
+        return wait
+
+    def _reserve_all(self, model: str, tokens: int) -> float:
+        wait = self._reserve(model, tokens)
+        if self.process is not None:
+            wait = max(wait, self.process._reserve())
+        return wait
+
+    def acquire(self, model: str, tokens: int = 0):
+        """Wait until a call of about tokens prompt tokens to model is within every budget."""
+        wait = self._reserve_all(model, tokens)
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self, model: str, tokens: int = 0):
+        """Async version of acquire; the database is updated on another thread, off the event loop."""
+        wait = await asyncio.to_thread(self._reserve_all, model, tokens)
+        if wait:
+            await asyncio.sleep(wait)
+
+    def record_usage(self, model: str, tokens: int):
+        """Charge the token budgets for tokens more than were estimated (or refund, if negative)."""
+        buckets = [(name, per_minute) for name, per_minute, counts_tokens in self.limits(model) if counts_tokens]
+        if not buckets or not tokens:
+            return
+        now = time.time()
+        with self._transaction() as conn:
+            for name, per_minute in buckets:
+                self._draw(conn, name, per_minute, tokens, now)
+
+    def stats(self) -> Dict:
+        with self._stats_lock:
+            return {"waits": self.waits, "waited": round(self.waited, 3), "rejected": self.rejected}
+
+
+def default_rate_limiter(api_key: str) -> Optional[SharedRateLimiter]:
+    """The shared limiter configured by the environment, or None if rate limiting is off."""
+    return SharedRateLimiter(api_key) if LLM_RATE_LIMIT_ENABLED else None
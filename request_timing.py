@@ -0,0 +1,170 @@
+import contextvars
+import cProfile
+import functools
+import inspect
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+# Write a JSON record with the phase timings of every request and job
+TIMING_LOG = os.getenv("TIMING_LOG", "true").lower() not in ("0", "false", "no")
+# File the records are appended to, one per line; standard output if empty
+TIMING_LOG_PATH = os.getenv("TIMING_LOG_PATH", "")
+# Fraction of requests and jobs run under cProfile; 0 turns profiling off
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+# Profiled requests taking at least this many milliseconds have their profile saved
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "2000"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+
+# Phase timer of the request or job running in the current context; see track_phases
+_timer = contextvars.ContextVar("phase_timer", default=None)
+_log_lock = threading.Lock()
+# cProfile profiles one thread, and newer Pythons allow only one profiler at a time
+_profile_lock = threading.Lock()
+
+
+class PhaseTimer:
+    """Total time spent in each named phase of one request or job.
+
+    Phases can nest: the prompt phase includes the context phase, and the llm phase
+    includes rate_limit and retry_wait. Phases run concurrently, such as the sections of a
+    sectioned scope, add up, so their total can exceed the wall time.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def add(self, name: str, seconds: float):
+        with self._lock:
+            self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def elapsed(self) -> float:
+        return time.perf_counter() - self.started
+
+    def milliseconds(self) -> Dict[str, float]:
+        """Phase totals in milliseconds, in the order the phases first ran."""
+        with self._lock:
+            return {name: round(seconds * 1000, 1) for name, seconds in self.phases.items()}
+
+    def server_timing(self) -> str:
+        """The phases as a Server-Timing header value, ending with the total so far."""
+        entries = [f"{name};dur={ms}" for name, ms in self.milliseconds().items()]
+        entries.append(f"total;dur={round(self.elapsed() * 1000, 1)}")
+        return ", ".join(entries)
+
+
+def start_phases() -> Tuple[PhaseTimer, contextvars.Token]:
+    """Start timing phases in the current context; pass the token to stop_phases when done."""
+    timer = PhaseTimer()
+    return timer, _timer.set(timer)
+
+
+def stop_phases(token: contextvars.Token):
+    _timer.reset(token)
+
+
+@contextmanager
+def track_phases() -> Iterator[PhaseTimer]:
+    """Time the phases run inside the block, including by tasks and copied contexts it starts."""
+    timer, token = start_phases()
+    try:
+        yield timer
+    finally:
+        stop_phases(token)
+
+
+@contextmanager
+def phase(name: str):
+    """Add the time spent in the block to phase name of the current timer, if there is one.
+
+    Can also decorate a function. Costs next to nothing when no timer is running.
+    """
+    timer = _timer.get()
+    if timer is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - started)
+
+
+def log_timing(record: Dict):
+    """Write one structured timing record as a line of JSON."""
+    if not TIMING_LOG:
+        return
+    line = json.dumps(dict(record, ts=round(time.time(), 3)))
+    with _log_lock:
+        if TIMING_LOG_PATH:
+            with open(TIMING_LOG_PATH, 'a') as f:
+                f.write(line + "\n")
+        else:
+            print(line, flush=True)
+
+
+@contextmanager
+def sampled_profile(name: str):
+    """Run the block under cProfile for a PROFILE_SAMPLE_RATE sample of calls.
+
+    The profile is saved to PROFILE_DIR only if the block took PROFILE_SLOW_MS or more;
+    read it with `python -m pstats <file>` or snakeviz. Only one block is profiled at a
+    time; calls made while another is being profiled run unprofiled.
+    """
+    if PROFILE_SAMPLE_RATE <= 0 or random.random() >= PROFILE_SAMPLE_RATE \
+            or not _profile_lock.acquire(blocking=False):
+        yield
+        return
+    profiler = cProfile.Profile()
+    started = time.perf_counter()
+    try:
+        profiler.enable()
+        yield
+    finally:
+        profiler.disable()
+        _profile_lock.release()
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        if elapsed_ms >= PROFILE_SLOW_MS:
+            _save_profile(profiler, name, elapsed_ms)
+
+
+def _save_profile(profiler: cProfile.Profile, name: str, elapsed_ms: float):
+    try:
+        directory = Path(PROFILE_DIR)
+        directory.mkdir(parents=True, exist_ok=True)
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]+", "_", name).strip("_") or "request"
+        path = directory / f"{time.strftime('%Y%m%d-%H%M%S')}_{safe_name}_{elapsed_ms:.0f}ms.prof"
+        profiler.dump_stats(str(path))
+        print(f"Saved profile of slow {name} ({elapsed_ms:.0f}ms) to {path}", file=sys.stderr)
+    except Exception as e:
+        print(f"Error saving profile of {name}: {str(e)}")
+
+
+def profiled(func: Callable, name: Optional[str] = None) -> Callable:
+    """Wrap a function, sync or async, so sampled calls run under sampled_profile.
+
+    Async functions are profiled from inside the coroutine, on the thread running its event
+    loop, which is where their work happens.
+    """
+    name = name or func.__name__
+    if inspect.iscoroutinefunction(func):
+        @functools.wraps(func)
+        async def async_wrapper(*args, **kwargs):
+            with sampled_profile(name):
+                return await func(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with sampled_profile(name):
+            return func(*args, **kwargs)
+    return wrapper
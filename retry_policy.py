@@ -0,0 +1,191 @@
+import email.utils
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from openai import APIConnectionError, APIStatusError
+
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "3"))
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "20"))
+LLM_REQUEST_DEADLINE = float(os.getenv("LLM_REQUEST_DEADLINE", "300"))
+LLM_BREAKER_THRESHOLD = int(os.getenv("LLM_BREAKER_THRESHOLD", "5"))
+LLM_BREAKER_RESET = float(os.getenv("LLM_BREAKER_RESET", "30"))
+
+# Status codes worth another attempt: timeouts, conflicts, rate limits and upstream failures
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+
+class RetryLaterError(Exception):
+    """The API can't be called right now; retry_after is the number of seconds to wait first."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(RetryLaterError):
+    """Raised without calling the API while the circuit breaker considers it unhealthy."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"The AI service is unavailable after repeated failures; retrying in {retry_after:.0f}s",
+                         retry_after)
+
+
+def is_retryable(error: Exception) -> bool:
+    """Whether an API error may succeed on another attempt."""
+    if isinstance(error, APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    if isinstance(error, APIConnectionError):  # Includes timeouts
+        return True
+    # The API sometimes answers with no choices under load
+    return isinstance(error, ValueError) and "Empty response from API" in str(error)
+
+
+def is_rejected(error: Exception) -> bool:
+    """Whether the API answered and refused the request itself, such as for an unknown model."""
+    return isinstance(error, APIStatusError) and not is_retryable(error)
+
+
+def retry_after(error: Exception) -> Optional[float]:
+    """Seconds the server asked us to wait, from the Retry-After headers of an error response."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, parsed.timestamp() - time.time())
+
+
+class RetryPolicy:
+    """When to try a failed API call again, and how long to wait first.
+
+    Retryable errors (connection failures, timeouts, 408/409/425/429 and 5xx responses)
+    are retried up to max_attempts in total, waiting a random time between zero and
+    base_delay * 2^attempt capped at max_delay ("full jitter"), or longer if the response
+    carried Retry-After. Other errors fail at once. Nothing is retried past the overall
+    deadline of the request.
+    """
+
+    def __init__(self, max_attempts: int = LLM_MAX_RETRIES, base_delay: float = LLM_RETRY_BASE_DELAY,
+                 max_delay: float = LLM_RETRY_MAX_DELAY, deadline: float = LLM_REQUEST_DEADLINE):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.deadline = deadline
+
+    def start(self) -> float:
+        """Return the monotonic time by which a request starting now must finish."""
+        return time.monotonic() + self.deadline
+
+    @staticmethod
+    def remaining(deadline: float) -> float:
+        return max(0.0, deadline - time.monotonic())
+
+    def next_delay(self, error: Exception, attempt: int, max_attempts: int, deadline: float) -> Optional[float]:
+        """Seconds to wait before retrying after attempt (counted from 0) failed, or None to give up."""
+        if not is_retryable(error) or attempt + 1 >= max_attempts:
+            return None
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        requested = retry_after(error)
+        if requested is not None:
+            delay = max(delay, requested)
+        if delay >= self.remaining(deadline):
+            return None
+        return delay
+
+
+class CircuitBreaker:
+    """Fails API calls fast while the upstream keeps failing.
+
+    After failure_threshold retryable failures in a row the circuit opens, and calls raise
+    CircuitOpenError without reaching the API. Once reset_timeout has passed one call is let
+    through as a probe: its success closes the circuit, its failure opens it again. Run
+    each attempt inside attempt(), so a probe that ends without a result, because it was
+    cancelled or stopped by the rate limiter, hands the probe on to the next call.
+    """
+
+    def __init__(self, failure_threshold: int = LLM_BREAKER_THRESHOLD, reset_timeout: float = LLM_BREAKER_RESET):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self.rejected = 0
+
+    def check(self) -> bool:
+        """Raise CircuitOpenError unless a call may go ahead now; return whether it is the probe."""
+        with self._lock:
+            if self.state == "closed":
+                return False
+            waited = time.monotonic() - self.opened_at
+            if self.state == "open" and waited >= self.reset_timeout:
+                self.state = "half_open"
+                return True
+            self.rejected += 1
+            raise CircuitOpenError(max(0.0, self.reset_timeout - waited))
+
+    @contextmanager
+    def attempt(self):
+        """Check the circuit for one attempt, releasing the probe if the attempt records no result."""
+        probe = self.check()
+        try:
+            yield
+        finally:
+            if probe:
+                self._release_probe()
+
+    def _release_probe(self):
+        with self._lock:
+            if self.state == "half_open":
+                # Open again, but with the timeout already passed, so the next call probes
+                self.state = "open"
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def record_success(self):
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or (self.state == "closed" and self.failures >= self.failure_threshold):
+                if self.state != "open":
+                    self.times_opened += 1
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            retry_in = 0.0
+            if self.state == "open":
+                retry_in = max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+            return {
+                "state": self.state,
+                "consecutive_failures": self.failures,
+                "times_opened": self.times_opened,
+                "rejected": self.rejected,
+                "retry_in": retry_in
+            }
@@ -0,0 +1,101 @@
+import copy
+import os
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+CACHE_MAX_BYTES = int(os.getenv("SCOPE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class ScopeCache:
+    """Bounded LRU cache of parsed scope files.
+
+    Entries are keyed by path and checked against the file's inode, mtime and size on every
+    lookup, so writes from other processes invalidate them. The signature stored with an
+    entry must come from the same open file the data was read from or written to, or a file
+    replaced in between would be cached under the wrong signature. The cache is capped by
+    the total decoded size of the cached files, which for compressed files is several times
+    their size on disk.
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def _signature(stat: os.stat_result) -> tuple:
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def get(self, path) -> Optional[object]:
+        """Return a copy of the cached data for path if the file has not changed since it was cached."""
+        key = str(path)
+        try:
+            signature = self._signature(os.stat(key))
+        except OSError:
+            signature = None
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == signature:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                data = entry[1]
+            else:
+                if entry is not None:
+                    self._drop(key)
+                self.misses += 1
+                return None
+        return copy.deepcopy(data)
+
+    def put(self, path, data, stat: os.stat_result, size: int):
+        """Cache parsed data for path.
+
+        stat is the fstat of the file the data was read from or written to, taken before
+        reading or before renaming it into place, and size the length of its decoded JSON.
+        """
+        key = str(path)
+        if size > self.max_bytes:
+            return
+
+        data = copy.deepcopy(data)
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (self._signature(stat), data, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate(self, path):
+        with self._lock:
+            if str(path) in self._entries:
+                self._drop(str(path))
+
+    def _drop(self, key: str):
+        entry = self._entries.pop(key)
+        self._bytes -= entry[2]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
@@ -0,0 +1,186 @@
+import argparse
+import re
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Bump when the tables change so existing catalogs are rebuilt from the scope files
+SCHEMA_VERSION = 2
+
+# Markers around matched terms in search snippets; callers escape the text and swap these for markup
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+
+
+def _answers_text(project_info) -> str:
+    """Collect the free-text answers and transcription from a scope's project_info."""
+    if not isinstance(project_info, dict):
+        return ""
+    return "\n".join(value for value in project_info.values() if isinstance(value, str) and value.strip())
+
+
+def _match_expression(query: str) -> Optional[str]:
+    """Turn free text into an FTS5 query that matches all words, the last one as a prefix."""
+    terms = re.findall(r"\w+", query.lower())
+    if not terms:
+        return None
+    quoted = [f'"{term}"' for term in terms]
+    quoted[-1] += "*"
+    return " ".join(quoted)
+
+
+class ScopeCatalog:
+    """SQLite index of saved scopes so listing never has to parse the full scope files.
+
+    Alongside the listing table it keeps an FTS5 full-text index over project names,
+    scope text and project_info answers, updated with every save. Search rows share their
+    rowid with the listing row, so replacing a scope's entry is an indexed lookup.
+    """
+
+    def __init__(self, db_path: str = "scopes/catalog.sqlite3"):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        with closing(self._connect()) as conn, conn:
+            schema_version = conn.execute("PRAGMA user_version").fetchone()[0]
+            if schema_version < SCHEMA_VERSION:
+                conn.execute("DROP TABLE IF EXISTS scope_search")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scopes (
+                    id TEXT PRIMARY KEY,
+                    project_name TEXT NOT NULL,
+                    date_created REAL NOT NULL,
+                    formatted_date TEXT NOT NULL,
+                    file_name TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_scopes_date_created ON scopes (date_created DESC)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_scopes_project_name ON scopes (project_name)")
+            conn.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS scope_search USING fts5(
+                    project_name,
+                    scope,
+                    answers,
+                    tokenize = 'porter unicode61'
+                )
+            """)
+            # A catalog written by an older version has rows but an empty or outdated search index
+            self.needs_rebuild = schema_version < SCHEMA_VERSION and conn.execute(
+                "SELECT COUNT(*) FROM scopes").fetchone()[0] > 0
+            conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    @staticmethod
+    def _row_from_scope(scope_data: Dict, file_name: str) -> tuple:
+        return (
+            scope_data.get("id", "Unknown Scope"),
+            scope_data.get("project_name", "Unknown Project"),
+            scope_data.get("date_created", 0),
+            scope_data.get("formatted_date", "Unknown Date"),
+            file_name
+        )
+
+    @staticmethod
+    def _search_row_from_scope(scope_data: Dict) -> tuple:
+        return (
+            scope_data.get("project_name", ""),
+            scope_data.get("scope", ""),
+            _answers_text(scope_data.get("project_info"))
+        )
+
+    def _write(self, conn: sqlite3.Connection, scope_data: Dict, file_name: str):
+        row = self._row_from_scope(scope_data, file_name)
+        conn.execute(
+            "INSERT INTO scopes (id, project_name, date_created, formatted_date, file_name) "
+            "VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET project_name = excluded.project_name, "
+            "date_created = excluded.date_created, formatted_date = excluded.formatted_date, "
+            "file_name = excluded.file_name",
+            row
+        )
+        rowid = conn.execute("SELECT rowid FROM scopes WHERE id = ?", (row[0],)).fetchone()[0]
+        conn.execute("DELETE FROM scope_search WHERE rowid = ?", (rowid,))
+        conn.execute(
+            "INSERT INTO scope_search (rowid, project_name, scope, answers) VALUES (?, ?, ?, ?)",
+            (rowid,) + self._search_row_from_scope(scope_data)
+        )
+
+    def upsert(self, scope_data: Dict, file_name: Optional[str] = None):
+        """Insert or refresh the catalog and search entries for a scope."""
+        file_name = file_name or f"{scope_data.get('id')}.json"
+        with closing(self._connect()) as conn, conn:
+            self._write(conn, scope_data, file_name)
+
+    def remove(self, scope_id: str):
+        """Drop a scope from the catalog."""
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM scope_search WHERE rowid IN (SELECT rowid FROM scopes WHERE id = ?)",
+                         (scope_id,))
+            conn.execute("DELETE FROM scopes WHERE id = ?", (scope_id,))
+
+    def list(self, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """List catalogued scopes, newest first, optionally one page at a time."""
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                "SELECT id, project_name, date_created, formatted_date, file_name "
+                "FROM scopes ORDER BY date_created DESC LIMIT ? OFFSET ?",
+                (-1 if limit is None else limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def count(self) -> int:
+        with closing(self._connect()) as conn:
+            return conn.execute("SELECT COUNT(*) FROM scopes").fetchone()[0]
+
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """Full-text search over saved scopes, best matches first.
+
+        Matches in the project name weigh most, then answers, then the scope text. Each
+        result carries a snippet with matched terms wrapped in HIGHLIGHT_START/HIGHLIGHT_END.
+        """
+        match = _match_expression(query)
+        if not match:
+            return []
+        with closing(self._connect()) as conn:
+            rows = conn.execute(
+                f"""
+                SELECT s.id, s.project_name, s.date_created, s.formatted_date, s.file_name,
+                       bm25(scope_search, 10.0, 1.0, 2.0) AS score,
+                       snippet(scope_search, -1, '{HIGHLIGHT_START}', '{HIGHLIGHT_END}', '...', 16) AS snippet
+                FROM scope_search
+                JOIN scopes s ON s.rowid = scope_search.rowid
+                WHERE scope_search MATCH ?
+                ORDER BY score
+                LIMIT ? OFFSET ?
+                """,
+                (match, limit, offset)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def rebuild(self, scopes: Iterable[Tuple[Dict, str]]) -> int:
+        """Recreate the catalog from (scope data, file name) pairs for every saved scope."""
+        count = 0
+        with closing(self._connect()) as conn, conn:
+            conn.execute("DELETE FROM scopes")
+            conn.execute("DELETE FROM scope_search")
+            for scope_data, file_name in scopes:
+                self._write(conn, scope_data, file_name)
+                count += 1
+        self.needs_rebuild = False
+        return count
+
+
+if __name__ == '__main__':
+    from scope_store import FileScopeStore
+
+    parser = argparse.ArgumentParser(description="Manage the saved scope catalog.")
+    parser.add_argument("command", choices=["rebuild"], help="rebuild: recreate the catalog from the scope files")
+    parser.add_argument("--scopes-dir", default="scopes")
+    args = parser.parse_args()
+
+    count = FileScopeStore(args.scopes_dir).rebuild_catalog()
+    print(f"Catalog rebuilt with {count} scopes")
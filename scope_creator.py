@@ -1,65 +1,136 @@
 import os
 from pathlib import Path
-from typing import Dict, Optional, List, Tuple
+from typing import Dict, Iterator, Optional, List, Tuple
 from dotenv import load_dotenv
-from openai import OpenAI
+import asyncio
+import contextvars
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from context_index import ContextIndex
+from llm_cache import LLM_CACHE_ENABLED, ResponseCache, request_key
+from llm_transport import LLMTransport
+from request_timing import phase
+from retry_policy import RetryLaterError, is_rejected
+from single_flight import SingleFlight
+from scope_sections import OUTLINE_PARAMS, merge_sections, outline_messages, parse_outline, section_messages
+from scope_store import open_store
 
 # Load environment variables
 load_dotenv()
 
+# Seconds a generated scope is remembered by request key, so a retried request does not generate it again
+GENERATION_REMEMBER = float(os.getenv("GENERATION_REMEMBER", "3600"))
+
+# "single" writes a scope in one model call; "sectioned" writes an outline, then its sections concurrently
+SCOPE_GENERATION_MODE = os.getenv("SCOPE_GENERATION_MODE", "single")
+
 class ScopeCreator:
     def __init__(self, model: str = "google/gemini-2.0-pro-exp-02-05:free"):
         api_key = os.getenv("OPENROUTER_API_KEY")
         if not api_key:
             raise ValueError("OPENROUTER_API_KEY environment variable is not set")
             
-        self.client = OpenAI(
-            base_url="https://openrouter.ai/api/v1",
-            api_key=api_key,
+        # Every model call, including the editor's AI chat, shares this connection pool and retry policy
+        self.transport = LLMTransport(
+            api_key,
             default_headers={
                 "HTTP-Referer": os.getenv("SITE_URL", "http://localhost:5006"),
                 "X-Title": os.getenv("SITE_NAME", "Scope Creator AI")
             }
         )
         self.model = model
-        self.context = self._load_context()
+        # Prompts include only the parts of context.txt relevant to the project, within a token budget
+        self.context_index = ContextIndex()
 
-    def _make_api_call(self, messages, max_retries=3, model=None):
-        """Make an API call with retries and proper error handling."""
-        for attempt in range(max_retries):
-            try:
-                completion = self.client.chat.completions.create(
-                    model=model or self.model,  # Use provided model or fall back to default
-                    messages=messages,
-                    temperature=0.7,
-                    max_tokens=8000
-                )
-                if not completion or not completion.choices:
-                    raise ValueError("Empty response from API")
-                    
-                return completion.choices[0].message.content
-                
-            except Exception as e:
-                print(f"Error on attempt {attempt + 1}: {str(e)}")
-                if attempt == max_retries - 1:  # Last attempt
-                    raise
-                time.sleep(1 * (attempt + 1))  # Exponential backoff
-                
-        raise Exception("Max retries exceeded")
-
-    def _load_context(self) -> str:
-        """Load the context file that guides scope creation."""
-        try:
-            with open('context.txt', 'r') as f:
-                return f.read()
-        except FileNotFoundError:
-            print("Warning: context.txt not found")
-            return ""
-
-    def analyze_project(self, project_name: str, transcription: Optional[str] = None) -> Dict:
-        """Analyze the project and determine what information is needed."""
+        self.store = open_store("scopes")
+        self.response_cache = ResponseCache() if LLM_CACHE_ENABLED else None
+
+        # Identical completions requested at the same time share one upstream call
+        self.in_flight = SingleFlight()
+        # Scope generations by client request key, so a repeated request returns the same scope
+        self.generations = SingleFlight(remember=GENERATION_REMEMBER, max_remembered=256)
+
+    # Default sampling parameters of a completion; part of the response cache key
+    SAMPLING_PARAMS = {"temperature": 0.7, "max_tokens": 8000}
+
+    # Sampling parameters of the editor's AI chat, which wants short, precise answers
+    CHAT_PARAMS = {"temperature": 0.5, "max_tokens": 1500}
+
+    def _response_key(self, messages, model=None, params=None) -> str:
+        return request_key(model or self.model, messages, **(params or self.SAMPLING_PARAMS))
+
+    def _make_api_call(self, messages, max_retries=None, model=None, use_cache=False, operation="other", **params):
+        """Make an API call with retries and proper error handling.
+
+        operation labels the call in the metrics: analyze, follow_up, generate or chat.
+        Sampling parameters default to SAMPLING_PARAMS. Identical requests (same model,
+        messages and sampling parameters) made while one is in flight wait for it and share
+        its response. With use_cache, an identical earlier request is answered from the
+        response cache without calling the API.
+        """
+        model = model or self.model  # Use provided model or fall back to default
+        params = dict(self.SAMPLING_PARAMS, **params)
+        key = None
+        if use_cache and self.response_cache is not None:
+            key = self._response_key(messages, model, params)
+            with phase("cache"):
+                cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+
+        def call():
+            content = self.transport.complete(messages, model, max_retries, operation, **params)
+            if key is not None and content is not None:
+                self.response_cache.put(key, content, model)
+            return content
+
+        return self.in_flight.do(key or self._response_key(messages, model, params), call)
+
+    async def _make_api_call_async(self, messages, max_retries=None, model=None, use_cache=False, operation="other",
+                                   **params):
+        """Async version of _make_api_call; waits between retries without blocking the event loop."""
+        model = model or self.model
+        params = dict(self.SAMPLING_PARAMS, **params)
+        key = None
+        if use_cache and self.response_cache is not None:
+            key = self._response_key(messages, model, params)
+            with phase("cache"):
+                cached = self.response_cache.get(key)
+            if cached is not None:
+                return cached
+
+        async def call():
+            content = await self.transport.complete_async(messages, model, max_retries, operation, **params)
+            if key is not None and content is not None:
+                self.response_cache.put(key, content, model)
+            return content
+
+        return await self.in_flight.do_async(key or self._response_key(messages, model, params), call)
+
+    def _stream_api_call(self, messages, max_retries=None, model=None, operation="other") -> Iterator[str]:
+        """Stream a completion, yielding its text as it arrives."""
+        return self.transport.stream(messages, model or self.model, max_retries, operation, **self.SAMPLING_PARAMS)
+
+    def chat(self, messages: List[Dict], model: Optional[str] = None) -> str:
+        """Get a reply for the editor's AI chat, with the chat sampling parameters."""
+        return self._make_api_call(messages, model=model, operation="chat", **self.CHAT_PARAMS)
+
+    def _forget_response(self, messages, model=None):
+        """Drop a cached response that turned out to be unusable, so the next call asks again."""
+        if self.response_cache is not None:
+            self.response_cache.invalidate(self._response_key(messages, model))
+
+    @phase("context")
+    def _load_context(self, query: str) -> str:
+        """The parts of the context file that guide scope creation and are most relevant to query."""
+        return self.context_index.render(query)
+
+    @phase("prompt")
+    def _analysis_messages(self, project_name: str, transcription: Optional[str] = None) -> List[Dict]:
+        """Build the prompt messages that analyze a new project."""
+        transcription_section = "Meeting Transcription:\n" + transcription if transcription else ""
+        context = self._load_context(f"{project_name}\n{transcription or ''}")
         prompt = f"""
         Based on this project name and any provided transcription, analyze what type of project this is
         and what specific information would be needed to create a comprehensive scope document.
@@ -67,10 +138,10 @@ class ScopeCreator:
         
         Project Name: {project_name}
 
-        {"Meeting Transcription:\n" + transcription if transcription else ""}
+        {transcription_section}
 
         Context for good scope creation:
-        {self.context}
+        {context}
 
         Important Guidelines:
         1. Only ask questions about information that is ABSOLUTELY NECESSARY for the scope
@@ -101,47 +172,71 @@ class ScopeCreator:
         Important: Return ONLY the JSON object, no markdown code blocks or additional text.
         """
 
+        return [
+            {
+                "role": "system",
+                "content": "You are a professional scope writer. Be conservative in your analysis and only ask for information that is absolutely necessary. Do not make assumptions or ask speculative questions. Return ONLY the JSON object without any markdown formatting or additional text."
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+
+    @phase("parse")
+    def _parse_analysis(self, content: str, messages: List[Dict]) -> Dict:
+        """Parse the project analysis JSON out of a model response."""
+        print(f"Raw AI response:\n{content}")  # Debug print
+        
+        # Clean up the response if it contains markdown code blocks
+        cleaned_content = content.strip()
+        if cleaned_content.startswith('```json'):
+            cleaned_content = cleaned_content[7:]
+        elif cleaned_content.startswith('```'):
+            cleaned_content = cleaned_content[3:]
+        if cleaned_content.endswith('```'):
+            cleaned_content = cleaned_content[:-3]
+        cleaned_content = cleaned_content.strip()
+        
+        try:
+            # Try to parse the JSON
+            parsed_json = json.loads(cleaned_content)
+            return parsed_json
+        except json.JSONDecodeError:
+            # If JSON parsing fails, return the raw response for debugging
+            self._forget_response(messages)
+            return {
+                "raw_response": content
+            }
+
+    def analyze_project(self, project_name: str, transcription: Optional[str] = None, use_cache: bool = True) -> Dict:
+        """Analyze the project and determine what information is needed.
+
+        Identical requests are answered from the response cache unless use_cache is False.
+        """
+        try:
+            messages = self._analysis_messages(project_name, transcription)
+            content = self._make_api_call(messages, use_cache=use_cache, operation="analyze")
+            return self._parse_analysis(content, messages)
+        except Exception as e:
+            print(f"Error analyzing project: {str(e)}")
+            raise
+
+    async def analyze_project_async(self, project_name: str, transcription: Optional[str] = None,
+                                    use_cache: bool = True) -> Dict:
+        """Async version of analyze_project, for use from an event loop."""
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a professional scope writer. Be conservative in your analysis and only ask for information that is absolutely necessary. Do not make assumptions or ask speculative questions. Return ONLY the JSON object without any markdown formatting or additional text."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-            
-            content = self._make_api_call(messages)
-            print(f"Raw AI response:\n{content}")  # Debug print
-            
-            # Clean up the response if it contains markdown code blocks
-            cleaned_content = content.strip()
-            if cleaned_content.startswith('```json'):
-                cleaned_content = cleaned_content[7:]
-            elif cleaned_content.startswith('```'):
-                cleaned_content = cleaned_content[3:]
-            if cleaned_content.endswith('```'):
-                cleaned_content = cleaned_content[:-3]
-            cleaned_content = cleaned_content.strip()
-            
-            try:
-                # Try to parse the JSON
-                parsed_json = json.loads(cleaned_content)
-                return parsed_json
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return the raw response for debugging
-                return {
-                    "raw_response": content
-                }
-            
+            messages = self._analysis_messages(project_name, transcription)
+            content = await self._make_api_call_async(messages, use_cache=use_cache, operation="analyze")
+            return self._parse_analysis(content, messages)
         except Exception as e:
             print(f"Error analyzing project: {str(e)}")
             raise
 
-    def get_follow_up_questions(self, project_name: str, current_info: Dict) -> List[Dict]:
-        """Determine what additional information is needed based on current responses."""
+    @phase("prompt")
+    def _follow_up_messages(self, project_name: str, current_info: Dict) -> List[Dict]:
+        """Build the prompt messages that ask for follow-up questions."""
+        context = self._load_context(f"{project_name}\n{json.dumps(current_info)}")
         prompt = f"""
         Based ONLY on the information provided so far, determine if any CRITICAL information is still missing
         to create a comprehensive scope document for this specific project.
@@ -152,7 +247,7 @@ class ScopeCreator:
         {json.dumps(current_info, indent=2)}
 
         Context for good scope creation:
-        {self.context}
+        {context}
 
         Important Guidelines:
         1. Only ask follow-up questions if information is ABSOLUTELY NECESSARY for the scope
@@ -178,78 +273,110 @@ class ScopeCreator:
         If you have enough information to generate the scope, or if no CRITICAL information is missing, return an empty array: []
         """
 
+        return [
+            {
+                "role": "system",
+                "content": "You are a professional scope writer. Be conservative and only ask for information that is absolutely necessary. Do not make assumptions or ask speculative questions. Return ONLY the JSON array without any markdown formatting or additional text. Return an empty array [] if no critical information is missing."
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+
+    @phase("parse")
+    def _parse_follow_up(self, content: str, messages: List[Dict]) -> List[Dict]:
+        """Parse the follow-up questions JSON array out of a model response."""
+        print(f"Raw follow-up response:\n{content}")  # Debug print
+        
+        # Clean up the response if it contains markdown code blocks
+        cleaned_content = content.strip()
+        if cleaned_content.startswith('```json'):
+            cleaned_content = cleaned_content[7:]
+        elif cleaned_content.startswith('```'):
+            cleaned_content = cleaned_content[3:]
+        if cleaned_content.endswith('```'):
+            cleaned_content = cleaned_content[:-3]
+        cleaned_content = cleaned_content.strip()
+        
+        # If we get an empty string or just whitespace, return empty array
+        if not cleaned_content:
+            print("Empty content - interpreting as no more questions needed")
+            return []
+        
         try:
-            messages = [
-                {
-                    "role": "system",
-                    "content": "You are a professional scope writer. Be conservative and only ask for information that is absolutely necessary. Do not make assumptions or ask speculative questions. Return ONLY the JSON array without any markdown formatting or additional text. Return an empty array [] if no critical information is missing."
-                },
-                {
-                    "role": "user",
-                    "content": prompt
-                }
-            ]
-            
+            # Try to parse the JSON
+            parsed_json = json.loads(cleaned_content)
+            return parsed_json
+        except json.JSONDecodeError:
+            # If JSON parsing fails, return the raw response for debugging
+            self._forget_response(messages)
+            return [{
+                "question": "Error parsing AI response",
+                "why_needed": "Debug information",
+                "section": "Debug",
+                "based_on": "Raw response: " + content
+            }]
+
+    @staticmethod
+    def _is_empty_response(error: Exception) -> bool:
+        # An empty response means the model has no more questions
+        if isinstance(error, ValueError) and "Empty response from API" in str(error):
+            print("Empty API response - interpreting as no more questions needed")
+            return True
+        return False
+
+    def get_follow_up_questions(self, project_name: str, current_info: Dict, use_cache: bool = True) -> List[Dict]:
+        """Determine what additional information is needed based on current responses.
+
+        Identical requests are answered from the response cache unless use_cache is False.
+        """
+        try:
+            messages = self._follow_up_messages(project_name, current_info)
             try:
-                content = self._make_api_call(messages)
-                print(f"Raw follow-up response:\n{content}")  # Debug print
+                content = self._make_api_call(messages, use_cache=use_cache, operation="follow_up")
             except ValueError as e:
-                if "Empty response from API" in str(e):
-                    # If we get an empty response, assume no more questions are needed
-                    print("Empty API response - interpreting as no more questions needed")
+                if self._is_empty_response(e):
                     return []
                 raise
-            
-            # Clean up the response if it contains markdown code blocks
-            cleaned_content = content.strip()
-            if cleaned_content.startswith('```json'):
-                cleaned_content = cleaned_content[7:]
-            elif cleaned_content.startswith('```'):
-                cleaned_content = cleaned_content[3:]
-            if cleaned_content.endswith('```'):
-                cleaned_content = cleaned_content[:-3]
-            cleaned_content = cleaned_content.strip()
-            
-            # If we get an empty string or just whitespace, return empty array
-            if not cleaned_content:
-                print("Empty content - interpreting as no more questions needed")
-                return []
-            
-            try:
-                # Try to parse the JSON
-                parsed_json = json.loads(cleaned_content)
-                return parsed_json
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return the raw response for debugging
-                return [{
-                    "question": "Error parsing AI response",
-                    "why_needed": "Debug information",
-                    "section": "Debug",
-                    "based_on": "Raw response: " + content
-                }]
-            
+            return self._parse_follow_up(content, messages)
         except Exception as e:
             print(f"Error getting follow-up questions: {str(e)}")
             raise
 
-    def generate_scope(self, project_name: str, project_info: Dict, model: str) -> Dict:
+    async def get_follow_up_questions_async(self, project_name: str, current_info: Dict,
+                                            use_cache: bool = True) -> List[Dict]:
+        """Async version of get_follow_up_questions, for use from an event loop."""
         try:
-            # Get the transcription and other info
-            transcription = project_info.get('transcription', '')
-            initial_questions = project_info.get('initial_questions', [])
-            context = self._load_context()
-
-            # Clean up project info
-            cleaned_info = {}
-            question_mapping = {str(i): q.get('question', '') for i, q in enumerate(initial_questions)}
-            for key, value in project_info.items():
-                if key.isdigit() and value.strip() and key in question_mapping:
-                    cleaned_info[question_mapping[key]] = value
-
-            # Single comprehensive prompt for a consistent, structured scope document
-            scope_prompt = f"""You are a professional scope document creator. Create a comprehensive, DETAILED scope document (minimum 2000 words) following a specific structure with the following information:
-
-PROJECT DETAILS:
+            messages = self._follow_up_messages(project_name, current_info)
+            try:
+                content = await self._make_api_call_async(messages, use_cache=use_cache, operation="follow_up")
+            except ValueError as e:
+                if self._is_empty_response(e):
+                    return []
+                raise
+            return self._parse_follow_up(content, messages)
+        except Exception as e:
+            print(f"Error getting follow-up questions: {str(e)}")
+            raise
+
+    def _project_details(self, project_name: str, project_info: Dict) -> str:
+        """The project details and examples every scope generation prompt is written from."""
+        # Get the transcription and other info
+        transcription = project_info.get('transcription', '')
+        initial_questions = project_info.get('initial_questions', [])
+
+        # Clean up project info
+        cleaned_info = {}
+        question_mapping = {str(i): q.get('question', '') for i, q in enumerate(initial_questions)}
+        for key, value in project_info.items():
+            if key.isdigit() and value.strip() and key in question_mapping:
+                cleaned_info[question_mapping[key]] = value
+
+        query = [project_name, transcription or '', *cleaned_info.keys(), *cleaned_info.values()]
+        context = self._load_context("\n".join(query))
+
+        return f"""PROJECT DETAILS:
 Project Name: {project_name}
 
 Meeting Transcription:
@@ -259,7 +386,17 @@ Questions and Answers:
 {json.dumps(cleaned_info, indent=2) if cleaned_info else "No additional information provided"}
 
 CONTEXT AND EXAMPLES:
-{context}
+{context}"""
+
+    @phase("prompt")
+    def _scope_messages(self, project_name: str, project_info: Dict) -> List[Dict]:
+        """Build the prompt messages that generate a scope document."""
+        details = self._project_details(project_name, project_info)
+
+        # Single comprehensive prompt for a consistent, structured scope document
+        scope_prompt = f"""You are a professional scope document creator. Create a comprehensive, DETAILED scope document (minimum 2000 words) following a specific structure with the following information:
+
+{details}
 
 REQUIRED STRUCTURE:
 The scope document MUST follow this exact structure:
@@ -329,52 +466,185 @@ EXAMPLE FORMAT:
 Follow the structure and level of detail shown in the examples provided in the context. The requirements should be highly detailed with multiple subsections like the game screen requirements example, and assumptions should be specific and technical like in the example.
 """
 
-            # Execute the scope creation
-            messages = [
-                {"role": "system", "content": "You are a professional scope writer who creates detailed, structured scope documents."},
-                {"role": "user", "content": scope_prompt}
-            ]
-            
-            # Get response
-            scope_response = self._make_api_call(messages, model=model)
-            
-            # Format the scope
-            formatted_scope = self._clean_and_format_scope(scope_response)
-            
-            # Generate a unique scope ID based on name and timestamp
-            timestamp = time.time()
-            formatted_time = time.strftime("%Y%m%d%H%M%S", time.localtime(timestamp))
-            scope_id = f"{project_name.replace(' ', '_').lower()}_{formatted_time}"
-            
-            # Save scope to JSON with version history
-            scope_data = {
-                "id": scope_id,
-                "project_name": project_name,
-                "project_info": project_info,
-                "scope": formatted_scope,
-                "date_created": timestamp,
-                "formatted_date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp)),
-                "version_history": []  # Initialize empty version history
-            }
-            
-            # Ensure the scopes directory exists
-            os.makedirs("scopes", exist_ok=True)
-            
-            # Save the scope as a JSON file
-            file_path = os.path.join("scopes", f"{scope_id}.json")
-            with open(file_path, "w") as f:
-                json.dump(scope_data, f, indent=4)
-                
-            return {"scope": formatted_scope, "id": scope_id}
+        return [
+            {"role": "system", "content": "You are a professional scope writer who creates detailed, structured scope documents."},
+            {"role": "user", "content": scope_prompt}
+        ]
+
+    def _save_generated_scope(self, project_name: str, project_info: Dict, scope_response: str) -> Dict:
+        """Format a generated scope and save it under a new ID."""
+        formatted_scope = self._clean_and_format_scope(scope_response)
+
+        # Generate a unique scope ID based on name and timestamp
+        timestamp = time.time()
+        formatted_time = time.strftime("%Y%m%d%H%M%S", time.localtime(timestamp))
+        scope_id = f"{project_name.replace(' ', '_').lower()}_{formatted_time}"
+
+        scope_data = {
+            "id": scope_id,
+            "project_name": project_name,
+            "project_info": project_info,
+            "scope": formatted_scope,
+            "date_created": timestamp,
+            "formatted_date": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(timestamp))
+        }
+
+        # Save the scope; its version history is kept separately by the store
+        with phase("save"):
+            self.store.create(scope_data)
+
+        return {"scope": formatted_scope, "id": scope_id}
+
+    def _generate_sectioned(self, project_name: str, project_info: Dict, model: str) -> str:
+        """Write a scope as an outline, then all of its sections at once, and merge them.
+
+        Takes about as long as the outline plus the longest section, instead of the whole
+        document. Falls back to a single call if the outline can't be parsed.
+        """
+        with phase("prompt"):
+            details = self._project_details(project_name, project_info)
+        content = self._make_api_call(outline_messages(details), model=model, operation="generate",
+                                      **OUTLINE_PARAMS)
+        try:
+            outline = parse_outline(content)
+        except ValueError as e:
+            print(f"Error parsing scope outline, generating in one call: {str(e)}")
+            return self._make_api_call(self._scope_messages(project_name, project_info), model=model,
+                                       operation="generate")
+
+        with phase("prompt"):
+            sections = section_messages(details, outline)
+        with ThreadPoolExecutor(max_workers=len(sections)) as pool:
+            # Run each section in a copy of this context, so its tokens and timings are still tracked
+            futures = {name: pool.submit(contextvars.copy_context().run, self._make_api_call, messages, model=model,
+                                         operation="generate", **params)
+                       for name, messages, params in sections}
+            texts = {name: future.result() for name, future in futures.items()}
+        return merge_sections(project_name, outline, texts)
+
+    async def _generate_sectioned_async(self, project_name: str, project_info: Dict, model: str) -> str:
+        """Async version of _generate_sectioned."""
+        with phase("prompt"):
+            details = self._project_details(project_name, project_info)
+        content = await self._make_api_call_async(outline_messages(details), model=model, operation="generate",
+                                                  **OUTLINE_PARAMS)
+        try:
+            outline = parse_outline(content)
+        except ValueError as e:
+            print(f"Error parsing scope outline, generating in one call: {str(e)}")
+            return await self._make_api_call_async(self._scope_messages(project_name, project_info), model=model,
+                                                   operation="generate")
+
+        with phase("prompt"):
+            sections = section_messages(details, outline)
+        results = await asyncio.gather(*(self._make_api_call_async(messages, model=model, operation="generate",
+                                                                   **params)
+                                         for _, messages, params in sections))
+        return merge_sections(project_name, outline, {name: text for (name, _, _), text in zip(sections, results)})
+
+    def _generate_and_save(self, project_name: str, project_info: Dict, model: str,
+                           mode: Optional[str] = None) -> Dict:
+        if (mode or SCOPE_GENERATION_MODE) == "sectioned":
+            scope_response = self._generate_sectioned(project_name, project_info, model)
+        else:
+            messages = self._scope_messages(project_name, project_info)
+            scope_response = self._make_api_call(messages, model=model, operation="generate")
+        return self._save_generated_scope(project_name, project_info, scope_response)
+
+    async def _generate_and_save_async(self, project_name: str, project_info: Dict, model: str,
+                                       mode: Optional[str] = None) -> Dict:
+        if (mode or SCOPE_GENERATION_MODE) == "sectioned":
+            scope_response = await self._generate_sectioned_async(project_name, project_info, model)
+        else:
+            messages = self._scope_messages(project_name, project_info)
+            scope_response = await self._make_api_call_async(messages, model=model, operation="generate")
+        return self._save_generated_scope(project_name, project_info, scope_response)
+
+    def generate_scope(self, project_name: str, project_info: Dict, model: str,
+                       request_key: Optional[str] = None, mode: Optional[str] = None) -> Dict:
+        """Generate and save a scope document.
+
+        mode is "single" or "sectioned" and defaults to SCOPE_GENERATION_MODE. Calls with
+        the same client-supplied request_key generate the scope once: repeats made while it
+        is being generated, or within GENERATION_REMEMBER seconds after, return the same
+        scope and ID.
+        """
+        try:
+            if request_key:
+                return self.generations.do(
+                    request_key, lambda: self._generate_and_save(project_name, project_info, model, mode))
+            return self._generate_and_save(project_name, project_info, model, mode)
             
+        except RetryLaterError as e:
+            return {"error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            print(f"Error generating scope: {str(e)}")
+            # Another attempt at a request the API rejected would be rejected again
+            return {"error": "Failed to generate scope document", "retryable": not is_rejected(e)}
+
+    async def generate_scope_async(self, project_name: str, project_info: Dict, model: str,
+                                   request_key: Optional[str] = None, mode: Optional[str] = None) -> Dict:
+        """Async version of generate_scope, for use from an event loop."""
+        try:
+            if request_key:
+                return await self.generations.do_async(
+                    request_key, lambda: self._generate_and_save_async(project_name, project_info, model, mode))
+            return await self._generate_and_save_async(project_name, project_info, model, mode)
+        except RetryLaterError as e:
+            return {"error": str(e), "retry_after": e.retry_after}
+        except Exception as e:
+            print(f"Error generating scope: {str(e)}")
+            # Another attempt at a request the API rejected would be rejected again
+            return {"error": "Failed to generate scope document", "retryable": not is_rejected(e)}
+
+    def generate_scope_stream(self, project_name: str, project_info: Dict, model: str,
+                              request_key: Optional[str] = None) -> Iterator[Tuple[str, object]]:
+        """Generate a scope, yielding ("delta", text) as the completion arrives.
+
+        Ends with ("done", {"scope", "id"}) once the full scope is formatted and saved, or
+        with ("error", message). A repeat of a request_key that is already being generated,
+        or was recently, waits for that scope and only yields "done".
+        """
+        future, leader = self.generations.begin(request_key) if request_key else (None, True)
+        if not leader:
+            try:
+                yield "done", future.result()
+            except Exception as e:
+                print(f"Error generating scope: {str(e)}")
+                yield "error", "Failed to generate scope document"
+            return
+
+        result, error = None, None
+        try:
+            messages = self._scope_messages(project_name, project_info)
+            parts = []
+            for text in self._stream_api_call(messages, model=model, operation="generate"):
+                parts.append(text)
+                yield "delta", text
+            result = self._save_generated_scope(project_name, project_info, "".join(parts))
+        except GeneratorExit:
+            # The client went away mid-stream; let anyone waiting on this key retry
+            error = RuntimeError("Scope generation was interrupted")
+            raise
         except Exception as e:
+            error = e
             print(f"Error generating scope: {str(e)}")
-            return {"error": "Failed to generate scope document"}
+        finally:
+            if future is not None:
+                self.generations.finish(request_key, future, result, error)
+
+        if error is None:
+            yield "done", result
+        elif isinstance(error, RetryLaterError):
+            yield "error", str(error)
+        else:
+            yield "error", "Failed to generate scope document"
 
     def get_ai_response(self, prompt, model):
         # Implement AI model interaction here
         pass
 
+    @phase("format")
     def _clean_and_format_scope(self, scope):
         """Clean and format the scope document for better presentation"""
         # Remove any potential system messages or prefixes
@@ -435,169 +705,50 @@ Follow the structure and level of detail shown in the examples provided in the c
         
         return '\n'.join(formatted_lines).strip()
         
-    def list_saved_scopes(self) -> List[Dict]:
-        """List all saved scopes with basic information."""
-        scopes = []
-        scopes_dir = Path("scopes")
+    def list_saved_scopes(self, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """List saved scopes with basic information, newest first, optionally one page at a time."""
+        return self.store.list(limit, offset)
         
-        if not scopes_dir.exists():
-            return []
-            
-        for file_path in scopes_dir.glob("*.json"):
-            try:
-                with open(file_path, 'r') as f:
-                    data = json.load(f)
-                    # Extract just the data we need for listing
-                    scopes.append({
-                        "id": data.get("id", "Unknown Scope"),
-                        "project_name": data.get("project_name", "Unknown Project"),
-                        "date_created": data.get("date_created", 0),
-                        "formatted_date": data.get("formatted_date", "Unknown Date"),
-                        "file_name": file_path.name
-                    })
-            except Exception as e:
-                print(f"Error reading scope file {file_path}: {str(e)}")
-                
-        # Sort by date created (newest first)
-        scopes.sort(key=lambda x: x["date_created"], reverse=True)
-        return scopes
+    def search_scopes(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """Search saved scopes by project name, scope text and answers, best matches first."""
+        return self.store.search(query, limit, offset)
         
-    def get_saved_scope(self, scope_id: str) -> Optional[Dict]:
-        """Get a specific saved scope by ID."""
-        file_path = Path(f"scopes/{scope_id}.json")
+    def resolve_scope_id(self, partial_id: str) -> Optional[str]:
+        """Find the saved scope ID that matches partial_id exactly, by prefix or by substring."""
+        return self.store.resolve_id(partial_id)
         
-        if not file_path.exists():
-            return None
-            
-        try:
-            with open(file_path, 'r') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Error reading scope file {file_path}: {str(e)}")
-            return None
+    def get_saved_scope(self, scope_id: str) -> Optional[Dict]:
+        """Get a specific saved scope by ID, without its version history."""
+        return self.store.get(scope_id)
             
     def update_saved_scope(self, scope_id: str, updated_data: Dict) -> bool:
         """Update a saved scope with edited data and maintain version history."""
-        file_path = Path(f"scopes/{scope_id}.json")
-        
-        if not file_path.exists():
-            return False
-            
-        try:
-            # Read existing data first to preserve structure
-            with open(file_path, 'r') as f:
-                existing_data = json.load(f)
-                
-            # Create version history array if it doesn't exist
-            if "version_history" not in existing_data:
-                existing_data["version_history"] = []
-                
-            # Add current version to history before updating
-            current_timestamp = time.time()
-            current_version = {
-                "timestamp": current_timestamp,
-                "formatted_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current_timestamp)),
-                "project_name": existing_data.get("project_name", ""),
-                "scope": existing_data.get("scope", "")
-            }
-            
-            # Only add to history if content actually changed
-            latest_scope = existing_data.get("scope", "")
-            new_scope = updated_data.get("scope", "")
-            if latest_scope != new_scope or existing_data.get("project_name", "") != updated_data.get("project_name", ""):
-                existing_data["version_history"].append(current_version)
-            
-            # Update with new data
-            if "project_name" in updated_data:
-                existing_data["project_name"] = updated_data["project_name"]
-            if "project_info" in updated_data:
-                existing_data["project_info"] = updated_data["project_info"]
-            if "scope" in updated_data:
-                existing_data["scope"] = updated_data["scope"]
-                
-            # Write the updated data back
-            with open(file_path, 'w') as f:
-                json.dump(existing_data, f, indent=4)
-                
-            return True
-        except Exception as e:
-            print(f"Error updating scope file {file_path}: {str(e)}")
-            return False
+        return self.store.update(scope_id, updated_data)
             
     def get_scope_history(self, scope_id: str) -> List[Dict]:
-        """Get the version history of a scope."""
-        file_path = Path(f"scopes/{scope_id}.json")
-        
-        if not file_path.exists():
-            return []
+        """Get the version history of a scope, without the text of each version."""
+        return self.store.history(scope_id)
             
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
-            return data.get("version_history", [])
-        except Exception as e:
-            print(f"Error reading scope history {file_path}: {str(e)}")
-            return []
+    def find_version_id(self, scope_id: str, version_timestamp: float) -> Optional[int]:
+        """Get the number of the version saved at the given timestamp."""
+        return self.store.find_version_id(scope_id, version_timestamp)
             
-    def restore_scope_version(self, scope_id: str, version_timestamp: float) -> bool:
-        """Restore a scope to a previous version from history."""
-        file_path = Path(f"scopes/{scope_id}.json")
-        
-        if not file_path.exists():
-            return False
-            
-        try:
-            with open(file_path, 'r') as f:
-                data = json.load(f)
-                
-            history = data.get("version_history", [])
+    def get_scope_version(self, scope_id: str, version_id: int) -> Optional[Dict]:
+        """Get a single version of a scope, with its text rebuilt from the history."""
+        return self.store.version(scope_id, version_id)
             
-            # Find the version with the matching timestamp
-            version_to_restore = None
-            for version in history:
-                if version.get("timestamp") == version_timestamp:
-                    version_to_restore = version
-                    break
-                    
-            if not version_to_restore:
-                return False
-                
-            # Create a new history entry for the current version before restoring
-            current_timestamp = time.time()
-            current_version = {
-                "timestamp": current_timestamp,
-                "formatted_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current_timestamp)),
-                "project_name": data.get("project_name", ""),
-                "scope": data.get("scope", ""),
-                "is_restore_point": True,
-                "restored_from": version_timestamp
-            }
-            
-            # Add current version to history
-            history.append(current_version)
-            
-            # Restore the old version data
-            data["project_name"] = version_to_restore.get("project_name", data.get("project_name", ""))
-            data["scope"] = version_to_restore.get("scope", data.get("scope", ""))
-            
-            # Add restoration note
-            restore_note = {
-                "timestamp": time.time(),
-                "formatted_time": time.strftime("%Y-%m-%d %H:%M:%S"),
-                "message": f"Restored to version from {version_to_restore.get('formatted_time')}"
-            }
-            
-            if "restoration_notes" not in data:
-                data["restoration_notes"] = []
-                
-            data["restoration_notes"].append(restore_note)
-            
-            # Write the updated data back
-            with open(file_path, 'w') as f:
-                json.dump(data, f, indent=4)
-                
-            return True
-        except Exception as e:
-            print(f"Error restoring scope version {file_path}: {str(e)}")
-            return False
+    def restore_scope_version(self, scope_id: str, version_id: int) -> bool:
+        """Restore a scope to a previous version from history."""
+        return self.store.restore(scope_id, version_id)
+
+    def get_cache_stats(self) -> Dict:
+        """Hit, miss and size counters of the storage backend's cache, if it has one."""
+        return self.store.cache_stats()
+
+    def get_transport_stats(self) -> Dict:
+        """State of the circuit breaker in front of the model API and the tokens used so far."""
+        return self.transport.stats()
+
+    def get_response_cache_stats(self) -> Dict:
+        """Hit, miss and size counters of the LLM response cache."""
+        return self.response_cache.stats() if self.response_cache is not None else {}
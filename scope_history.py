@@ -0,0 +1,72 @@
+import os
+from difflib import SequenceMatcher
+from typing import Dict, List
+
+# A full copy of the scope is stored every SNAPSHOT_INTERVAL versions; the rest are diffs
+SNAPSHOT_INTERVAL = int(os.getenv("SCOPE_SNAPSHOT_INTERVAL", "20"))
+
+
+def make_delta(old: str, new: str) -> List:
+    """Build a line-based delta that turns old into new.
+
+    The delta is a list where [start, end] copies lines start:end of the old text
+    and a string inserts new text.
+    """
+    old_lines = old.splitlines(keepends=True)
+    new_lines = new.splitlines(keepends=True)
+    delta = []
+    matcher = SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            delta.append([i1, i2])
+        elif j2 > j1:
+            delta.append(''.join(new_lines[j1:j2]))
+    return delta
+
+
+def apply_delta(old: str, delta: List) -> str:
+    """Rebuild the new text from the old text and a delta made by make_delta."""
+    old_lines = old.splitlines(keepends=True)
+    parts = []
+    for op in delta:
+        if isinstance(op, str):
+            parts.append(op)
+        else:
+            parts.extend(old_lines[op[0]:op[1]])
+    return ''.join(parts)
+
+
+def _last_snapshot_index(history: List[Dict], index: int) -> int:
+    while index > 0 and "scope" not in history[index]:
+        index -= 1
+    return index
+
+
+def reconstruct_scope(history: List[Dict], index: int) -> str:
+    """Rebuild the scope text of history[index] from the nearest snapshot."""
+    start = _last_snapshot_index(history, index)
+    scope = history[start].get("scope", "")
+    for entry in history[start + 1:index + 1]:
+        scope = apply_delta(scope, entry.get("delta", []))
+    return scope
+
+
+def append_version(history: List[Dict], entry: Dict, scope: str, snapshot_interval: int = SNAPSHOT_INTERVAL):
+    """Append a version to history, storing either a snapshot or a diff against the previous version."""
+    entry = {k: v for k, v in entry.items() if k not in ("scope", "delta")}
+    if not history or len(history) - _last_snapshot_index(history, len(history) - 1) >= snapshot_interval:
+        entry["scope"] = scope
+    else:
+        entry["delta"] = make_delta(reconstruct_scope(history, len(history) - 1), scope)
+    history.append(entry)
+
+
+def version_metadata(entry: Dict) -> Dict:
+    """Return a history entry without its stored text."""
+    return {k: v for k, v in entry.items() if k not in ("scope", "delta")}
+
+
+def timestamp_key(timestamp: float) -> str:
+    """Normalize a version timestamp so values parsed back from URLs still match."""
+    return f"{float(timestamp):.6f}"
+
@@ -0,0 +1,118 @@
+import bisect
+import re
+import threading
+import time
+from typing import Callable, Iterable, Optional, Set
+
+_TIMESTAMP_SUFFIX = re.compile(r"_(\d{14})$")
+
+
+def _recency_key(scope_id: str):
+    """Sort key that puts the most recently generated scope ID last."""
+    match = _TIMESTAMP_SUFFIX.search(scope_id)
+    return (match.group(1) if match else "", scope_id)
+
+
+class ScopeIdIndex:
+    """In-memory prefix and substring index of the scope IDs in the scopes directory.
+
+    Built by scan from directory entries only, so resolving an ID never opens a scope file.
+    Writes in this process update it directly; changes made by other processes are picked
+    up by rescanning when change_token returns something new, checked at most once per
+    rescan_interval.
+    """
+
+    def __init__(self, scan: Callable[[], Iterable[str]], change_token: Callable[[], object],
+                 rescan_interval: float = 5.0):
+        self.scan = scan
+        self.change_token = change_token
+        self.rescan_interval = rescan_interval
+        self._lock = threading.Lock()
+        self._ids = []
+        self._trigrams = {}
+        self._token = None
+        self._scanned_at = 0.0
+        self._scan()
+
+    @staticmethod
+    def _trigrams_of(text: str) -> Set[str]:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def _scan(self):
+        token = self.change_token()
+        ids = list(self.scan())
+
+        trigrams = {}
+        for scope_id in ids:
+            for trigram in self._trigrams_of(scope_id):
+                trigrams.setdefault(trigram, set()).add(scope_id)
+
+        with self._lock:
+            self._ids = sorted(ids)
+            self._trigrams = trigrams
+            self._token = token
+            self._scanned_at = time.monotonic()
+
+    def _refresh_if_changed(self):
+        if time.monotonic() - self._scanned_at < self.rescan_interval:
+            return
+        if self.change_token() != self._token:
+            self._scan()
+        else:
+            self._scanned_at = time.monotonic()
+
+    def add(self, scope_id: str):
+        with self._lock:
+            position = bisect.bisect_left(self._ids, scope_id)
+            if position < len(self._ids) and self._ids[position] == scope_id:
+                return
+            self._ids.insert(position, scope_id)
+            for trigram in self._trigrams_of(scope_id):
+                self._trigrams.setdefault(trigram, set()).add(scope_id)
+
+    def remove(self, scope_id: str):
+        with self._lock:
+            position = bisect.bisect_left(self._ids, scope_id)
+            if position < len(self._ids) and self._ids[position] == scope_id:
+                del self._ids[position]
+            for trigram in self._trigrams_of(scope_id):
+                self._trigrams.get(trigram, set()).discard(scope_id)
+
+    def __contains__(self, scope_id: str) -> bool:
+        with self._lock:
+            position = bisect.bisect_left(self._ids, scope_id)
+            return position < len(self._ids) and self._ids[position] == scope_id
+
+    def _lookup(self, partial_id: str) -> Optional[str]:
+        with self._lock:
+            position = bisect.bisect_left(self._ids, partial_id)
+            if position < len(self._ids) and self._ids[position] == partial_id:
+                return partial_id
+
+            # Prefer IDs that start with the partial ID, then any ID that contains it
+            end = bisect.bisect_right(self._ids, partial_id + "\U0010ffff", position)
+            candidates = self._ids[position:end]
+
+            if not candidates and len(partial_id) >= 3:
+                postings = [self._trigrams.get(t, set()) for t in self._trigrams_of(partial_id)]
+                postings.sort(key=len)
+                matches = set(postings[0]).intersection(*postings[1:])
+                candidates = [scope_id for scope_id in matches if partial_id in scope_id]
+            elif not candidates:
+                # Too short for the trigram index
+                candidates = [scope_id for scope_id in self._ids if partial_id in scope_id]
+
+        if not candidates:
+            return None
+        return max(candidates, key=_recency_key)
+
+    def resolve(self, partial_id: str) -> Optional[str]:
+        """Return the saved scope ID matching partial_id exactly, by prefix or by substring.
+
+        When several IDs match, the most recently generated one wins. Substrings of at least
+        three characters are looked up in the trigram index; shorter ones scan every ID.
+        """
+        if not partial_id:
+            return None
+        self._refresh_if_changed()
+        return self._lookup(partial_id)
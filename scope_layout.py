@@ -0,0 +1,142 @@
+import gzip
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Iterator
+
+try:
+    import zstandard
+except ImportError:  # zstd compression is optional
+    zstandard = None
+
+LAYOUTS = ("flat", "sharded")
+COMPRESSIONS = ("none", "gzip", "zstd")
+SUFFIXES = {"none": ".json", "gzip": ".json.gz", "zstd": ".json.zst"}
+
+# Records the format of an existing scopes directory, so switching needs an explicit conversion
+CONFIG_FILE = "storage.json"
+
+
+class ScopeLayout:
+    """Where scope files live in the scopes directory and how they are encoded.
+
+    The flat layout keeps every head record directly in scopes/. The sharded layout spreads
+    them over 256 subdirectories named after the first two hex digits of a hash of the ID,
+    and does the same for history and lock files. Files can be stored as pretty-printed
+    JSON, or as compact JSON compressed with gzip or zstd.
+    """
+
+    def __init__(self, scopes_dir: str = "scopes", layout: str = "flat", compression: str = "none"):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown scope storage layout '{layout}', expected one of {', '.join(LAYOUTS)}")
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown scope compression '{compression}', expected one of {', '.join(COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package (pip install zstandard)")
+        self.scopes_dir = Path(scopes_dir)
+        self.layout = layout
+        self.compression = compression
+        self.suffix = SUFFIXES[compression]
+
+    @classmethod
+    def load(cls, scopes_dir: str = "scopes") -> "ScopeLayout":
+        """Read the format of a scopes directory.
+
+        An existing directory keeps the format recorded in storage.json, or the flat
+        uncompressed format if it predates that file. The SCOPE_STORAGE_LAYOUT and
+        SCOPE_COMPRESSION environment variables choose the format of a new directory.
+        """
+        scopes_dir = Path(scopes_dir)
+        config_path = scopes_dir / CONFIG_FILE
+        if config_path.exists():
+            with open(config_path, 'r') as f:
+                config = json.load(f)
+            return cls(str(scopes_dir), config.get("layout", "flat"), config.get("compression", "none"))
+
+        requested = cls(str(scopes_dir),
+                        os.getenv("SCOPE_STORAGE_LAYOUT", "flat"),
+                        os.getenv("SCOPE_COMPRESSION", "none"))
+        current = cls(str(scopes_dir))
+        if (requested.layout, requested.compression) == ("flat", "none"):
+            return current
+        if any(current.iter_head_paths()):
+            print(f"Warning: {scopes_dir} holds scopes in the flat layout; run "
+                  f"'python scope_store.py convert --layout {requested.layout} "
+                  f"--compression {requested.compression}' to switch")
+            return current
+        requested.save()
+        return requested
+
+    def save(self):
+        """Record this format in the scopes directory."""
+        self.scopes_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.scopes_dir / CONFIG_FILE, 'w') as f:
+            json.dump({"layout": self.layout, "compression": self.compression}, f, indent=4)
+
+    def _shard(self, scope_id: str) -> str:
+        return hashlib.sha1(scope_id.encode('utf-8')).hexdigest()[:2]
+
+    def _base(self, root: Path, scope_id: str) -> Path:
+        return root / self._shard(scope_id) if self.layout == "sharded" else root
+
+    def head_path(self, scope_id: str) -> Path:
+        return self._base(self.scopes_dir, scope_id) / f"{scope_id}{self.suffix}"
+
+    def history_dir(self, scope_id: str) -> Path:
+        return self._base(self.scopes_dir / "history", scope_id) / scope_id
+
+    def history_file(self, scope_id: str, name: str) -> Path:
+        return self.history_dir(scope_id) / f"{name}{self.suffix}"
+
+    def lock_path(self, scope_id: str) -> Path:
+        return self._base(self.scopes_dir / "locks", scope_id) / f"{scope_id}.lock"
+
+    def iter_head_paths(self) -> Iterator[Path]:
+        """Yield the path of every head record, reading directory entries only."""
+        if self.layout == "flat":
+            directories = [self.scopes_dir]
+        else:
+            directories = [self.scopes_dir / f"{i:02x}" for i in range(256)]
+        for directory in directories:
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if (entry.name.endswith(self.suffix) and not entry.name.startswith(".")
+                                and entry.name != CONFIG_FILE):
+                            yield Path(entry.path)
+            except FileNotFoundError:
+                continue
+
+    def scope_id_from_path(self, path: Path) -> str:
+        return path.name[:-len(self.suffix)]
+
+    def dump(self, data) -> bytes:
+        """The JSON of data before compression."""
+        if self.compression == "none":
+            return json.dumps(data, indent=4).encode('utf-8')
+        return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+    def compress(self, payload: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(payload, compresslevel=6)
+        if self.compression == "zstd":
+            return zstandard.ZstdCompressor(level=3).compress(payload)
+        return payload
+
+    def decompress(self, raw: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.decompress(raw)
+        if self.compression == "zstd":
+            return zstandard.ZstdDecompressor().decompress(raw)
+        return raw
+
+    def encode(self, data) -> bytes:
+        return self.compress(self.dump(data))
+
+    def decode(self, raw: bytes):
+        return json.loads(self.decompress(raw))
+
+    def read(self, path: Path):
+        with open(path, 'rb') as f:
+            return self.decode(f.read())
@@ -0,0 +1,187 @@
+import json
+import os
+import re
+import time
+from typing import Dict, List, Tuple
+
+# Most Requirements categories a sectioned scope is split into, one model call each
+SCOPE_MAX_SECTIONS = int(os.getenv("SCOPE_MAX_SECTIONS", "8"))
+
+# Output budgets of the calls that make up a sectioned scope
+OUTLINE_PARAMS = {"temperature": 0.4, "max_tokens": 1500}
+PURPOSE_PARAMS = {"temperature": 0.7, "max_tokens": 1200}
+REQUIREMENTS_PARAMS = {"temperature": 0.7, "max_tokens": 3000}
+ASSUMPTIONS_PARAMS = {"temperature": 0.7, "max_tokens": 1500}
+
+SYSTEM_MESSAGE = "You are a professional scope writer who creates detailed, structured scope documents."
+
+FORMATTING = """FORMATTING:
+1. Use Markdown formatting
+2. Do NOT repeat the section heading; it is added for you. Start directly with the content
+3. Use #### for sub-subsections
+4. Use numbered lists for individual items (1., 2., 3., etc.)
+5. Use bullet points for descriptive lists
+6. Use bold for emphasis on key points
+7. Return only the section text, no code blocks or commentary"""
+
+
+def _messages(prompt: str) -> List[Dict]:
+    return [
+        {"role": "system", "content": SYSTEM_MESSAGE},
+        {"role": "user", "content": prompt}
+    ]
+
+
+def _outline_text(outline: Dict) -> str:
+    lines = [f"Summary: {outline['summary']}", "", "Requirements categories:"]
+    for i, category in enumerate(outline["requirement_categories"], 1):
+        lines.append(f"{i}. {category['title']}: {', '.join(category['covers'])}")
+    if outline["assumption_topics"]:
+        lines += ["", "Assumption topics: " + ", ".join(outline["assumption_topics"])]
+    return "\n".join(lines)
+
+
+def outline_messages(details: str) -> List[Dict]:
+    """Prompt for the outline that every section of a sectioned scope is written from."""
+    return _messages(f"""You are planning a comprehensive scope document. Other writers will write each section
+in parallel from your outline, so it must divide the work cleanly: every requirement belongs to exactly one
+category and categories must not overlap.
+
+{details}
+
+Return a JSON object with:
+1. "summary": two or three sentences on what the project is and what it must achieve
+2. "requirement_categories": 3 to {SCOPE_MAX_SECTIONS} logical categories of requirements for this project type,
+   each {{"title": "Category name", "covers": ["topic", "topic", ...]}} listing what that category must specify
+3. "assumption_topics": 5 to 7 project-specific technical areas the Assumptions section should address
+
+Return ONLY the JSON object, no markdown code blocks or additional text.""")
+
+
+def parse_outline(content: str) -> Dict:
+    """Parse an outline response; raises ValueError if it is not a usable outline."""
+    cleaned = content.strip()
+    if cleaned.startswith('```'):
+        cleaned = cleaned.split('\n', 1)[1] if '\n' in cleaned else ''
+    if cleaned.endswith('```'):
+        cleaned = cleaned[:-3]
+    try:
+        data = json.loads(cleaned.strip())
+    except json.JSONDecodeError as e:
+        raise ValueError(f"Outline is not valid JSON: {e}")
+    if not isinstance(data, dict):
+        raise ValueError("Outline is not a JSON object")
+
+    categories = []
+    for category in _list(data, "requirement_categories"):
+        if isinstance(category, str):
+            category = {"title": category}
+        title = str(category.get("title", "")).strip() if isinstance(category, dict) else ""
+        if title:
+            categories.append({"title": title, "covers": [str(topic) for topic in _list(category, "covers")]})
+    if not categories:
+        raise ValueError("Outline has no requirement categories")
+
+    return {
+        "summary": str(data.get("summary", "")).strip(),
+        "requirement_categories": categories[:SCOPE_MAX_SECTIONS],
+        "assumption_topics": [str(topic) for topic in _list(data, "assumption_topics")]
+    }
+
+
+def _list(data: Dict, key: str) -> List:
+    """The list at data[key], empty if missing; raises ValueError if it is something else."""
+    value = data.get(key) or []
+    if not isinstance(value, list):
+        raise ValueError(f"Outline {key} is not a list")
+    return value
+
+
+def section_messages(details: str, outline: Dict) -> List[Tuple[str, List[Dict], Dict]]:
+    """The calls that write a scope from its outline, as (section, messages, params).
+
+    Sections are "purpose", "assumptions" and "requirements:<n>" for the n-th category.
+    They are independent of each other and can be requested concurrently.
+    """
+    shared = f"""{details}
+
+DOCUMENT OUTLINE (written by the lead writer; other sections are being written from it at the same time):
+{_outline_text(outline)}
+
+The meeting transcription and answered questions are your PRIMARY sources - use ALL details from them that
+belong in your section. Never say "insufficient information" - use what's known or make reasonable
+project-specific assumptions. Stay within your section; do not write content that belongs to another one."""
+
+    sections = [("purpose", _messages(f"""You are writing the "Project Purpose" section of a scope document.
+
+{shared}
+
+Write 200-300 words covering:
+- Clear statement of what this project aims to accomplish
+- Business justification and value
+- Specific goals and objectives
+- Success criteria where applicable
+
+{FORMATTING}"""), PURPOSE_PARAMS)]
+
+    categories = outline["requirement_categories"]
+    for i, category in enumerate(categories, 1):
+        covers = ", ".join(category["covers"]) or "everything this category implies for the project"
+        sections.append((f"requirements:{i}", _messages(f"""You are writing requirements category {i} of {len(categories)},
+"{category['title']}", in the Requirements section of a scope document.
+
+{shared}
+
+This category covers: {covers}
+
+Write {max(200, 1500 // len(categories))}+ words of requirements for this category only:
+- Each requirement MUST be extremely detailed, clear, specific, and measurable
+- Include specific technical details, measurements, and parameters where available
+- Group related requirements under #### sub-subsections where useful
+- At least 3-5 specific requirements, as numbered lists
+- Requirements should be specific, measurable, achievable, relevant, and time-bound (SMART)
+- When describing features or functionality, explain HOW they should work in detail
+
+{FORMATTING}"""), REQUIREMENTS_PARAMS))
+
+    topics = ", ".join(outline["assumption_topics"]) or "the technical areas of the requirements"
+    sections.append(("assumptions", _messages(f"""You are writing the "Assumptions" section of a scope document.
+
+{shared}
+
+Write 300+ words: at least 5-7 specific, project-relevant assumptions as a numbered list, covering: {topics}
+- Base assumptions on the actual project details, NOT generic statements
+- Focus on technical constraints, design limitations, and project-specific factors
+- Include assumptions about tools, technologies, and implementation details
+- Avoid generic assumptions like "client will provide requirements in a timely manner"
+- Model your assumptions after the example provided, which are specific and technical
+
+{FORMATTING}"""), ASSUMPTIONS_PARAMS))
+    return sections
+
+
+def _section_body(text: str) -> str:
+    """Strip code fences and any section heading the model repeated at the top of a section.
+
+    Only headings of level 3 or above are stripped; the #### sub-subsections a section
+    may start with are its own content.
+    """
+    text = text.strip()
+    fenced = re.match(r"^```[a-zA-Z]*\n(.*?)\n?```$", text, re.DOTALL)
+    if fenced:
+        text = fenced.group(1).strip()
+    lines = text.split('\n')
+    while lines and (re.match(r"^#{1,3}(\s|$)", lines[0]) or not lines[0].strip()):
+        lines.pop(0)
+    return '\n'.join(lines).strip()
+
+
+def merge_sections(project_name: str, outline: Dict, sections: Dict[str, str]) -> str:
+    """Assemble generated sections into one scope document, in document order."""
+    parts = [f"# {project_name}", time.strftime("%B %Y"),
+             "## Project Purpose", _section_body(sections["purpose"]),
+             "## Requirements"]
+    for i, category in enumerate(outline["requirement_categories"], 1):
+        parts += [f"### {i}. {category['title']}", _section_body(sections[f"requirements:{i}"])]
+    parts += ["## Assumptions", _section_body(sections["assumptions"])]
+    return "\n\n".join(parts)
@@ -0,0 +1,554 @@
+import argparse
+import json
+import os
+import time
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from fileio import atomic_write, file_lock
+from metrics import SCOPE_FILE_SECONDS, storage_timed
+from scope_cache import ScopeCache
+from scope_catalog import ScopeCatalog
+from scope_ids import ScopeIdIndex
+from scope_layout import COMPRESSIONS, LAYOUTS, ScopeLayout
+from scope_history import SNAPSHOT_INTERVAL, append_version, reconstruct_scope, timestamp_key, version_metadata
+
+
+# Which ScopeStore implementation open_store() returns: "file" or "sqlite"
+STORAGE_BACKEND = os.getenv("SCOPE_STORAGE_BACKEND", "file")
+SQLITE_PATH = os.getenv("SCOPE_SQLITE_PATH", "scopes/scopes.sqlite3")
+
+
+class ScopeStore(ABC):
+    """Interface of a saved scope storage backend.
+
+    Scopes are dictionaries with id, project_name, project_info, scope, date_created and
+    formatted_date. Every update or restore records the previous text as a numbered version
+    (numbered from 1 in save order), and listing and search return catalog rows rather than
+    full documents. Methods return None, False or an empty list when a scope is missing or
+    storage fails, after printing the error.
+    """
+
+    @abstractmethod
+    def create(self, scope_data: Dict):
+        """Save a newly generated scope."""
+
+    @abstractmethod
+    def get(self, scope_id: str) -> Optional[Dict]:
+        """Get the current document of a scope without its history."""
+
+    @abstractmethod
+    def update(self, scope_id: str, updated_data: Dict) -> bool:
+        """Update a saved scope with edited data and maintain version history."""
+
+    @abstractmethod
+    def list(self, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """List saved scopes with basic information, newest first."""
+
+    @abstractmethod
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """Full-text search over saved scopes, best matches first."""
+
+    @abstractmethod
+    def resolve_id(self, partial_id: str) -> Optional[str]:
+        """Find the saved scope ID that matches partial_id exactly, by prefix or by substring."""
+
+    @abstractmethod
+    def history(self, scope_id: str) -> List[Dict]:
+        """Get the version history of a scope, without the text of each version."""
+
+    @abstractmethod
+    def find_version_id(self, scope_id: str, version_timestamp: float) -> Optional[int]:
+        """Get the number of the version saved at the given timestamp."""
+
+    @abstractmethod
+    def version(self, scope_id: str, version_id: int) -> Optional[Dict]:
+        """Get a single version of a scope, with its text."""
+
+    @abstractmethod
+    def restore(self, scope_id: str, version_id: int) -> bool:
+        """Restore a scope to a previous version from history."""
+
+    def cache_stats(self) -> Dict:
+        """Statistics of the backend's in-process cache, if it has one."""
+        return {}
+
+    @staticmethod
+    def _version_entry(data: Dict, **extra) -> Dict:
+        """History entry recording the current state of a scope before it changes."""
+        current_timestamp = time.time()
+        entry = {
+            "timestamp": current_timestamp,
+            "formatted_time": time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(current_timestamp)),
+            "project_name": data.get("project_name", "")
+        }
+        entry.update(extra)
+        return entry
+
+    @staticmethod
+    def _is_changed(existing_data: Dict, updated_data: Dict) -> bool:
+        return (existing_data.get("scope", "") != updated_data.get("scope", "")
+                or existing_data.get("project_name", "") != updated_data.get("project_name", ""))
+
+    @staticmethod
+    def _apply_update(existing_data: Dict, updated_data: Dict):
+        for key in ("project_name", "project_info", "scope"):
+            if key in updated_data:
+                existing_data[key] = updated_data[key]
+
+    @staticmethod
+    def _apply_restore(data: Dict, version_to_restore: Dict, restored_scope: str):
+        data["project_name"] = version_to_restore.get("project_name", data.get("project_name", ""))
+        data["scope"] = restored_scope
+        data.setdefault("restoration_notes", []).append({
+            "timestamp": time.time(),
+            "formatted_time": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "message": f"Restored to version from {version_to_restore.get('formatted_time')}"
+        })
+
+
+class FileScopeStore(ScopeStore):
+    """Filesystem storage for saved scopes.
+
+    Each scope is a small head record at scopes/<id>.json holding the current document,
+    and its version history lives in segment files under scopes/history/<id>/ (paths as
+    in the default flat layout; see ScopeLayout for the sharded and compressed ones). Every
+    segment starts with a full snapshot, so any version can be rebuilt from one segment.
+    The segment size is recorded in the head, so changing it only affects new scopes.
+
+    Versions are numbered from 1 in the order they were saved, so a version number maps
+    straight to its segment. Next to each segment, scopes/history/<id>/index-<segment>.json
+    maps the timestamps of its versions to version numbers for links that still use
+    timestamps, so a save only rewrites the files of the last segment.
+
+    Writes go through a temporary file and a rename, and read-modify-write operations on a
+    scope hold a lock file under scopes/locks/ for that scope only. Parsed files are kept
+    in an in-process LRU cache.
+    """
+
+    def __init__(self, scopes_dir: str = "scopes", segment_size: int = SNAPSHOT_INTERVAL):
+        self.scopes_dir = Path(scopes_dir)
+        self.segment_size = segment_size
+        self.scopes_dir.mkdir(parents=True, exist_ok=True)
+        self.layout = ScopeLayout.load(str(self.scopes_dir))
+        self.cache = ScopeCache()
+
+        # Index of saved scopes used for listing; built from the scope files on first use
+        self.catalog_path = self.scopes_dir / "catalog.sqlite3"
+        catalog_exists = self.catalog_path.exists()
+        self.catalog = ScopeCatalog(str(self.catalog_path))
+        if not catalog_exists or self.catalog.needs_rebuild:
+            self.rebuild_catalog()
+
+        self.ids = ScopeIdIndex(self._scan_ids, self._change_token)
+
+    def _head_path(self, scope_id: str) -> Path:
+        return self.layout.head_path(scope_id)
+
+    def _segment_path(self, scope_id: str, segment: int) -> Path:
+        return self.layout.history_file(scope_id, f"{segment:06d}")
+
+    def _index_path(self, scope_id: str, segment: int) -> Path:
+        return self.layout.history_file(scope_id, f"index-{segment:06d}")
+
+    def _lock(self, scope_id: str):
+        return file_lock(self.layout.lock_path(scope_id))
+
+    def _scan_ids(self):
+        return (self.layout.scope_id_from_path(path) for path in self.layout.iter_head_paths())
+
+    def _change_token(self):
+        # New head files change the directory mtime in the flat layout; every save from any
+        # process also writes the catalog, which covers the sharded layout
+        tokens = []
+        for path in (self.scopes_dir, self.catalog_path):
+            try:
+                tokens.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                tokens.append(None)
+        return tuple(tokens)
+
+    def _read_json(self, path: Path, use_cache: bool = True):
+        """Read a scope file, from the cache unless use_cache is False.
+
+        Read-modify-write operations pass use_cache=False for the files they read under the
+        scope lock, so they always start from what is on disk.
+        """
+        data = self.cache.get(path) if use_cache else None
+        if data is None:
+            started = time.perf_counter()
+            # The signature comes from the open file, so a file swapped in by another
+            # process's write after this read can't be cached with this parse
+            with open(path, 'rb') as f:
+                stat = os.fstat(f.fileno())
+                raw = f.read()
+            payload = self.layout.decompress(raw)
+            data = json.loads(payload)
+            SCOPE_FILE_SECONDS.observe(time.perf_counter() - started, operation="read")
+            self.cache.put(path, data, stat, len(payload))
+        return data
+
+    def _write_json(self, path: Path, data):
+        started = time.perf_counter()
+        payload = self.layout.dump(data)
+        stat = atomic_write(path, self.layout.compress(payload), mode='wb')
+        SCOPE_FILE_SECONDS.observe(time.perf_counter() - started, operation="write")
+        self.cache.put(path, data, stat, len(payload))
+
+    def _file_name(self, path: Path) -> str:
+        return path.relative_to(self.scopes_dir).as_posix()
+
+    def _iter_heads(self):
+        for file_path in self.layout.iter_head_paths():
+            try:
+                yield self.layout.read(file_path), self._file_name(file_path)
+            except Exception as e:
+                print(f"Error reading scope file {file_path}: {str(e)}")
+
+    def _read_head(self, scope_id: str, use_cache: bool = True) -> Optional[Dict]:
+        file_path = self._head_path(scope_id)
+        if not file_path.exists():
+            return None
+        return self._read_json(file_path, use_cache)
+
+    def _load_segment(self, scope_id: str, segment: int, use_cache: bool = True) -> List[Dict]:
+        segment_path = self._segment_path(scope_id, segment)
+        if not segment_path.exists():
+            return []
+        return self._read_json(segment_path, use_cache)
+
+    def _load_history(self, scope_id: str, head: Dict, use_cache: bool = True) -> List[Dict]:
+        """Load every stored version of a scope, oldest first."""
+        if "version_history" in head:
+            return head["version_history"]
+        history = []
+        history_length = head.get("history_length", 0)
+        segment_size = head.get("history_segment_size", self.segment_size)
+        segment_count = -(-history_length // segment_size)
+        for segment in range(segment_count):
+            history.extend(self._load_segment(scope_id, segment, use_cache))
+        # A segment can run ahead of the head if a save was interrupted between the two writes
+        return history[:history_length]
+
+    def _get_version(self, scope_id: str, head: Dict, version_id: int, use_cache: bool = True):
+        """Look up a version by number, loading only the segment that holds it.
+
+        Returns the entries of that segment and the version's position in it, or (None, None).
+        """
+        history_length = len(head["version_history"]) if "version_history" in head else head.get("history_length", 0)
+        if not 1 <= version_id <= history_length:
+            return None, None
+        if "version_history" in head:
+            return head["version_history"], version_id - 1
+
+        segment_size = head.get("history_segment_size", self.segment_size)
+        segment, offset = divmod(version_id - 1, segment_size)
+        entries = self._load_segment(scope_id, segment, use_cache)
+        if offset >= len(entries):
+            return None, None
+        return entries, offset
+
+    @staticmethod
+    def _version_index(entries: List[Dict], first_version: int = 1) -> Dict[str, int]:
+        """Map the timestamps of consecutive versions, starting at first_version, to their numbers."""
+        return {timestamp_key(entry["timestamp"]): version_id
+                for version_id, entry in enumerate(entries, first_version) if "timestamp" in entry}
+
+    def _write_version_index(self, scope_id: str, segment: int, entries: List[Dict], segment_size: int):
+        self._write_json(self._index_path(scope_id, segment), self._version_index(entries, segment * segment_size + 1))
+
+    def _lookup_version(self, scope_id: str, head: Dict, key: str) -> Optional[int]:
+        """Find the version saved at a timestamp key, searching the newest segments first."""
+        if "version_history" in head:
+            return self._version_index(head["version_history"]).get(key)
+        history_length = head.get("history_length", 0)
+        segment_size = head.get("history_segment_size", self.segment_size)
+        for segment in reversed(range(-(-history_length // segment_size))):
+            index_path = self._index_path(scope_id, segment)
+            if index_path.exists():
+                version_index = self._read_json(index_path)
+            else:
+                # Segments saved before the per-segment indexes existed
+                version_index = self._version_index(self._load_segment(scope_id, segment), segment * segment_size + 1)
+            version_id = version_index.get(key)
+            # A segment can run ahead of the head if a save was interrupted between the writes
+            if version_id is not None and version_id <= history_length:
+                return version_id
+        return None
+
+    def _append_version(self, scope_id: str, head: Dict, entry: Dict, scope: str):
+        """Add a version to the last history segment, starting a new segment when it is full."""
+        index = head.get("history_length", 0)
+        segment_size = head.setdefault("history_segment_size", self.segment_size)
+        segment = index // segment_size
+        entries = self._load_segment(scope_id, segment, use_cache=False)[:index - segment * segment_size]
+        append_version(entries, dict(entry, version=index + 1), scope, segment_size)
+        self._write_json(self._segment_path(scope_id, segment), entries)
+        self._write_version_index(scope_id, segment, entries, segment_size)
+        head["history_length"] = index + 1
+
+    def _split_history(self, scope_id: str, head: Dict):
+        """Move history embedded in an older head record out into segment files."""
+        if "version_history" not in head:
+            return
+        history = head.pop("version_history")
+        head["history_segment_size"] = self.segment_size
+        segments = {}
+        for index, entry in enumerate(history):
+            entries = segments.setdefault(index // self.segment_size, [])
+            append_version(entries, dict(entry, version=index + 1), reconstruct_scope(history, index),
+                           self.segment_size)
+        for segment, entries in segments.items():
+            self._write_json(self._segment_path(scope_id, segment), entries)
+            self._write_version_index(scope_id, segment, entries, self.segment_size)
+        head["history_length"] = len(history)
+
+    def rebuild_catalog(self) -> int:
+        """Recreate the listing and search catalog from the scope files."""
+        return self.catalog.rebuild(self._iter_heads())
+
+    @storage_timed("file", "list")
+    def list(self, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """List saved scopes with basic information, newest first."""
+        return self.catalog.list(limit, offset)
+
+    @storage_timed("file", "search")
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """Full-text search over saved scopes, best matches first."""
+        return self.catalog.search(query, limit, offset)
+
+    @storage_timed("file", "resolve_id")
+    def resolve_id(self, partial_id: str) -> Optional[str]:
+        """Find the saved scope ID that matches partial_id, without opening any scope file."""
+        return self.ids.resolve(partial_id)
+
+    def cache_stats(self) -> Dict:
+        return self.cache.stats()
+
+    @storage_timed("file", "create")
+    def create(self, scope_data: Dict):
+        """Save a newly generated scope."""
+        head = dict(scope_data)
+        head.pop("version_history", None)
+        head["history_length"] = 0
+        head["history_segment_size"] = self.segment_size
+        file_path = self._head_path(head["id"])
+        self._write_json(file_path, head)
+        self.catalog.upsert(head, self._file_name(file_path))
+        self.ids.add(head["id"])
+
+    @storage_timed("file", "get")
+    def get(self, scope_id: str) -> Optional[Dict]:
+        """Get the current document of a scope without its history."""
+        try:
+            head = self._read_head(scope_id)
+        except Exception as e:
+            print(f"Error reading scope file {self._head_path(scope_id)}: {str(e)}")
+            return None
+        if head is not None:
+            head.pop("version_history", None)
+        return head
+
+    @storage_timed("file", "update")
+    def update(self, scope_id: str, updated_data: Dict) -> bool:
+        """Update a saved scope with edited data and maintain version history."""
+        file_path = self._head_path(scope_id)
+
+        try:
+            with self._lock(scope_id):
+                existing_data = self._read_head(scope_id, use_cache=False)
+                if existing_data is None:
+                    return False
+                self._split_history(scope_id, existing_data)
+
+                # Only add to history if content actually changed
+                if self._is_changed(existing_data, updated_data):
+                    self._append_version(scope_id, existing_data, self._version_entry(existing_data),
+                                         existing_data.get("scope", ""))
+                self._apply_update(existing_data, updated_data)
+
+                # Write the updated data back
+                self._write_json(file_path, existing_data)
+                self.catalog.upsert(existing_data, self._file_name(file_path))
+
+                return True
+        except Exception as e:
+            print(f"Error updating scope file {file_path}: {str(e)}")
+            return False
+
+    @storage_timed("file", "history")
+    def history(self, scope_id: str) -> List[Dict]:
+        """Get the version history of a scope, without the text of each version."""
+        try:
+            head = self._read_head(scope_id)
+            if head is None:
+                return []
+            return [dict(version_metadata(v), version=v.get("version", version_id))
+                    for version_id, v in enumerate(self._load_history(scope_id, head), 1)]
+        except Exception as e:
+            print(f"Error reading scope history {self._head_path(scope_id)}: {str(e)}")
+            return []
+
+    @storage_timed("file", "find_version_id")
+    def find_version_id(self, scope_id: str, version_timestamp: float) -> Optional[int]:
+        """Get the number of the version saved at the given timestamp."""
+        try:
+            head = self._read_head(scope_id)
+            if head is None:
+                return None
+            return self._lookup_version(scope_id, head, timestamp_key(version_timestamp))
+        except Exception as e:
+            print(f"Error reading version index {self.layout.history_dir(scope_id)}: {str(e)}")
+            return None
+
+    @storage_timed("file", "version")
+    def version(self, scope_id: str, version_id: int) -> Optional[Dict]:
+        """Get a single version of a scope, with its text rebuilt from the history."""
+        try:
+            head = self._read_head(scope_id)
+            if head is None:
+                return None
+
+            entries, index = self._get_version(scope_id, head, version_id)
+            if entries is None:
+                return None
+
+            version = version_metadata(entries[index])
+            version["version"] = version_id
+            version["scope"] = reconstruct_scope(entries, index)
+            return version
+        except Exception as e:
+            print(f"Error reading scope version {self._head_path(scope_id)}: {str(e)}")
+            return None
+
+    @storage_timed("file", "restore")
+    def restore(self, scope_id: str, version_id: int) -> bool:
+        """Restore a scope to a previous version from history."""
+        file_path = self._head_path(scope_id)
+
+        try:
+            with self._lock(scope_id):
+                data = self._read_head(scope_id, use_cache=False)
+                if data is None:
+                    return False
+                self._split_history(scope_id, data)
+
+                # Look up the version to restore
+                entries, index = self._get_version(scope_id, data, version_id, use_cache=False)
+                if entries is None:
+                    return False
+                version_to_restore = entries[index]
+                restored_scope = reconstruct_scope(entries, index)
+
+                # Add the current version to history, then bring back the old one
+                current_version = self._version_entry(
+                    data,
+                    is_restore_point=True,
+                    restored_from=version_to_restore.get("timestamp"),
+                    restored_from_version=version_id
+                )
+                self._append_version(scope_id, data, current_version, data.get("scope", ""))
+                self._apply_restore(data, version_to_restore, restored_scope)
+
+                # Write the updated data back
+                self._write_json(file_path, data)
+                self.catalog.upsert(data, self._file_name(file_path))
+
+                return True
+        except Exception as e:
+            print(f"Error restoring scope version {file_path}: {str(e)}")
+            return False
+
+    def migrate(self) -> int:
+        """Move embedded version history of older scope files out into diff-encoded segments."""
+        migrated = 0
+        for file_path in list(self.layout.iter_head_paths()):
+            scope_id = self.layout.scope_id_from_path(file_path)
+            try:
+                with self._lock(scope_id):
+                    head = self._read_json(file_path, use_cache=False)
+                    if "version_history" not in head:
+                        continue
+                    self._split_history(scope_id, head)
+                    self._write_json(file_path, head)
+                migrated += 1
+            except Exception as e:
+                print(f"Error migrating scope file {file_path}: {str(e)}")
+        return migrated
+
+    def convert(self, layout: str, compression: str) -> int:
+        """Rewrite every scope file in another layout or compression.
+
+        New files are written first and the format only switches once all of them exist,
+        so an interrupted conversion leaves the old files in place. Stop the app while it runs.
+        """
+        target = ScopeLayout(str(self.scopes_dir), layout, compression)
+        if (target.layout, target.compression) == (self.layout.layout, self.layout.compression):
+            return 0
+
+        converted = []
+        for file_path in list(self.layout.iter_head_paths()):
+            scope_id = self.layout.scope_id_from_path(file_path)
+            with self._lock(scope_id):
+                atomic_write(target.head_path(scope_id), target.encode(self.layout.read(file_path)), mode='wb')
+                history_files = []
+                history_dir = self.layout.history_dir(scope_id)
+                if history_dir.exists():
+                    for history_path in history_dir.iterdir():
+                        if not history_path.name.endswith(self.layout.suffix):
+                            continue
+                        name = history_path.name[:-len(self.layout.suffix)]
+                        atomic_write(target.history_file(scope_id, name),
+                                     target.encode(self.layout.read(history_path)), mode='wb')
+                        history_files.append(history_path)
+            converted.append((scope_id, file_path, history_files))
+
+        target.save()
+        for scope_id, file_path, history_files in converted:
+            file_path.unlink(missing_ok=True)
+            for history_path in history_files:
+                history_path.unlink(missing_ok=True)
+            # Drop directories the old layout no longer needs; rmdir leaves non-empty ones alone
+            for directory in (self.layout.history_dir(scope_id), self.layout.history_dir(scope_id).parent,
+                              file_path.parent):
+                if directory not in (self.scopes_dir, self.scopes_dir / "history"):
+                    try:
+                        directory.rmdir()
+                    except OSError:
+                        pass
+
+        self.layout = target
+        self.cache.clear()
+        self.rebuild_catalog()
+        self.ids = ScopeIdIndex(self._scan_ids, self._change_token)
+        return len(converted)
+
+
+def open_store(scopes_dir: str = "scopes") -> ScopeStore:
+    """Open the storage backend chosen by SCOPE_STORAGE_BACKEND."""
+    if STORAGE_BACKEND == "sqlite":
+        from scope_store_sqlite import SQLiteScopeStore
+        return SQLiteScopeStore(SQLITE_PATH)
+    if STORAGE_BACKEND != "file":
+        raise ValueError(f"Unknown scope storage backend '{STORAGE_BACKEND}', expected file or sqlite")
+    return FileScopeStore(scopes_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage saved scope storage.")
+    parser.add_argument("command", choices=["migrate", "convert"],
+                        help="migrate: move embedded version history into diff-encoded history segments; "
+                             "convert: rewrite all scope files in the given --layout and --compression")
+    parser.add_argument("--scopes-dir", default="scopes")
+    parser.add_argument("--layout", choices=LAYOUTS, default="sharded")
+    parser.add_argument("--compression", choices=COMPRESSIONS, default="gzip")
+    args = parser.parse_args()
+
+    store = FileScopeStore(args.scopes_dir)
+    if args.command == "migrate":
+        count = store.migrate()
+        print(f"Migrated version history of {count} scopes")
+    else:
+        count = store.convert(args.layout, args.compression)
+        print(f"Converted {count} scopes to the {args.layout} layout with {args.compression} compression")
@@ -0,0 +1,372 @@
+import argparse
+import json
+import os
+import sqlite3
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from metrics import storage_timed
+from scope_catalog import ScopeCatalog
+from scope_history import SNAPSHOT_INTERVAL, append_version, reconstruct_scope, timestamp_key, version_metadata
+from scope_ids import ScopeIdIndex
+from scope_store import SQLITE_PATH, FileScopeStore, ScopeStore
+
+# Head fields kept in their own columns; anything else a scope carries goes in the extra column
+_DOCUMENT_FIELDS = ("id", "project_name", "date_created", "formatted_date", "project_info", "scope",
+                    "history_length")
+
+
+class SQLiteScopeStore(ScopeStore):
+    """SQLite storage for saved scopes.
+
+    The scope_documents table holds the current document of each scope, with indexed id,
+    project_name and date_created columns so listing pages straight from the index.
+    scope_versions holds one row per version: its metadata and either a full snapshot or a
+    diff against the version before, as in the filesystem history segments. The search
+    tables of ScopeCatalog live in the same database and are written in the same
+    transaction as the document.
+
+    The database runs in WAL mode, so readers never wait for a save. Read-modify-write
+    operations take the write lock up front with BEGIN IMMEDIATE, which serializes them
+    across threads and processes.
+    """
+
+    def __init__(self, db_path: str = SQLITE_PATH, snapshot_interval: int = SNAPSHOT_INTERVAL):
+        self.db_path = Path(db_path)
+        self.snapshot_interval = snapshot_interval
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._local = threading.local()
+
+        with self._transaction() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scope_documents (
+                    id TEXT PRIMARY KEY,
+                    project_name TEXT NOT NULL,
+                    date_created REAL NOT NULL,
+                    formatted_date TEXT NOT NULL,
+                    project_info TEXT NOT NULL,
+                    scope TEXT NOT NULL,
+                    extra TEXT NOT NULL,
+                    history_length INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_project_name ON scope_documents (project_name)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_documents_date_created "
+                         "ON scope_documents (date_created DESC)")
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS scope_versions (
+                    scope_id TEXT NOT NULL,
+                    version INTEGER NOT NULL,
+                    timestamp_key TEXT,
+                    is_snapshot INTEGER NOT NULL,
+                    metadata TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    PRIMARY KEY (scope_id, version)
+                ) WITHOUT ROWID
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_versions_timestamp ON scope_versions (scope_id, timestamp_key)")
+
+        self.catalog = ScopeCatalog(str(self.db_path))
+        if self.catalog.needs_rebuild:
+            self.rebuild_catalog()
+        self.ids = ScopeIdIndex(self._scan_ids, self._change_token)
+
+    def _connect(self) -> sqlite3.Connection:
+        """Return this thread's connection, opening it on first use."""
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode; transactions are opened explicitly by _transaction
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode = WAL")
+            conn.execute("PRAGMA synchronous = NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Run a block in a write transaction, holding the database write lock from the start."""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _scan_ids(self):
+        with self._connect_reader() as conn:
+            return [row[0] for row in conn.execute("SELECT id FROM scope_documents")]
+
+    @contextmanager
+    def _connect_reader(self) -> Iterator[sqlite3.Connection]:
+        # The ID index rescans from whichever thread resolves an ID, so it gets its own connection
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def _change_token(self):
+        # In WAL mode every commit appends to the -wal file; checkpoints rewrite the database file
+        tokens = []
+        for path in (self.db_path, Path(f"{self.db_path}-wal")):
+            try:
+                stat = os.stat(path)
+                tokens.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                tokens.append(None)
+        return tuple(tokens)
+
+    @staticmethod
+    def _document_from_row(row: sqlite3.Row) -> Dict:
+        data = json.loads(row["extra"])
+        data.update({
+            "id": row["id"],
+            "project_name": row["project_name"],
+            "project_info": json.loads(row["project_info"]),
+            "scope": row["scope"],
+            "date_created": row["date_created"],
+            "formatted_date": row["formatted_date"],
+            "history_length": row["history_length"]
+        })
+        return data
+
+    def _read_document(self, conn: sqlite3.Connection, scope_id: str) -> Optional[Dict]:
+        row = conn.execute("SELECT * FROM scope_documents WHERE id = ?", (scope_id,)).fetchone()
+        return self._document_from_row(row) if row else None
+
+    def _write_document(self, conn: sqlite3.Connection, data: Dict):
+        extra = {k: v for k, v in data.items() if k not in _DOCUMENT_FIELDS and k != "version_history"}
+        conn.execute(
+            "INSERT INTO scope_documents (id, project_name, date_created, formatted_date, project_info, "
+            "scope, extra, history_length) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (id) DO UPDATE SET project_name = excluded.project_name, "
+            "date_created = excluded.date_created, formatted_date = excluded.formatted_date, "
+            "project_info = excluded.project_info, scope = excluded.scope, extra = excluded.extra, "
+            "history_length = excluded.history_length",
+            (
+                data["id"],
+                data.get("project_name", "Unknown Project"),
+                data.get("date_created", 0),
+                data.get("formatted_date", "Unknown Date"),
+                json.dumps(data.get("project_info", {})),
+                data.get("scope", ""),
+                json.dumps(extra),
+                data.get("history_length", 0)
+            )
+        )
+        self.catalog._write(conn, data, "")
+
+    def _load_entries(self, conn: sqlite3.Connection, scope_id: str, version_id: int) -> List[Dict]:
+        """Load the stored versions from the last snapshot up to version_id, oldest first."""
+        rows = conn.execute(
+            "SELECT metadata, body FROM scope_versions "
+            "WHERE scope_id = ? AND version <= ? AND version >= ("
+            "    SELECT MAX(version) FROM scope_versions WHERE scope_id = ? AND version <= ? AND is_snapshot"
+            ") ORDER BY version",
+            (scope_id, version_id, scope_id, version_id)
+        ).fetchall()
+        return [dict(json.loads(row["metadata"]), **json.loads(row["body"])) for row in rows]
+
+    def _insert_version(self, conn: sqlite3.Connection, scope_id: str, version_id: int, entry: Dict):
+        body = {k: entry[k] for k in ("scope", "delta") if k in entry}
+        conn.execute(
+            "INSERT OR REPLACE INTO scope_versions (scope_id, version, timestamp_key, is_snapshot, metadata, body) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                scope_id,
+                version_id,
+                timestamp_key(entry["timestamp"]) if "timestamp" in entry else None,
+                "scope" in entry,
+                json.dumps(dict(version_metadata(entry), version=version_id)),
+                json.dumps(body)
+            )
+        )
+
+    def _append_version(self, conn: sqlite3.Connection, data: Dict, entry: Dict, scope: str):
+        """Store a version as a snapshot or as a diff against the version before it."""
+        index = data.get("history_length", 0)
+        entries = self._load_entries(conn, data["id"], index) if index else []
+        append_version(entries, dict(entry, version=index + 1), scope, self.snapshot_interval)
+        self._insert_version(conn, data["id"], index + 1, entries[-1])
+        data["history_length"] = index + 1
+
+    def rebuild_catalog(self) -> int:
+        """Recreate the search catalog from the stored documents."""
+        with self._connect_reader() as conn:
+            conn.row_factory = sqlite3.Row
+            documents = [self._document_from_row(row) for row in conn.execute("SELECT * FROM scope_documents")]
+        return self.catalog.rebuild((data, "") for data in documents)
+
+    @storage_timed("sqlite", "list")
+    def list(self, limit: Optional[int] = None, offset: int = 0) -> List[Dict]:
+        """List saved scopes with basic information, newest first, optionally one page at a time."""
+        rows = self._connect().execute(
+            "SELECT id, project_name, date_created, formatted_date FROM scope_documents "
+            "ORDER BY date_created DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)
+        ).fetchall()
+        return [dict(row) for row in rows]
+
+    @storage_timed("sqlite", "search")
+    def search(self, query: str, limit: int = 20, offset: int = 0) -> List[Dict]:
+        """Full-text search over saved scopes, best matches first."""
+        return self.catalog.search(query, limit, offset)
+
+    @storage_timed("sqlite", "resolve_id")
+    def resolve_id(self, partial_id: str) -> Optional[str]:
+        """Find the saved scope ID that matches partial_id exactly, by prefix or by substring."""
+        return self.ids.resolve(partial_id)
+
+    @storage_timed("sqlite", "create")
+    def create(self, scope_data: Dict):
+        """Save a newly generated scope."""
+        data = dict(scope_data)
+        data["history_length"] = 0
+        with self._transaction() as conn:
+            self._write_document(conn, data)
+        self.ids.add(data["id"])
+
+    @storage_timed("sqlite", "get")
+    def get(self, scope_id: str) -> Optional[Dict]:
+        """Get the current document of a scope without its history."""
+        try:
+            return self._read_document(self._connect(), scope_id)
+        except Exception as e:
+            print(f"Error reading scope {scope_id} from {self.db_path}: {str(e)}")
+            return None
+
+    @storage_timed("sqlite", "update")
+    def update(self, scope_id: str, updated_data: Dict) -> bool:
+        """Update a saved scope with edited data and maintain version history."""
+        try:
+            with self._transaction() as conn:
+                existing_data = self._read_document(conn, scope_id)
+                if existing_data is None:
+                    return False
+
+                # Only add to history if content actually changed
+                if self._is_changed(existing_data, updated_data):
+                    self._append_version(conn, existing_data, self._version_entry(existing_data),
+                                         existing_data.get("scope", ""))
+                self._apply_update(existing_data, updated_data)
+                self._write_document(conn, existing_data)
+                return True
+        except Exception as e:
+            print(f"Error updating scope {scope_id} in {self.db_path}: {str(e)}")
+            return False
+
+    @storage_timed("sqlite", "history")
+    def history(self, scope_id: str) -> List[Dict]:
+        """Get the version history of a scope, without the text of each version."""
+        try:
+            rows = self._connect().execute(
+                "SELECT metadata FROM scope_versions WHERE scope_id = ? ORDER BY version", (scope_id,)
+            ).fetchall()
+            return [json.loads(row["metadata"]) for row in rows]
+        except Exception as e:
+            print(f"Error reading scope history {scope_id} from {self.db_path}: {str(e)}")
+            return []
+
+    @storage_timed("sqlite", "find_version_id")
+    def find_version_id(self, scope_id: str, version_timestamp: float) -> Optional[int]:
+        """Get the number of the version saved at the given timestamp."""
+        try:
+            row = self._connect().execute(
+                "SELECT version FROM scope_versions WHERE scope_id = ? AND timestamp_key = ?",
+                (scope_id, timestamp_key(version_timestamp))
+            ).fetchone()
+            return row["version"] if row else None
+        except Exception as e:
+            print(f"Error reading version index {scope_id} from {self.db_path}: {str(e)}")
+            return None
+
+    @storage_timed("sqlite", "version")
+    def version(self, scope_id: str, version_id: int) -> Optional[Dict]:
+        """Get a single version of a scope, with its text rebuilt from the history."""
+        try:
+            entries = self._load_entries(self._connect(), scope_id, version_id)
+            if not entries or entries[-1].get("version") != version_id:
+                return None
+            version = version_metadata(entries[-1])
+            version["scope"] = reconstruct_scope(entries, len(entries) - 1)
+            return version
+        except Exception as e:
+            print(f"Error reading scope version {scope_id} from {self.db_path}: {str(e)}")
+            return None
+
+    @storage_timed("sqlite", "restore")
+    def restore(self, scope_id: str, version_id: int) -> bool:
+        """Restore a scope to a previous version from history."""
+        try:
+            with self._transaction() as conn:
+                data = self._read_document(conn, scope_id)
+                if data is None:
+                    return False
+
+                # Look up the version to restore
+                entries = self._load_entries(conn, scope_id, version_id)
+                if not entries or entries[-1].get("version") != version_id:
+                    return False
+                version_to_restore = entries[-1]
+                restored_scope = reconstruct_scope(entries, len(entries) - 1)
+
+                # Add the current version to history, then bring back the old one
+                current_version = self._version_entry(
+                    data,
+                    is_restore_point=True,
+                    restored_from=version_to_restore.get("timestamp"),
+                    restored_from_version=version_id
+                )
+                self._append_version(conn, data, current_version, data.get("scope", ""))
+                self._apply_restore(data, version_to_restore, restored_scope)
+                self._write_document(conn, data)
+                return True
+        except Exception as e:
+            print(f"Error restoring scope version {scope_id} in {self.db_path}: {str(e)}")
+            return False
+
+    def import_files(self, scopes_dir: str = "scopes") -> int:
+        """Copy every scope and its version history from a filesystem scopes directory.
+
+        History entries are copied as stored: segments and older embedded histories both
+        start from a full snapshot, so their diffs stay valid. Scopes already in the
+        database are replaced, so an interrupted import can simply be run again.
+        """
+        source = FileScopeStore(scopes_dir)
+        imported = 0
+        for head, file_name in source._iter_heads():
+            scope_id = head.get("id")
+            if not scope_id:
+                print(f"Skipping scope file {file_name} without an id")
+                continue
+            try:
+                history = source._load_history(scope_id, head)
+                with self._transaction() as conn:
+                    conn.execute("DELETE FROM scope_versions WHERE scope_id = ?", (scope_id,))
+                    for version_id, entry in enumerate(history, 1):
+                        self._insert_version(conn, scope_id, version_id, entry)
+                    data = {k: v for k, v in head.items() if k not in ("version_history", "history_segment_size")}
+                    data["history_length"] = len(history)
+                    self._write_document(conn, data)
+                self.ids.add(scope_id)
+                imported += 1
+            except Exception as e:
+                print(f"Error importing scope file {file_name}: {str(e)}")
+        return imported
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Manage the SQLite scope storage backend.")
+    parser.add_argument("command", choices=["import"],
+                        help="import: copy all scopes and their history from a scopes directory")
+    parser.add_argument("--scopes-dir", default="scopes")
+    parser.add_argument("--db", default=SQLITE_PATH)
+    args = parser.parse_args()
+
+    count = SQLiteScopeStore(args.db).import_files(args.scopes_dir)
+    print(f"Imported {count} scopes into {args.db}")
@@ -0,0 +1,98 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Awaitable, Callable, Dict, Hashable, Tuple
+
+
+class SingleFlight:
+    """Coalesces concurrent calls that share a key into a single execution.
+
+    The first caller for a key runs the work; callers that arrive while it is running wait
+    for it and get the same result or exception. With remember > 0, successful results are
+    also kept for that many seconds (at most max_remembered of them) and returned to later
+    callers with the same key without running the work again.
+
+    Waiting works across threads and event loops, so sync and async callers can share one
+    instance. Coalescing is per process.
+    """
+
+    def __init__(self, remember: float = 0.0, max_remembered: int = 1024):
+        self.remember = remember
+        self.max_remembered = max_remembered
+        self._in_flight: Dict[Hashable, Future] = {}
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.shared = 0
+
+    def begin(self, key: Hashable) -> Tuple[Future, bool]:
+        """Join the call for key, returning its future and whether this caller must run it.
+
+        A caller that gets True must call finish() for the key when it is done.
+        """
+        with self._lock:
+            remembered = self._results.get(key)
+            if remembered is not None:
+                if time.monotonic() - remembered[0] <= self.remember:
+                    self.shared += 1
+                    return remembered[1], False
+                del self._results[key]
+
+            future = self._in_flight.get(key)
+            if future is not None:
+                self.shared += 1
+                return future, False
+            future = self._in_flight[key] = Future()
+            self.calls += 1
+            return future, True
+
+    def finish(self, key: Hashable, future: Future, result=None, error: BaseException = None):
+        """Publish the outcome of a call started with begin() to everyone waiting on it."""
+        with self._lock:
+            self._in_flight.pop(key, None)
+            if error is None and self.remember > 0:
+                self._results[key] = (time.monotonic(), future)
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_remembered:
+                    self._results.popitem(last=False)
+        if error is not None:
+            future.set_exception(error)
+        else:
+            future.set_result(result)
+
+    def do(self, key: Hashable, fn: Callable):
+        """Run fn() unless a call with the same key is running or remembered, and return its result."""
+        future, leader = self.begin(key)
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable]):
+        """Async version of do; fn returns an awaitable."""
+        future, leader = self.begin(key)
+        if not leader:
+            return await asyncio.wrap_future(future)
+        try:
+            result = await fn()
+        except BaseException as e:
+            self.finish(key, future, error=e)
+            raise
+        self.finish(key, future, result)
+        return result
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "shared": self.shared,
+                "in_flight": len(self._in_flight),
+                "remembered": len(self._results)
+            }